@@ -7,7 +7,8 @@ from .models import (
     User, Address, PickupStation, Category, Brand, Vendor, 
     Product, ProductImage, ProductVariant, ProductSpecification,
     Review, Cart, CartItem, Order, OrderItem, Payment, 
-    Coupon, Wishlist, Notification, DeliveryZone, Banner
+    Coupon, Wishlist, Notification, DeliveryZone, Banner, MpesaCallback,
+    ProductRanking
 )
 
 
@@ -114,7 +115,7 @@ class ProductAdmin(admin.ModelAdmin):
     list_filter = ['is_active', 'is_featured', 'category', 'brand', 'created_at']
     search_fields = ['name', 'sku', 'description']
     prepopulated_fields = {'slug': ('name',)}
-    readonly_fields = ['views', 'total_sales', 'created_at', 'updated_at', 'average_rating']
+    readonly_fields = ['views', 'total_sales', 'created_at', 'updated_at', 'rating_avg', 'rating_count']
     list_editable = ['is_active', 'is_featured']
     date_hierarchy = 'created_at'
     inlines = [ProductImageInline, ProductVariantInline, ProductSpecificationInline]
@@ -140,7 +141,7 @@ class ProductAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
         ('Statistics', {
-            'fields': ('views', 'total_sales', 'average_rating', 'created_at', 'updated_at'),
+            'fields': ('views', 'total_sales', 'rating_avg', 'rating_count', 'created_at', 'updated_at'),
             'classes': ('collapse',)
         }),
     )
@@ -266,8 +267,11 @@ class PaymentAdmin(admin.ModelAdmin):
         'amount_display', 'created_at', 'completed_at'
     ]
     list_filter = ['payment_method', 'status', 'created_at']
-    search_fields = ['transaction_id', 'order__order_number', 'mpesa_receipt', 'mpesa_phone']
-    readonly_fields = ['transaction_id', 'created_at', 'completed_at']
+    search_fields = [
+        'transaction_id', 'order__order_number', 'mpesa_receipt', 'mpesa_phone',
+        'checkout_request_id', 'merchant_request_id'
+    ]
+    readonly_fields = ['transaction_id', 'checkout_request_id', 'merchant_request_id', 'created_at', 'completed_at']
     date_hierarchy = 'created_at'
     
     fieldsets = (
@@ -275,7 +279,7 @@ class PaymentAdmin(admin.ModelAdmin):
             'fields': ('order', 'transaction_id', 'payment_method', 'status', 'amount')
         }),
         ('M-Pesa Details', {
-            'fields': ('mpesa_receipt', 'mpesa_phone'),
+            'fields': ('mpesa_receipt', 'mpesa_phone', 'checkout_request_id', 'merchant_request_id'),
             'classes': ('collapse',)
         }),
         ('Card Details', {
@@ -374,6 +378,24 @@ class BannerAdmin(admin.ModelAdmin):
     banner_preview.short_description = 'Preview'
 
 
+# M-Pesa Callback Inbox Admin
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ['id', 'checkout_request_id', 'status', 'attempts', 'received_at', 'processed_at']
+    list_filter = ['status', 'received_at']
+    search_fields = ['checkout_request_id']
+    readonly_fields = ['checkout_request_id', 'payload', 'received_at', 'processed_at', 'attempts', 'error']
+    date_hierarchy = 'received_at'
+
+
+# Product Ranking Admin
+@admin.register(ProductRanking)
+class ProductRankingAdmin(admin.ModelAdmin):
+    list_display = ['scope', 'scope_id', 'metric', 'refreshed_at']
+    list_filter = ['scope', 'metric']
+    readonly_fields = ['scope', 'scope_id', 'metric', 'entries', 'refreshed_at']
+
+
 # Admin Site Customization
 admin.site.site_header = "Jumia V2 Admin"
 admin.site.site_title = "Jumia V2"
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ECommerceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'e_commerce'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,306 @@
+"""
+Checkout funnel benchmark.
+
+Drives the shop in-process with Django's test client, one shopper walking
+home -> category -> search -> product -> cart -> checkout -> place order ->
+M-Pesa payment -> callback per iteration, and records latency and query
+counts for every step. Safaricom's Daraja API is replaced by DarajaStub, a
+local HTTP server, so payments run end to end without leaving the machine.
+
+Results can be saved as a baseline JSON and later runs compared against it;
+see the ``benchmark`` management command. Seed a catalog first, e.g.
+``python manage.py seed_data --scale 100000``. The run places real orders
+for a dedicated ``benchmark`` user, so point it at a disposable database.
+"""
+
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from .models import Category, Order, Payment, PickupStation, Product, User
+from .mpesa import STK_QUERY_IN_PROGRESS
+from .mpesa_callbacks import drain
+from .percentiles import percentile
+
+
+STEPS = (
+    'home',
+    'category_products',
+    'search',
+    'product_detail',
+    'add_to_cart',
+    'cart',
+    'checkout',
+    'place_order',
+    'initiate_mpesa_payment',
+    'mpesa_callback',
+)
+
+BENCHMARK_USERNAME = 'benchmark'
+BENCHMARK_PHONE = '0712345678'
+
+
+class DarajaStub:
+    """
+    Local stand-in for the Safaricom OAuth, STK push and STK query endpoints.
+    STK queries for CheckoutRequestIDs in ``pending`` get Daraja's HTTP 500
+    "still being processed" answer; all others report a successful payment.
+    """
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.pending = set()
+        # Request ids must not repeat across runs against the same database
+        self.run_id = uuid.uuid4().hex[:8]
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.reply({'access_token': 'stub-access-token', 'expires_in': '3599'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                query = self.path.startswith('/mpesa/stkpushquery/')
+                if query and payload.get('CheckoutRequestID') in stub.pending:
+                    self.reply({
+                        'requestId': payload.get('CheckoutRequestID'),
+                        'errorCode': STK_QUERY_IN_PROGRESS,
+                        'errorMessage': 'The transaction is being processed',
+                    }, status=500)
+                elif query:
+                    self.reply({
+                        'ResponseCode': '0',
+                        'ResponseDescription': 'The service request has been accepted successsfully',
+                        'MerchantRequestID': payload.get('MerchantRequestID', ''),
+                        'CheckoutRequestID': payload.get('CheckoutRequestID', ''),
+                        'ResultCode': '0',
+                        'ResultDesc': 'The service request is processed successfully.',
+                    })
+                else:
+                    n = next(stub.ids)
+                    self.reply({
+                        'MerchantRequestID': f'stub-merchant-{stub.run_id}-{n}',
+                        'CheckoutRequestID': f'ws_CO_stub_{stub.run_id}_{n}',
+                        'ResponseCode': '0',
+                        'ResponseDescription': 'Success. Request accepted for processing',
+                        'CustomerMessage': 'Success. Request accepted for processing',
+                    })
+
+            def reply(self, data, status=200):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def settings(self):
+        """MPESA_* settings pointing at this stub"""
+        return {
+            'MPESA_CONSUMER_KEY': 'stub-key',
+            'MPESA_CONSUMER_SECRET': 'stub-secret',
+            'MPESA_SHORTCODE': '174379',
+            'MPESA_PASSKEY': 'stub-passkey',
+            'MPESA_AUTH_URL': f'{self.base_url}/oauth/v1/generate?grant_type=client_credentials',
+            'MPESA_STK_PUSH_URL': f'{self.base_url}/mpesa/stkpush/v1/processrequest',
+            'MPESA_QUERY_URL': f'{self.base_url}/mpesa/stkpushquery/v1/query',
+            'MPESA_CALLBACK_URL': 'http://testserver/payment/mpesa/callback/',
+        }
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def callback_payload(checkout_request_id, merchant_request_id, amount, phone):
+    """A successful STK push callback as Safaricom sends it"""
+    return {
+        'Body': {
+            'stkCallback': {
+                'MerchantRequestID': merchant_request_id,
+                'CheckoutRequestID': checkout_request_id,
+                'ResultCode': 0,
+                'ResultDesc': 'The service request is processed successfully.',
+                'CallbackMetadata': {
+                    'Item': [
+                        {'Name': 'Amount', 'Value': amount},
+                        {'Name': 'MpesaReceiptNumber', 'Value': f'STUB{checkout_request_id[-8:].upper()}'},
+                        {'Name': 'TransactionDate', 'Value': int(time.strftime('%Y%m%d%H%M%S'))},
+                        {'Name': 'PhoneNumber', 'Value': int(phone)},
+                    ]
+                }
+            }
+        }
+    }
+
+
+class StepStats:
+    def __init__(self):
+        self.durations = []
+        self.queries = []
+        self.errors = 0
+
+    def record(self, seconds, queries, ok):
+        self.durations.append(seconds)
+        self.queries.append(queries)
+        if not ok:
+            self.errors += 1
+
+    def summary(self):
+        durations = sorted(self.durations)
+        total = sum(durations)
+        return {
+            'requests': len(durations),
+            'errors': self.errors,
+            'rps': round(len(durations) / total, 2) if total else 0.0,
+            'p50_ms': round(percentile(durations, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(durations, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(durations, 0.99) * 1000, 2),
+            'queries': max(self.queries) if self.queries else 0,
+        }
+
+
+class FunnelBenchmark:
+    """Walks the checkout funnel ``iterations`` times and times every step"""
+
+    def __init__(self, iterations=50, warmup=5, seed=0):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.rng = random.Random(seed)
+        self.stats = {step: StepStats() for step in STEPS}
+
+    def prepare(self):
+        user = User.objects.filter(username=BENCHMARK_USERNAME).first()
+        if user is None:
+            user = User.objects.create_user(
+                username=BENCHMARK_USERNAME,
+                email='benchmark@example.com',
+                phone_number='0700000000',
+                password=BENCHMARK_USERNAME
+            )
+        self.client = Client(raise_request_exception=False)
+        self.client.force_login(user)
+        self.user = user
+
+        if not PickupStation.objects.filter(is_active=True).exists():
+            raise RuntimeError('No active pickup station; run seed_data first')
+
+        self.category_slugs = list(
+            Category.objects.filter(parent=None, is_active=True).values_list('slug', flat=True)
+        )
+        products = list(
+            Product.objects.filter(is_active=True, stock__gte=50).order_by('id').values_list('id', 'slug', 'name')[:500]
+        )
+        if not products or not self.category_slugs:
+            raise RuntimeError('The catalog is empty; run seed_data first')
+        self.products = products
+        self.search_terms = sorted({word for _, _, name in products for word in name.split() if len(word) > 3})
+
+    def timed(self, step, method, path, record=True, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(self.client, method)(path, **kwargs)
+            elapsed = time.perf_counter() - started
+        if record:
+            self.stats[step].record(elapsed, len(queries), response.status_code < 400)
+        return response
+
+    def walk(self, record=True):
+        product_id, product_slug, _ = self.rng.choice(self.products)
+
+        self.timed('home', 'get', reverse('home'), record)
+        self.timed('category_products', 'get',
+                   reverse('category_products', args=[self.rng.choice(self.category_slugs)]), record)
+        self.timed('search', 'get', reverse('search'), record, data={'q': self.rng.choice(self.search_terms)})
+        self.timed('product_detail', 'get', reverse('product_detail', args=[product_slug]), record)
+        self.timed('add_to_cart', 'post', reverse('add_to_cart', args=[product_id]), record, data={'quantity': 1})
+        self.timed('cart', 'get', reverse('cart'), record)
+        self.timed('checkout', 'get', reverse('checkout'), record)
+        self.timed('place_order', 'post', reverse('place_order'), record, data={'payment_method': 'mpesa'})
+
+        order = Order.objects.filter(user=self.user).order_by('-id').first()
+        payment = order and Payment.objects.filter(order=order).first()
+        if payment is None:
+            return
+
+        response = self.timed('initiate_mpesa_payment', 'post',
+                              reverse('initiate_mpesa_payment', args=[payment.id]), record,
+                              data={'phone_number': BENCHMARK_PHONE})
+        if response.status_code != 200:
+            return
+
+        payment.refresh_from_db()
+        checkout_request_id = response.json().get('checkout_request_id')
+        merchant_request_id = (payment.response_data or {}).get('MerchantRequestID', '')
+        self.timed('mpesa_callback', 'post', reverse('mpesa_callback'), record,
+                   data=json.dumps(callback_payload(
+                       checkout_request_id, merchant_request_id, int(payment.amount), '254712345678'
+                   )),
+                   content_type='application/json')
+        # The callback is only queued; apply it as the worker would
+        drain()
+
+    def run(self, stdout=None):
+        self.prepare()
+        with DarajaStub() as daraja, override_settings(**daraja.settings()):
+            for _ in range(self.warmup):
+                self.walk(record=False)
+
+            started = time.perf_counter()
+            for n in range(self.iterations):
+                self.walk()
+                if stdout and (n + 1) % 10 == 0:
+                    stdout.write(f'  {n + 1}/{self.iterations} iterations')
+            elapsed = time.perf_counter() - started
+
+        steps = {step: stats.summary() for step, stats in self.stats.items()}
+        return {
+            'products': Product.objects.count(),
+            'iterations': self.iterations,
+            'funnels_per_second': round(self.iterations / elapsed, 2) if elapsed else 0.0,
+            'steps': steps,
+        }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Regressions of ``results`` against ``baseline``, as readable strings"""
+    regressions = []
+    for step, current in results['steps'].items():
+        previous = baseline.get('steps', {}).get(step)
+        if not previous or not current['requests']:
+            continue
+        if current['queries'] > previous['queries']:
+            regressions.append(f"{step}: queries {previous['queries']} -> {current['queries']}")
+        for metric in ('p95_ms', 'p99_ms'):
+            if previous[metric] and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f'{step}: {metric} {previous[metric]} -> {current[metric]}')
+        if previous['rps'] and current['rps'] < previous['rps'] * (1 - tolerance):
+            regressions.append(f"{step}: rps {previous['rps']} -> {current['rps']}")
+        if current['errors'] > previous.get('errors', 0):
+            regressions.append(f"{step}: errors {previous.get('errors', 0)} -> {current['errors']}")
+    return regressions
@@ -0,0 +1,67 @@
+"""
+Cached cart summary for the site header.
+
+The header shows the cart badge on every page, so the item count and subtotal
+are kept in the cache per user (or per session for anonymous carts). Every
+view that changes cart contents calls invalidate_cart_summary().
+"""
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Sum
+
+from .models import CartItem
+
+
+CART_SUMMARY_TTL = getattr(settings, 'CART_SUMMARY_TTL', 60 * 60)
+
+
+def cart_summary_key(request):
+    """Cache key for the request's cart, or None when there can be no cart"""
+    if request.user.is_authenticated:
+        return f'cart_summary:user:{request.user.pk}'
+
+    session_key = request.session.session_key
+    if session_key:
+        return f'cart_summary:session:{session_key}'
+
+    return None
+
+
+def build_cart_summary(request):
+    if request.user.is_authenticated:
+        items = CartItem.objects.filter(cart__user=request.user)
+    else:
+        items = CartItem.objects.filter(cart__session_key=request.session.session_key)
+
+    totals = items.aggregate(
+        item_count=Sum('quantity'),
+        subtotal=Sum(F('price') * F('quantity')),
+    )
+    return {
+        'item_count': totals['item_count'] or 0,
+        'subtotal': totals['subtotal'] or Decimal('0.00'),
+    }
+
+
+def get_cart_summary(request):
+    """Return {'item_count', 'subtotal'} for the request's cart"""
+    key = cart_summary_key(request)
+    if key is None:
+        return {'item_count': 0, 'subtotal': Decimal('0.00')}
+
+    summary = cache.get(key)
+    if summary is None:
+        summary = build_cart_summary(request)
+        cache.set(key, summary, timeout=CART_SUMMARY_TTL)
+    return summary
+
+
+def invalidate_cart_summary(request):
+    """Drop the cached summary once the current transaction commits"""
+    key = cart_summary_key(request)
+    if key is not None:
+        transaction.on_commit(lambda: cache.delete(key))
@@ -0,0 +1,119 @@
+"""
+Process-wide category tree.
+
+Listings, breadcrumbs, the header menu and the home rails all need the
+category hierarchy. All categories are loaded once into an immutable
+CategoryTree with slug and id lookups, children lists, ancestor paths and
+descendant id sets for every category, so resolving a listing or a
+breadcrumb takes no queries at any depth.
+
+The tree is a versioned snapshot (see snapshots.py): Category signals bump
+its version (see signals.py) and CATEGORY_TREE_TTL bounds staleness for
+changes that bypass signals. Category instances handed out by the tree are
+shared between requests and must be treated as read-only.
+"""
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.http import Http404
+
+from .models import Category
+from .snapshots import VersionedSnapshot
+
+
+CATEGORY_TREE_TTL = getattr(settings, 'CATEGORY_TREE_TTL', 10 * 60)
+
+VERSION_KEY = 'category_tree:version'
+
+
+class CategoryTree:
+    """Immutable snapshot of every category and how they nest"""
+
+    def __init__(self, categories):
+        self.by_id = {category.id: category for category in categories}
+        self.by_slug = {category.slug: category for category in categories}
+
+        children = defaultdict(list)
+        roots = []
+        for category in categories:
+            parent = self.by_id.get(category.parent_id)
+            # Link parents so category.parent never queries
+            category.parent = parent
+            if parent is None:
+                roots.append(category)
+            else:
+                children[parent.id].append(category)
+        self._children = {category_id: tuple(kids) for category_id, kids in children.items()}
+        self.roots = tuple(roots)
+
+        self._ancestors = {}
+        for category in categories:
+            path = []
+            seen = set()
+            node = category
+            while node is not None and node.id not in seen:
+                seen.add(node.id)
+                path.append(node)
+                node = node.parent
+            self._ancestors[category.id] = tuple(reversed(path))
+
+        # A category is listed when it and all of its ancestors are active
+        self.listed_ids = frozenset(
+            category_id for category_id, path in self._ancestors.items()
+            if all(node.is_active for node in path)
+        )
+
+        self._descendants = {}
+        for category in categories:
+            ids = set()
+            stack = [category.id]
+            while stack:
+                category_id = stack.pop()
+                if category_id in ids:
+                    continue
+                ids.add(category_id)
+                stack.extend(child.id for child in self._children.get(category_id, ()))
+            self._descendants[category.id] = frozenset(ids)
+
+    def get(self, slug):
+        """The active category with ``slug``, or None"""
+        category = self.by_slug.get(slug)
+        return category if category is not None and category.is_active else None
+
+    def children(self, category_id, active=True):
+        """Direct children of a category, in menu order"""
+        children = self._children.get(category_id, ())
+        return [child for child in children if child.is_active] if active else list(children)
+
+    def top_level(self, active=True):
+        return [category for category in self.roots if category.is_active] if active else list(self.roots)
+
+    def ancestors(self, category_id):
+        """The path from the top-level category down to ``category_id`` (inclusive)"""
+        return list(self._ancestors.get(category_id, ()))
+
+    def descendant_ids(self, category_id, active=True):
+        """Ids of ``category_id`` and every category below it, at any depth"""
+        ids = self._descendants.get(category_id, frozenset())
+        return ids & self.listed_ids if active else ids
+
+
+_snapshot = VersionedSnapshot(VERSION_KEY, lambda: CategoryTree(list(Category.objects.all())), CATEGORY_TREE_TTL)
+
+
+def get_category_tree():
+    """The process-wide CategoryTree, reloaded when its version changes"""
+    return _snapshot.get()
+
+
+def get_category_or_404(slug):
+    """get_object_or_404(Category, slug=slug, is_active=True), answered from the tree"""
+    category = get_category_tree().get(slug)
+    if category is None:
+        raise Http404('No Category matches the given query.')
+    return category
+
+
+def invalidate_category_tree():
+    _snapshot.invalidate()
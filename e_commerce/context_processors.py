@@ -1,24 +1,23 @@
-from e_commerce.models import Category, Cart
+from django.utils.functional import SimpleLazyObject
+
+from e_commerce.cart_summary import get_cart_summary
+from e_commerce.category_tree import get_category_tree
+
+
+def get_top_categories():
+    """Active top-level categories, from the process-wide category tree"""
+    return get_category_tree().top_level()
+
 
 def site_context(request):
-    # Get all parent categories
-    categories = Category.objects.filter(parent=None, is_active=True)
-    
-    # Get cart item count
-    cart_item_count = 0
-    if request.user.is_authenticated:
-        cart = Cart.objects.filter(user=request.user).first()
-        if cart:
-            cart_item_count = cart.total_items
-    else:
-        # For anonymous users, use session
-        session_key = request.session.session_key
-        if session_key:
-            cart = Cart.objects.filter(session_key=session_key).first()
-            if cart:
-                cart_item_count = cart.total_items
-    
+    # Parent categories are only loaded if the template renders them
+    categories = SimpleLazyObject(get_top_categories)
+
+    # Cart badge comes from the cached cart summary
+    cart_summary = get_cart_summary(request)
+
     return {
         'categories': categories,
-        'cart_item_count': cart_item_count,
-    }
\ No newline at end of file
+        'cart_item_count': cart_summary['item_count'],
+        'cart_subtotal': cart_summary['subtotal'],
+    }
@@ -0,0 +1,95 @@
+"""
+Delivery fees and delivery estimates.
+
+Delivery zones and pickup stations are small tables that rarely change, so
+each process keeps all active rows in memory, indexed by (region, city) and
+by station id. The table is a versioned snapshot (see snapshots.py): zone and
+station signals bump its version (see signals.py) and DELIVERY_TABLE_TTL
+bounds staleness for changes that bypass signals.
+
+checkout, update_delivery_method, place_order and order_detail all price and
+estimate delivery through quote() so the fee shown is the fee charged.
+"""
+
+from collections import namedtuple
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+
+from .models import DeliveryZone, PickupStation
+from .snapshots import VersionedSnapshot
+
+
+DELIVERY_TABLE_TTL = getattr(settings, 'DELIVERY_TABLE_TTL', 10 * 60)
+
+VERSION_KEY = 'delivery:version'
+
+# Used when an address is outside every zone, or no station is available
+DEFAULT_HOME_DELIVERY_FEE = Decimal('300.00')
+DEFAULT_PICKUP_FEE = Decimal('150.00')
+PICKUP_ESTIMATED_DAYS = 5
+
+DeliveryQuote = namedtuple('DeliveryQuote', 'fee estimated_days zone station')
+
+
+class DeliveryTable:
+    """All active delivery zones and pickup stations, indexed for lookups"""
+
+    def __init__(self):
+        self.zones = list(DeliveryZone.objects.filter(is_active=True).order_by('region', 'city'))
+        self.stations = list(PickupStation.objects.filter(is_active=True).order_by('city', 'name'))
+        self.zones_by_location = {(zone.region, zone.city): zone for zone in self.zones}
+        self.stations_by_id = {station.id: station for station in self.stations}
+        self.default_station = min(self.stations, key=lambda station: station.id, default=None)
+
+    def zone(self, region, city):
+        return self.zones_by_location.get((region, city))
+
+    def station(self, station_id):
+        try:
+            return self.stations_by_id.get(int(station_id))
+        except (TypeError, ValueError):
+            return None
+
+    def quote(self, delivery_method, address=None, station_id=None):
+        """
+        Fee and estimate for delivering to ``address`` (home delivery) or to
+        pickup station ``station_id``; without a station, the default one.
+        ``station`` is None when the requested station is not active.
+        """
+        if delivery_method == 'home_delivery':
+            zone = self.zone(address.region, address.city) if address else None
+            if zone is None:
+                return DeliveryQuote(DEFAULT_HOME_DELIVERY_FEE, None, None, None)
+            return DeliveryQuote(zone.delivery_fee, zone.estimated_days, zone, None)
+
+        station = self.station(station_id) if station_id else self.default_station
+        fee = station.delivery_fee if station else DEFAULT_PICKUP_FEE
+        return DeliveryQuote(fee, PICKUP_ESTIMATED_DAYS, None, station)
+
+    def estimated_delivery(self, order):
+        """Estimated delivery date of an order, or None when it cannot be told"""
+        if order.delivery_method == 'pickup_station' and order.pickup_station_id:
+            days = PICKUP_ESTIMATED_DAYS
+        elif order.delivery_address_id:
+            days = self.quote('home_delivery', order.delivery_address).estimated_days
+        else:
+            days = None
+        return order.created_at + timedelta(days=days) if days is not None else None
+
+
+_snapshot = VersionedSnapshot(VERSION_KEY, DeliveryTable, DELIVERY_TABLE_TTL)
+
+
+def get_delivery_table():
+    """The process-wide DeliveryTable, reloaded when its version changes"""
+    return _snapshot.get()
+
+
+def quote(delivery_method, address=None, station_id=None):
+    return get_delivery_table().quote(delivery_method, address, station_id)
+
+
+def invalidate_delivery_table():
+    _snapshot.invalidate()
@@ -0,0 +1,350 @@
+"""
+Facet counts for category listings.
+
+For each listing category (the category and all of its active descendants,
+grouped by its direct subcategories) a facet index is built once: the in-stock
+products sorted by price, with the set of products of each brand,
+subcategory, minimum rating and specification value. Because rows are sorted
+by price, a price filter is a contiguous bit range. Answering a request is
+then a handful of AND / popcount operations, whatever the filters are.
+
+A set holding a large share of the products is a bitmap (a Python int, bit
+i = i-th product). Most brands, subcategories and specification values hold
+only a few, and a bitmap would cost one bit per product of the whole
+category for each of them, so those are sorted arrays of positions instead.
+
+Indexes live in process memory, keyed by versions stored in the shared cache
+(see snapshots.py), up to FACET_INDEX_CACHE_BYTES in total. Product,
+specification, brand and category signals bump those versions (see
+signals.py), and FACET_INDEX_TTL bounds staleness for changes that bypass
+signals.
+"""
+
+import heapq
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from decimal import ROUND_CEILING, ROUND_FLOOR, Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Count
+
+from .category_tree import get_category_tree
+from .models import Brand, Product, ProductSpecification
+from .snapshots import bump_version, current_versions
+
+
+FACET_INDEX_TTL = getattr(settings, 'FACET_INDEX_TTL', 10 * 60)
+FACET_INDEX_CACHE_BYTES = getattr(settings, 'FACET_INDEX_CACHE_BYTES', 64 * 1024 * 1024)
+
+GLOBAL_VERSION_KEY = 'facets:version'
+
+# Same limits the listing page has always used for specification filters
+SPEC_MIN_PRODUCTS = 5
+SPEC_NAMES_LIMIT = 10
+SPEC_VALUES_LIMIT = 20
+
+RATINGS = (1, 2, 3, 4, 5)
+
+# Sets with fewer products than this share of the category are stored as
+# arrays of 4-byte positions, which is smaller than a bitmap below 1/32
+SPARSE_SHARE = 1 / 32
+
+
+def category_version_key(category_id):
+    return f'facets:version:{category_id}'
+
+
+def to_cents(price, rounding=ROUND_FLOOR):
+    return int((Decimal(price) * 100).to_integral_value(rounding=rounding))
+
+
+def bitmap(positions, size):
+    """Build an int with the given bit positions set"""
+    bits = bytearray((size + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def bit_range(start, stop):
+    """Bits start..stop-1 set"""
+    if stop <= start:
+        return 0
+    return ((1 << stop) - 1) ^ ((1 << start) - 1)
+
+
+def product_set(positions, size):
+    """Store sorted ``positions`` as an array if sparse, else as a bitmap"""
+    if len(positions) < size * SPARSE_SHARE:
+        return array('I', positions)
+    return bitmap(positions, size)
+
+
+def as_bitmap(products, size):
+    if isinstance(products, int):
+        return products
+    return bitmap(products, size)
+
+
+def union(sets, size):
+    result = 0
+    for products in sets:
+        result |= as_bitmap(products, size)
+    return result
+
+
+class Mask:
+    """A bitmap that stored sets are counted against"""
+
+    def __init__(self, bits, size, everything=False):
+        self.bits = bits
+        self.bytes = bits.to_bytes((size + 7) // 8, 'little')
+        self.everything = everything
+
+    def count(self, products):
+        """How many of ``products`` (a stored set) are in the mask"""
+        if isinstance(products, int):
+            return (products & self.bits).bit_count()
+        if self.everything:
+            return len(products)
+        mask = self.bytes
+        return sum(mask[position >> 3] >> (position & 7) & 1 for position in products)
+
+
+class FacetIndex:
+    """Bitmap facet index over the in-stock products of one category tree"""
+
+    def __init__(self, category):
+        tree = get_category_tree()
+        subcategories = tree.children(category.id)
+        self.subcategories = [
+            {'id': sub.id, 'name': sub.name, 'slug': sub.slug} for sub in subcategories
+        ]
+        category_ids = tree.descendant_ids(category.id)
+
+        rows = list(
+            Product.objects.filter(
+                category_id__in=category_ids,
+                is_active=True,
+                stock__gt=0
+            ).order_by('price', 'id').values_list(
+                'id', 'price', 'brand_id', 'category_id', 'rating_avg'
+            )
+        )
+        size = len(rows)
+        self.size = size
+        self.all = bit_range(0, size)
+        # Whole cents, 8 bytes each instead of a Decimal object per product
+        self.prices = array('q', (to_cents(row[1]) for row in rows))
+
+        by_brand = defaultdict(list)
+        by_category = defaultdict(list)
+        by_rating = defaultdict(list)
+        position_of = {}
+        for position, (product_id, _, brand_id, category_id, rating_avg) in enumerate(rows):
+            position_of[product_id] = position
+            if brand_id:
+                by_brand[brand_id].append(position)
+            by_category[category_id].append(position)
+            for rating in RATINGS:
+                if rating_avg >= rating:
+                    by_rating[rating].append(position)
+
+        # Each category's set covers its own subtree
+        self.categories = {
+            category_id: product_set(list(heapq.merge(*(
+                by_category.get(descendant_id, ()) for descendant_id in tree.descendant_ids(category_id)
+            ))), size)
+            for category_id in category_ids
+        }
+        self.ratings = {
+            rating: product_set(by_rating[rating], size) for rating in RATINGS
+        }
+
+        brand_names = dict(
+            Brand.objects.filter(id__in=by_brand.keys(), is_active=True).values_list('id', 'name')
+        )
+        self.brands = {
+            brand_id: (brand_names[brand_id], product_set(positions, size))
+            for brand_id, positions in by_brand.items()
+            if brand_id in brand_names
+        }
+
+        # Specification names shared by enough products, and their values
+        specifications = ProductSpecification.objects.filter(
+            product__category_id__in=category_ids,
+            product__is_active=True,
+            product__stock__gt=0
+        )
+        spec_names = list(
+            specifications.order_by().values('name').annotate(
+                count=Count('id')
+            ).filter(count__gte=SPEC_MIN_PRODUCTS).order_by('name').values_list('name', flat=True)[:SPEC_NAMES_LIMIT]
+        )
+        by_spec = defaultdict(lambda: defaultdict(set))
+        for product_id, name, value in specifications.filter(
+            name__in=spec_names
+        ).order_by().values_list('product_id', 'name', 'value'):
+            # Products that came into stock since the product query are skipped
+            position = position_of.get(product_id)
+            if position is not None:
+                by_spec[name][value].add(position)
+
+        self.specs = OrderedDict()
+        for name in spec_names:
+            values = sorted(by_spec[name].items())[:SPEC_VALUES_LIMIT]
+            if values:
+                self.specs[name] = [(value, product_set(sorted(positions), size)) for value, positions in values]
+
+        self.nbytes = sys.getsizeof(self.prices) + sum(
+            sys.getsizeof(products) for products in (
+                self.all,
+                *self.categories.values(),
+                *self.ratings.values(),
+                *(products for _, products in self.brands.values()),
+                *(products for values in self.specs.values() for _, products in values),
+            )
+        )
+
+    def price_bits(self, min_price=None, max_price=None):
+        start = bisect_left(self.prices, to_cents(min_price, ROUND_CEILING)) if min_price is not None else 0
+        stop = bisect_right(self.prices, to_cents(max_price)) if max_price is not None else self.size
+        return bit_range(start, stop)
+
+    def count(self, *sets):
+        bits = self.all
+        for products in sets:
+            bits &= as_bitmap(products, self.size)
+        return bits.bit_count()
+
+    def facets(self, min_price=None, max_price=None, brand_ids=(), subcategory_ids=(), rating=None):
+        """
+        Facet counts for the given filters.
+
+        Each facet ignores its own filter, so every option shows how many
+        products selecting it would add to the current result.
+        """
+        size = self.size
+        price = self.price_bits(min_price, max_price)
+        brand = union((self.brands[b][1] for b in brand_ids if b in self.brands), size) if brand_ids else self.all
+        subcategory = (
+            union((self.categories.get(c, 0) for c in subcategory_ids), size) if subcategory_ids else self.all
+        )
+        rated = as_bitmap(self.ratings[rating], size) if rating in self.ratings else self.all
+
+        matching = self.all & price & brand & subcategory & rated
+
+        without_price = self.all & brand & subcategory & rated
+        if without_price:
+            low = (without_price & -without_price).bit_length() - 1
+            high = without_price.bit_length() - 1
+            price_range = {
+                'min_price': Decimal(self.prices[low]).scaleb(-2),
+                'max_price': Decimal(self.prices[high]).scaleb(-2),
+            }
+        else:
+            price_range = {'min_price': None, 'max_price': None}
+
+        without_brand = self.all & price & subcategory & rated
+        without_brand = Mask(without_brand, size, everything=without_brand == self.all)
+        brands = [
+            {'id': brand_id, 'name': name, 'product_count': without_brand.count(products)}
+            for brand_id, (name, products) in self.brands.items()
+        ]
+        brands = sorted(
+            (brand for brand in brands if brand['product_count'] or brand['id'] in brand_ids),
+            key=lambda brand: brand['name']
+        )
+
+        without_subcategory = self.all & price & brand & rated
+        without_subcategory = Mask(without_subcategory, size, everything=without_subcategory == self.all)
+        subcategories = [
+            dict(sub, product_count=without_subcategory.count(self.categories.get(sub['id'], 0)))
+            for sub in self.subcategories
+        ]
+
+        within = Mask(matching, size, everything=matching == self.all)
+        spec_filters = OrderedDict()
+        for name, values in self.specs.items():
+            counted = [
+                {'value': value, 'count': within.count(products)} for value, products in values
+            ]
+            counted = [value for value in counted if value['count']]
+            if counted:
+                spec_filters[name] = counted
+
+        return {
+            'total': matching.bit_count(),
+            'price_range': price_range,
+            'brands': brands,
+            'subcategories': subcategories,
+            'spec_filters': spec_filters,
+        }
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_facet_index(category):
+    """Return the facet index for ``category``, building it when stale"""
+    version = current_versions([GLOBAL_VERSION_KEY, category_version_key(category.id)])
+    now = time.monotonic()
+
+    with _indexes_lock:
+        entry = _indexes.get(category.id)
+        if entry and entry[0] == version and now - entry[1] < FACET_INDEX_TTL:
+            _indexes.move_to_end(category.id)
+            return entry[2]
+
+    index = FacetIndex(category)
+
+    with _indexes_lock:
+        _indexes.pop(category.id, None)
+        # An index larger than the whole budget is used for this request only
+        if index.nbytes > FACET_INDEX_CACHE_BYTES:
+            return index
+        _indexes[category.id] = (version, now, index)
+        # Least recently used first; the index just built fits, so it stays
+        total = sum(entry[2].nbytes for entry in _indexes.values())
+        while total > FACET_INDEX_CACHE_BYTES:
+            total -= _indexes.popitem(last=False)[1][2].nbytes
+    return index
+
+
+def invalidate_category_facets(category_id):
+    """Mark the facet indexes of a category and its ancestors as stale"""
+    if not category_id:
+        return
+    # Category changes bump every index, so the tree's paths are current here
+    ancestor_ids = [ancestor.id for ancestor in get_category_tree().ancestors(category_id)] or [category_id]
+    for ancestor_id in ancestor_ids:
+        bump_version(category_version_key(ancestor_id))
+
+
+def invalidate_all_facets():
+    bump_version(GLOBAL_VERSION_KEY)
+
+
+def parse_price(value):
+    if not value:
+        return None
+    try:
+        price = Decimal(value)
+    except (InvalidOperation, ValueError):
+        return None
+    return price if price.is_finite() else None
+
+
+def parse_ids(values):
+    ids = []
+    for value in values:
+        try:
+            ids.append(int(value))
+        except (TypeError, ValueError):
+            pass
+    return ids
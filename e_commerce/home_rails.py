@@ -0,0 +1,129 @@
+"""
+Precomputed home page rails.
+
+The home page shows the same banners, categories and product rails to every
+visitor, so the whole set is built once and stored as a single versioned
+cache entry. Product rails are read from the materialized rankings (see
+rankings.py). Model signals bump the version (see signals.py) and the entry
+also expires after HOME_RAILS_TTL seconds, so a warm home page costs cache
+reads only.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+
+from .category_tree import get_category_tree
+from .models import Banner, Brand, Product, Vendor
+from .rankings import Rail, ranked_products
+
+
+HOME_RAILS_KEY = 'home_rails'
+HOME_RAILS_VERSION_KEY = 'home_rails:version'
+HOME_RAILS_TTL = getattr(settings, 'HOME_RAILS_TTL', 300)
+
+RAIL_SIZE = 12
+
+# (context name for the category, context name for its products, category slug)
+CATEGORY_RAILS = (
+    ('electronics', 'electronics_products', 'electronics'),
+    ('fashion', 'fashion_products', 'fashion'),
+    ('home_kitchen', 'home_kitchen_products', 'home-kitchen'),
+    ('phones_tablets', 'phones_products', 'phones-tablets'),
+)
+
+
+def _product_rail(queryset, limit=RAIL_SIZE):
+    """Evaluate a product rail with everything the product card needs"""
+    return list(queryset.prefetch_related('images')[:limit])
+
+
+def build_home_rails():
+    """Run the home page queries and return the rails as plain lists"""
+    in_stock = Product.objects.filter(is_active=True, stock__gt=0)
+
+    # Banners are stored with their schedule and filtered on read
+    banners = list(Banner.objects.filter(is_active=True))
+
+    tree = get_category_tree()
+    main_categories = tree.top_level()[:12]
+
+    rails = {
+        'banners': banners,
+        'main_categories': main_categories,
+        'top_deals': _product_rail(
+            in_stock.filter(is_featured=True).order_by('-total_sales', '-views'),
+            limit=20
+        ),
+    }
+
+    # The ranked rails come from the materialized rankings in one batch
+    new_since = (timezone.now() - timedelta(days=30)).timestamp()
+    ranked = {
+        'flash_sales': Rail('all', [0], 'discount', RAIL_SIZE),
+        'best_sellers': Rail('all', [0], 'sales', RAIL_SIZE),
+        'new_arrivals': Rail('all', [0], 'newest', RAIL_SIZE, min_score=new_since),
+    }
+    for category_name, products_name, slug in CATEGORY_RAILS:
+        category = tree.get(slug)
+        rails[category_name] = category
+        rails[products_name] = []
+        if category:
+            ranked[products_name] = Rail('category', [category.id], 'sales', RAIL_SIZE)
+    rails.update(zip(ranked, ranked_products(*ranked.values())))
+
+    rails['top_brands'] = list(
+        Brand.objects.filter(
+            is_active=True,
+            products__is_active=True
+        ).annotate(
+            product_count=Count('products')
+        ).filter(
+            product_count__gt=0
+        ).order_by('-product_count')[:12]
+    )
+
+    rails['top_vendors'] = list(
+        Vendor.objects.filter(is_active=True, is_verified=True).order_by('-rating')[:8]
+    )
+
+    return rails
+
+
+def get_home_rails_version():
+    version = cache.get(HOME_RAILS_VERSION_KEY)
+    if version is None:
+        cache.add(HOME_RAILS_VERSION_KEY, 1, timeout=None)
+        version = cache.get(HOME_RAILS_VERSION_KEY, 1)
+    return version
+
+
+def invalidate_home_rails():
+    """Move the rails to a new version so the next request rebuilds them"""
+    try:
+        cache.incr(HOME_RAILS_VERSION_KEY)
+    except ValueError:
+        cache.set(HOME_RAILS_VERSION_KEY, 1, timeout=None)
+        cache.delete(HOME_RAILS_KEY, version=1)
+
+
+def get_home_rails():
+    """Return the cached home rails, rebuilding them when missing or stale"""
+    version = get_home_rails_version()
+    rails = cache.get(HOME_RAILS_KEY, version=version)
+
+    if rails is None:
+        rails = build_home_rails()
+        cache.set(HOME_RAILS_KEY, rails, timeout=HOME_RAILS_TTL, version=version)
+
+    now = timezone.now()
+    context = dict(rails)
+    context['banners'] = [
+        banner for banner in rails['banners']
+        if (banner.start_date is None or banner.start_date <= now)
+        and (banner.end_date is None or banner.end_date >= now)
+    ][:5]
+    return context
@@ -0,0 +1,188 @@
+"""
+Stock reservation for orders.
+
+reserve_stock() turns cart lines into order items and takes the stock for
+them; restore_stock() gives it back when an order is cancelled. Both must run
+inside a transaction. Rows are locked in one global order (products, then
+variants, each by id) so concurrent checkouts sharing items cannot deadlock,
+and every decrement is a conditional ``UPDATE ... WHERE stock >= qty`` so stock
+never goes negative even where row locks are unavailable.
+"""
+
+from collections import Counter, defaultdict, namedtuple
+
+from django.db import transaction
+from django.db.models import F
+
+from .facets import invalidate_category_facets
+from .models import OrderItem, Product, ProductVariant
+from .rankings import update_rankings
+
+
+Shortfall = namedtuple('Shortfall', 'product_id variant_id name requested available')
+
+
+class InsufficientStock(Exception):
+    """Raised with one Shortfall per cart line that cannot be filled"""
+
+    def __init__(self, shortfalls):
+        self.shortfalls = shortfalls
+        super().__init__('; '.join(
+            f'Insufficient stock for {shortfall.name}. Only {shortfall.available} available.'
+            for shortfall in shortfalls
+        ))
+
+
+def _lock_stock(model, ids, *fields):
+    """Lock rows of ``model`` in id order and return {id: (stock, *fields)}"""
+    rows = model.objects.select_for_update().filter(pk__in=ids).order_by('pk').values_list(
+        'pk', 'stock', *fields
+    )
+    return {row[0]: row[1:] for row in rows}
+
+
+def _by_quantity(demand):
+    """{id: quantity} -> {quantity: [ids]}, so each quantity is one UPDATE"""
+    grouped = defaultdict(list)
+    for pk, quantity in demand.items():
+        grouped[quantity].append(pk)
+    return grouped.items()
+
+
+def _take(model, demand, *counters):
+    """
+    Take ``demand`` ({id: quantity}) from ``model`` stock with conditional
+    UPDATEs, adding the quantity to any ``counters`` fields as well. Returns
+    the ids whose stock ran short.
+    """
+    short = []
+    for quantity, ids in _by_quantity(demand):
+        updates = {field: F(field) + quantity for field in counters}
+        updated = model.objects.filter(pk__in=ids, stock__gte=quantity).update(
+            stock=F('stock') - quantity, **updates
+        )
+        if updated != len(ids):
+            short.extend(model.objects.filter(pk__in=ids, stock__lt=quantity).values_list('pk', flat=True))
+    return short
+
+
+def _give_back(model, demand, *counters):
+    """Return ``demand`` to ``model`` stock, taking it off any ``counters``"""
+    for quantity, ids in _by_quantity(demand):
+        updates = {field: F(field) - quantity for field in counters}
+        model.objects.filter(pk__in=ids).update(stock=F('stock') + quantity, **updates)
+
+
+def reserve_stock(order, cart_items):
+    """
+    Take stock for ``cart_items`` and create the order's items.
+
+    Raises InsufficientStock listing every line that cannot be filled; the
+    caller's transaction then rolls back any stock already taken.
+    """
+    cart_items = list(cart_items)
+    product_demand = Counter()
+    variant_demand = Counter()
+    for item in cart_items:
+        product_demand[item.product_id] += item.quantity
+        if item.variant_id:
+            variant_demand[item.variant_id] += item.quantity
+
+    # Lock order: all products, then all variants, each by ascending id
+    product_stock = _lock_stock(Product, product_demand, 'category_id')
+    variant_stock = _lock_stock(ProductVariant, variant_demand)
+
+    shortfalls = []
+    for item in cart_items:
+        available = product_stock.get(item.product_id, (0,))[0]
+        short = product_demand[item.product_id] > available
+        if item.variant_id:
+            variant_available = variant_stock.get(item.variant_id, (0,))[0]
+            short = short or variant_demand[item.variant_id] > variant_available
+            available = min(available, variant_available)
+        if short:
+            shortfalls.append(Shortfall(
+                item.product_id, item.variant_id, item.product.name, item.quantity, max(available, 0)
+            ))
+    if shortfalls:
+        raise InsufficientStock(shortfalls)
+
+    short_products = _take(Product, product_demand, 'total_sales')
+    short_variants = _take(ProductVariant, variant_demand)
+    if short_products or short_variants:
+        # Only reachable where the database ignores FOR UPDATE
+        raise InsufficientStock([
+            Shortfall(item.product_id, item.variant_id, item.product.name, item.quantity, 0)
+            for item in cart_items
+            if item.product_id in short_products or item.variant_id in short_variants
+        ])
+
+    sold_out = {pk for pk, (stock, category_id) in product_stock.items() if stock - product_demand[pk] <= 0}
+    _refresh_sold_out_facets(product_stock[pk][1] for pk in sold_out)
+    _refresh_rankings(product_demand, sold_out)
+
+    return OrderItem.objects.bulk_create([
+        OrderItem(
+            order=order,
+            product=item.product,
+            variant=item.variant,
+            vendor_id=item.product.vendor_id,
+            product_name=item.product.name,
+            product_sku=item.product.sku,
+            variant_name=item.variant.name if item.variant else '',
+            quantity=item.quantity,
+            price=item.price,
+            total=item.price * item.quantity
+        )
+        for item in cart_items
+    ])
+
+
+def restore_stock(order):
+    """Return the stock held by ``order``'s items"""
+    product_demand = Counter()
+    variant_demand = Counter()
+    for product_id, variant_id, quantity in order.items.values_list('product_id', 'variant_id', 'quantity'):
+        if product_id:
+            product_demand[product_id] += quantity
+        if variant_id:
+            variant_demand[variant_id] += quantity
+
+    product_stock = _lock_stock(Product, product_demand, 'category_id')
+    _lock_stock(ProductVariant, variant_demand)
+
+    _give_back(Product, product_demand, 'total_sales')
+    _give_back(ProductVariant, variant_demand)
+
+    restocked = {pk for pk, (stock, category_id) in product_stock.items() if stock <= 0}
+    _refresh_sold_out_facets(product_stock[pk][1] for pk in restocked)
+    _refresh_rankings(product_demand, restocked)
+
+
+def _refresh_sold_out_facets(category_ids):
+    """Listings only show in-stock products, so crossing zero changes facets"""
+    category_ids = set(category_ids)
+    if not category_ids:
+        return
+
+    def invalidate():
+        for category_id in category_ids:
+            invalidate_category_facets(category_id)
+
+    transaction.on_commit(invalidate)
+
+
+def _refresh_rankings(product_ids, crossed_zero):
+    """
+    total_sales changed for ``product_ids``; products whose stock crossed zero
+    also enter or leave the rankings of every other metric
+    """
+    product_ids = set(product_ids)
+    crossed_zero = set(crossed_zero)
+
+    def update():
+        update_rankings(product_ids - crossed_zero, metrics=('sales',))
+        update_rankings(crossed_zero)
+
+    # The order stands even if the rankings cannot be updated
+    transaction.on_commit(update, robust=True)
@@ -0,0 +1,25 @@
+"""
+Copy STK push CheckoutRequestID/MerchantRequestID out of Payment.response_data
+into their indexed columns.
+
+Usage: python manage.py backfill_payment_request_ids [--batch-size 1000]
+"""
+
+from django.core.management.base import BaseCommand
+
+from e_commerce.mpesa import backfill_payment_request_ids
+
+
+class Command(BaseCommand):
+    help = 'Backfills Payment.checkout_request_id and merchant_request_id from stored Daraja payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Payments written per bulk update'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Backfilling M-Pesa request ids...')
+        updated = backfill_payment_request_ids(batch_size=options['batch_size'], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f'✅ Backfilled {updated} payments'))
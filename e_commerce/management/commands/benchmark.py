@@ -0,0 +1,76 @@
+"""
+Benchmark the checkout funnel against the current database.
+
+Usage: python manage.py seed_data --scale 100000
+       python manage.py benchmark --iterations 200 --save-baseline bench/baseline.json
+       python manage.py benchmark --iterations 200 --baseline bench/baseline.json --fail-on-regression
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from e_commerce.benchmark import FunnelBenchmark, compare
+
+
+class Command(BaseCommand):
+    help = 'Measures req/s, latency percentiles and query counts for every step of the checkout funnel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Funnels to walk')
+        parser.add_argument('--warmup', type=int, default=5, help='Untimed funnels walked first')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the products and pages visited')
+        parser.add_argument('--baseline', help='Baseline JSON to compare against')
+        parser.add_argument('--save-baseline', help='Write the results to this JSON file')
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.2,
+            help='Allowed slowdown before a step counts as a regression (0.2 = 20%%)'
+        )
+        parser.add_argument(
+            '--fail-on-regression',
+            action='store_true',
+            help='Exit with an error when any step regressed against the baseline'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Walking the checkout funnel {options['iterations']} times...")
+
+        try:
+            results = FunnelBenchmark(
+                iterations=options['iterations'],
+                warmup=options['warmup'],
+                seed=options['seed']
+            ).run(stdout=self.stdout)
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            f"\n{results['products']} products, {results['funnels_per_second']} funnels/s\n"
+        )
+        self.stdout.write(
+            f"{'step':<24}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}{'errors':>8}"
+        )
+        for step, stats in results['steps'].items():
+            self.stdout.write(
+                f"{step:<24}{stats['rps']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+                f"{stats['p99_ms']:>10}{stats['queries']:>9}{stats['errors']:>8}"
+            )
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"✅ Baseline saved to {options['save_baseline']}"))
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline, tolerance=options['tolerance'])
+            if regressions:
+                for regression in regressions:
+                    self.stdout.write(self.style.ERROR(f'REGRESSION {regression}'))
+                if options['fail_on_regression']:
+                    raise CommandError(f'{len(regressions)} regression(s) against {options["baseline"]}')
+            else:
+                self.stdout.write(self.style.SUCCESS('✅ No regressions against the baseline'))
@@ -0,0 +1,48 @@
+"""
+EXPLAIN every query of the hot views and fail if any of them reads a large
+table with a sequential scan.
+
+Usage: python manage.py check_query_plans [--min-rows 10000] [--verbose]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from e_commerce.query_plans import QueryPlanCheck
+
+
+class Command(BaseCommand):
+    help = 'Checks that the hot views\' queries use indexes on large tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-rows', type=int, default=10000,
+            help='Ignore sequential scans of tables smaller than this'
+        )
+        parser.add_argument(
+            '--verbose', action='store_true',
+            help='Print the full SQL of every offending query'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Explaining hot view queries...')
+        check = QueryPlanCheck(min_rows=options['min_rows'])
+        try:
+            findings = check.run()
+        except (RuntimeError, NotImplementedError) as e:
+            raise CommandError(str(e))
+
+        for name, statements in check.statements.items():
+            flagged = sum(1 for finding in findings if finding.view == name)
+            self.stdout.write(f'{name:<32} {len(statements):>4} queries  {flagged:>3} sequential scans')
+
+        if findings:
+            for finding in findings:
+                self.stdout.write(self.style.ERROR(
+                    f'{finding.view}: sequential scan of {finding.table} ({finding.rows} rows)'
+                ))
+                if options['verbose']:
+                    self.stdout.write(f'    {finding.sql}')
+            raise CommandError(f'{len(findings)} queries scan large tables sequentially')
+
+        total = sum(len(statements) for statements in check.statements.values())
+        self.stdout.write(self.style.SUCCESS(f'✅ {total} queries checked, no sequential scans of large tables'))
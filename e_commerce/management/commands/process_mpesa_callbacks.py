@@ -0,0 +1,49 @@
+"""
+Apply M-Pesa callbacks stored in the callback inbox to their payments and orders.
+
+Usage: python manage.py process_mpesa_callbacks [--workers 4] [--batch-size 200] [--interval 1]
+       python manage.py process_mpesa_callbacks --once
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from e_commerce.models import MpesaCallback
+from e_commerce.mpesa_callbacks import (
+    MPESA_CALLBACK_BATCH_SIZE, MPESA_CALLBACK_POLL_INTERVAL, drain, start_workers
+)
+
+
+class Command(BaseCommand):
+    help = 'Processes the M-Pesa callback inbox in batches with a pool of worker threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Worker threads draining the inbox')
+        parser.add_argument(
+            '--batch-size', type=int, default=MPESA_CALLBACK_BATCH_SIZE,
+            help='Callbacks claimed per transaction'
+        )
+        parser.add_argument(
+            '--interval', type=float, default=MPESA_CALLBACK_POLL_INTERVAL,
+            help='Seconds between polls of an empty inbox'
+        )
+        parser.add_argument('--once', action='store_true', help='Make a single pass over the inbox and exit')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            claimed = drain(options['batch_size'])
+            pending = MpesaCallback.objects.filter(status='pending').count()
+            self.stdout.write(self.style.SUCCESS(f'✅ Processed {claimed} callbacks, {pending} still pending'))
+            return
+
+        self.stdout.write(f"Processing M-Pesa callbacks with {options['workers']} worker(s)... (Ctrl+C to stop)")
+        stop, threads = start_workers(options['workers'], options['batch_size'], options['interval'])
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.stdout.write(self.style.SUCCESS('✅ Callback workers stopped'))
@@ -0,0 +1,31 @@
+"""
+Recompute the denormalized rating columns on Product from approved reviews.
+
+Usage: python manage.py rebuild_ratings [--product ID ...]
+"""
+
+from django.core.management.base import BaseCommand
+
+from e_commerce.ratings import rebuild_product_ratings
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds product rating averages, counts and star histograms'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--product', type=int, action='append', dest='product_ids',
+            help='Only rebuild this product id (repeatable)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Products written per bulk update'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding product ratings...')
+        updated = rebuild_product_ratings(
+            product_ids=options['product_ids'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'✅ Rebuilt ratings for {updated} reviewed products'))
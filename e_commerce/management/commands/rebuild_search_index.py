@@ -0,0 +1,30 @@
+"""
+Rebuild the full-text search vectors on Product (PostgreSQL only).
+
+Usage: python manage.py rebuild_search_index [--batch-size N]
+"""
+
+from django.core.management.base import BaseCommand
+
+from e_commerce.search import rebuild_search_index, search_enabled
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product full-text search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help='Products updated per UPDATE statement'
+        )
+
+    def handle(self, *args, **options):
+        if not search_enabled():
+            self.stdout.write(self.style.WARNING(
+                'Full-text search needs PostgreSQL; search falls back to icontains matching.'
+            ))
+            return
+
+        self.stdout.write('Rebuilding search index...')
+        updated = rebuild_search_index(batch_size=options['batch_size'], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f'✅ Indexed {updated} products'))
@@ -0,0 +1,69 @@
+"""
+Query Daraja for M-Pesa payments stuck in processing (lost callbacks) and
+apply the results.
+
+Usage: python manage.py reconcile_mpesa_payments [--older-than 300] [--workers 4] [--rate 10]
+       python manage.py reconcile_mpesa_payments --interval 60
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from e_commerce.reconciliation import (
+    MPESA_RECONCILE_AFTER, MPESA_RECONCILE_BATCH_SIZE, MPESA_RECONCILE_RATE,
+    MPESA_RECONCILE_WORKERS, Reconciler
+)
+
+
+class Command(BaseCommand):
+    help = 'Reconciles stale processing M-Pesa payments with the STK push query API'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=int, default=MPESA_RECONCILE_AFTER,
+            help='Only payments created at least this many seconds ago'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=MPESA_RECONCILE_BATCH_SIZE,
+            help='Payments queried and applied per batch'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=MPESA_RECONCILE_WORKERS,
+            help='Concurrent STK queries'
+        )
+        parser.add_argument(
+            '--rate', type=float, default=MPESA_RECONCILE_RATE,
+            help='Maximum STK queries per second'
+        )
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep sweeping every this many seconds (default: a single sweep)'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.stdout.write('Reconciling processing M-Pesa payments...')
+            try:
+                stats = Reconciler(
+                    older_than=options['older_than'],
+                    batch_size=options['batch_size'],
+                    workers=options['workers'],
+                    rate=options['rate'],
+                    stdout=self.stdout
+                ).run()
+            except RuntimeError as e:
+                if not options['interval']:
+                    raise CommandError(str(e))
+                self.stdout.write(self.style.ERROR(str(e)))
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    '✅ {queried} queried: {completed} completed, {failed} failed, '
+                    '{in_progress} still in progress, {errors} errors'.format(**stats)
+                ))
+                if stats['stk_query']:
+                    self.stdout.write(f"STK query latency: {stats['stk_query']}")
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
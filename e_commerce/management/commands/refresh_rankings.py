@@ -0,0 +1,43 @@
+"""
+Rebuild the materialized product rankings (top products per category, vendor
+and brand by sales, views, newest and discount). Orders do not update the
+category and catalog-wide rankings, so run this with an --interval below
+RANKING_MAX_AGE (or from cron as often); a ranking older than that is rebuilt
+by the request that reads it.
+
+Usage: python manage.py refresh_rankings [--size 48]
+       python manage.py refresh_rankings --interval 900
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from e_commerce.rankings import RANKING_SIZE, rebuild_rankings
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the top-products rankings used by the product rails'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size', type=int, default=RANKING_SIZE,
+            help='Products kept per ranking'
+        )
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep rebuilding every this many seconds (default: a single rebuild)'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.stdout.write('Rebuilding product rankings...')
+            started = time.monotonic()
+            count = rebuild_rankings(size=options['size'])
+            self.stdout.write(self.style.SUCCESS(
+                f'✅ Rebuilt {count} rankings in {time.monotonic() - started:.1f}s'
+            ))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -3,15 +3,18 @@ Django management command to seed database with real Kenyan e-commerce data
 File location: e_commerce/management/commands/seed_data.py
 
 Usage: python manage.py seed_data
+       python manage.py seed_data --scale 100000   # plus 100k generated products
+       python manage.py seed_data --scale 1000000 --workers 8 --seed 7
 """
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.hashers import make_password
 from django.utils import timezone
 from datetime import timedelta
 from decimal import Decimal
 import random
 
+from e_commerce.seeding import CatalogGenerator
 from e_commerce.models import (
     User, Address, PickupStation, Category, Brand, Vendor,
     Product, ProductImage, ProductVariant, ProductSpecification,
@@ -22,6 +25,32 @@ from e_commerce.models import (
 class Command(BaseCommand):
     help = 'Seeds the database with real Kenyan e-commerce data'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scale',
+            type=int,
+            default=0,
+            help='Grow the catalog to this many generated products (for load tests)'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=42,
+            help='Random seed for the generated catalog; the same seed gives the same data'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows per bulk insert chunk'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Processes generating chunks in parallel'
+        )
+
     def handle(self, *args, **kwargs):
         self.stdout.write('Starting data seeding...')
         
@@ -41,6 +70,19 @@ class Command(BaseCommand):
         self.seed_banners()
         self.seed_orders()
         
+        if kwargs.get('scale'):
+            self.stdout.write(f"Generating load-test catalog ({kwargs['scale']} products)...")
+            try:
+                CatalogGenerator(
+                    kwargs['scale'],
+                    seed=kwargs['seed'],
+                    batch_size=kwargs['batch_size'],
+                    workers=kwargs['workers'],
+                    stdout=self.stdout
+                ).run()
+            except RuntimeError as e:
+                raise CommandError(str(e))
+        
         self.stdout.write(self.style.SUCCESS('✅ Data seeding completed successfully!'))
 
     def clear_data(self):
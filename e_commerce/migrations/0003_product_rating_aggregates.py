@@ -0,0 +1,68 @@
+# Generated by Django 5.2.4 on 2026-10-17 20:49
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def backfill_ratings(apps, schema_editor):
+    Product = apps.get_model('e_commerce', 'Product')
+    Review = apps.get_model('e_commerce', 'Review')
+
+    stats = Review.objects.filter(is_approved=True).values('product_id').annotate(
+        total=Count('id'),
+        **{f'star_{star}': Count('id', filter=Q(rating=star)) for star in range(1, 6)}
+    )
+    for row in stats:
+        counts = {f'rating_{star}_count': row[f'star_{star}'] for star in range(1, 6)}
+        rating_sum = sum(star * row[f'star_{star}'] for star in range(1, 6))
+        Product.objects.filter(pk=row['product_id']).update(
+            rating_count=row['total'],
+            rating_avg=round(rating_sum / row['total'], 2),
+            **counts
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_commerce', '0002_pickupstation_delivery_fee'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_avg',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=3),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_ratings, migrations.RunPython.noop),
+    ]
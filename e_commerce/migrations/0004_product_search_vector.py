@@ -0,0 +1,43 @@
+# Generated by Django 5.2.4 on 2026-10-17 20:51
+
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+SEARCH_INDEXES = (
+    ('products_search_vector_gin', 'USING gin (search_vector)'),
+    ('products_name_trgm', 'USING gin (name gin_trgm_ops)'),
+)
+
+
+def create_search_indexes(apps, schema_editor):
+    # GIN indexes only exist on PostgreSQL
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, definition in SEARCH_INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON products {definition}')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _ in SEARCH_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_commerce', '0003_product_rating_aggregates'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
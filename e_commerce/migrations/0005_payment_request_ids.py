@@ -0,0 +1,53 @@
+# Generated by Django 5.2.4 on 2026-10-17 21:06
+
+from django.db import migrations, models
+
+
+def request_ids(data):
+    """
+    (CheckoutRequestID, MerchantRequestID) from a stored Daraja payload.
+
+    A frozen copy of e_commerce.mpesa.stk_request_ids: migrations must not
+    import app code that can change after they are written. A test checks
+    that both still agree.
+    """
+    if not isinstance(data, dict):
+        return '', ''
+    # Either the STK push response or the callback that replaced it
+    source = (data.get('Body') or {}).get('stkCallback') or data
+    return source.get('CheckoutRequestID') or '', source.get('MerchantRequestID') or ''
+
+
+def backfill_request_ids(apps, schema_editor):
+    Payment = apps.get_model('e_commerce', 'Payment')
+
+    changed = []
+    for payment in Payment.objects.filter(response_data__isnull=False).only('pk', 'response_data').iterator():
+        payment.checkout_request_id, payment.merchant_request_id = request_ids(payment.response_data)
+        if payment.checkout_request_id:
+            changed.append(payment)
+        if len(changed) >= 1000:
+            Payment.objects.bulk_update(changed, ['checkout_request_id', 'merchant_request_id'])
+            changed = []
+    Payment.objects.bulk_update(changed, ['checkout_request_id', 'merchant_request_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_commerce', '0004_product_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='merchant_request_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.RunPython(backfill_request_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-17 21:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_commerce', '0006_mpesa_callback_inbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductRanking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(choices=[('all', 'All Products'), ('category', 'Category'), ('vendor', 'Vendor'), ('brand', 'Brand')], max_length=20)),
+                ('scope_id', models.IntegerField(default=0)),
+                ('metric', models.CharField(choices=[('sales', 'Best Selling'), ('views', 'Most Viewed'), ('newest', 'Newest'), ('discount', 'Biggest Discount')], max_length=20)),
+                ('entries', models.JSONField(default=list)),
+                ('refreshed_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'product_rankings',
+                'unique_together': {('scope', 'scope_id', 'metric')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-17 22:27
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('e_commerce', '0008_hot_path_indexes'),
+    ]
+
+    # 0004 already creates both indexes, on PostgreSQL only (GIN does not
+    # exist elsewhere); this records them in the model state
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='product',
+                    index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='products_search_vector_gin'),
+                ),
+                migrations.AddIndex(
+                    model_name='product',
+                    index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass('name', name='gin_trgm_ops'), name='products_name_trgm'),
+                ),
+            ],
+        ),
+    ]
@@ -1,8 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVectorField
 from django.utils.text import slugify
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models import Avg
 import uuid
 
 
@@ -145,6 +146,12 @@ class Vendor(models.Model):
         return self.business_name
 
 
+class ProductManager(models.Manager):
+    def get_queryset(self):
+        # The search vector is only ever read inside SQL
+        return super().get_queryset().defer('search_vector')
+
+
 class Product(models.Model):
     """Main product model"""
     vendor = models.ForeignKey(Vendor, on_delete=models.CASCADE, related_name='products')
@@ -173,15 +180,77 @@ class Product(models.Model):
     views = models.IntegerField(default=0)
     total_sales = models.IntegerField(default=0)
     
+    # Approved review aggregates, maintained by e_commerce.ratings
+    rating_avg = models.DecimalField(max_digits=3, decimal_places=2, default=0)
+    rating_count = models.IntegerField(default=0)
+    rating_1_count = models.IntegerField(default=0)
+    rating_2_count = models.IntegerField(default=0)
+    rating_3_count = models.IntegerField(default=0)
+    rating_4_count = models.IntegerField(default=0)
+    rating_5_count = models.IntegerField(default=0)
+    
+    # Weighted full-text document, maintained by e_commerce.search
+    search_vector = SearchVectorField(null=True, editable=False)
+    
     meta_title = models.CharField(max_length=200, blank=True)
     meta_description = models.TextField(blank=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = ProductManager()
+    
     class Meta:
         db_table = 'products'
         ordering = ['-created_at']
+        # Listings, rails and rankings only read active, in-stock products,
+        # so most indexes are partial on that condition
+        indexes = [
+            models.Index(
+                fields=['category', '-total_sales', '-views', '-id'],
+                condition=models.Q(is_active=True, stock__gt=0),
+                name='products_listing_sales_idx'
+            ),
+            models.Index(
+                fields=['category', 'price', 'id'],
+                condition=models.Q(is_active=True, stock__gt=0),
+                name='products_listing_price_idx'
+            ),
+            models.Index(
+                fields=['category', '-created_at', '-id'],
+                condition=models.Q(is_active=True, stock__gt=0),
+                name='products_listing_newest_idx'
+            ),
+            models.Index(
+                fields=['vendor', '-total_sales'],
+                condition=models.Q(is_active=True, stock__gt=0),
+                name='products_vendor_sales_idx'
+            ),
+            models.Index(
+                fields=['brand', '-total_sales'],
+                condition=models.Q(is_active=True, stock__gt=0),
+                name='products_brand_sales_idx'
+            ),
+            models.Index(
+                fields=['-total_sales', 'id'],
+                condition=models.Q(is_active=True, stock__gt=0),
+                name='products_sales_idx'
+            ),
+            models.Index(
+                fields=['-total_sales', '-views'],
+                condition=models.Q(is_active=True, stock__gt=0, is_featured=True),
+                name='products_featured_idx'
+            ),
+            models.Index(
+                fields=['-created_at'],
+                condition=models.Q(is_active=True),
+                name='products_active_newest_idx'
+            ),
+            # Full-text and trigram search (see search.py); PostgreSQL only,
+            # created by migration 0004
+            GinIndex(fields=['search_vector'], name='products_search_vector_gin'),
+            GinIndex(OpClass('name', name='gin_trgm_ops'), name='products_name_trgm'),
+        ]
     
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -202,7 +271,7 @@ class Product(models.Model):
     
     @property
     def average_rating(self):
-        return self.reviews.aggregate(Avg('rating'))['rating__avg'] or 0
+        return self.rating_avg
     
     def __str__(self):
         return self.name
@@ -272,6 +341,9 @@ class Review(models.Model):
         db_table = 'reviews'
         ordering = ['-created_at']
         unique_together = ['product', 'user']
+        indexes = [
+            models.Index(fields=['product', 'is_approved', '-created_at'], name='reviews_product_approved_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.product.name}"
@@ -309,6 +381,9 @@ class CartItem(models.Model):
     
     class Meta:
         db_table = 'cart_items'
+        indexes = [
+            models.Index(fields=['cart', 'product', 'variant'], name='cart_items_line_idx'),
+        ]
     
     @property
     def total_price(self):
@@ -370,6 +445,10 @@ class Order(models.Model):
     class Meta:
         db_table = 'orders'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='orders_user_created_idx'),
+            models.Index(fields=['user', 'status', '-created_at'], name='orders_user_status_idx'),
+        ]
     
     def save(self, *args, **kwargs):
         if not self.order_number:
@@ -433,6 +512,9 @@ class Payment(models.Model):
     # M-Pesa specific fields
     mpesa_receipt = models.CharField(max_length=100, blank=True)
     mpesa_phone = models.CharField(max_length=15, blank=True)
+    # STK push identifiers; callbacks and status queries look payments up by these
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
+    merchant_request_id = models.CharField(max_length=100, blank=True, db_index=True)
     
     # Card specific fields
     card_last4 = models.CharField(max_length=4, blank=True)
@@ -448,6 +530,10 @@ class Payment(models.Model):
     class Meta:
         db_table = 'payments'
         ordering = ['-created_at']
+        indexes = [
+            # Reconciliation sweeps; only a handful of payments are processing
+            models.Index(fields=['id'], condition=models.Q(status='processing'), name='payments_processing_idx'),
+        ]
     
     def save(self, *args, **kwargs):
         if not self.transaction_id:
@@ -458,6 +544,67 @@ class Payment(models.Model):
         return f"{self.transaction_id} - {self.payment_method}"
 
 
+class MpesaCallback(models.Model):
+    """Inbox of raw M-Pesa STK callbacks, applied to payments by a worker"""
+    STATUS = (
+        ('pending', 'Pending'),
+        ('processed', 'Processed'),
+        ('duplicate', 'Duplicate'),
+        ('unmatched', 'Unmatched'),
+        ('failed', 'Failed'),
+    )
+    
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS, default='pending')
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'mpesa_callbacks'
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='mpesa_callbacks_status_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.checkout_request_id or 'unknown'} ({self.status})"
+
+
+class ProductRanking(models.Model):
+    """Top in-stock products of one scope by one metric, maintained by e_commerce.rankings"""
+    SCOPE = (
+        ('all', 'All Products'),
+        ('category', 'Category'),
+        ('vendor', 'Vendor'),
+        ('brand', 'Brand'),
+    )
+    
+    METRIC = (
+        ('sales', 'Best Selling'),
+        ('views', 'Most Viewed'),
+        ('newest', 'Newest'),
+        ('discount', 'Biggest Discount'),
+    )
+    
+    scope = models.CharField(max_length=20, choices=SCOPE)
+    scope_id = models.IntegerField(default=0)
+    metric = models.CharField(max_length=20, choices=METRIC)
+    # [[product_id, score], ...], best first
+    entries = models.JSONField(default=list)
+    refreshed_at = models.DateTimeField()
+    
+    class Meta:
+        db_table = 'product_rankings'
+        unique_together = ['scope', 'scope_id', 'metric']
+    
+    def __str__(self):
+        return f"{self.scope} {self.scope_id} by {self.metric}"
+
+
 class Coupon(models.Model):
     """Discount coupons"""
     DISCOUNT_TYPE = (
@@ -524,6 +671,10 @@ class Notification(models.Model):
     class Meta:
         db_table = 'notifications'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='notifications_user_created_idx'),
+            models.Index(fields=['user'], condition=models.Q(is_read=False), name='notifications_unread_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.title}"
@@ -0,0 +1,438 @@
+"""
+M-Pesa (Safaricom Daraja) integration helpers.
+
+All Daraja traffic goes through DarajaClient: one pooled keep-alive session
+with connect/read timeouts, a small retry budget with jittered backoff, a
+circuit breaker that fails fast while Daraja is down, and per-endpoint
+latency metrics. Async views use arequest()/apost(), which run the same
+client on a worker thread so the event loop is never blocked on Daraja.
+
+Access tokens are cached until MPESA_TOKEN_REFRESH_MARGIN seconds before they
+expire, in process memory and in the shared cache so every worker reuses the
+same token. Inside the margin the current token is still handed out while a
+background thread fetches the next one, so payments never wait on the auth
+call. Concurrent callers share a single in-flight refresh.
+"""
+
+import base64
+import hashlib
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from .percentiles import percentile
+
+
+logger = logging.getLogger(__name__)
+
+MPESA_TOKEN_REFRESH_MARGIN = getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 5 * 60)
+MPESA_CONNECT_TIMEOUT = getattr(settings, 'MPESA_CONNECT_TIMEOUT', 3.05)
+MPESA_READ_TIMEOUT = getattr(settings, 'MPESA_READ_TIMEOUT', 10)
+MPESA_MAX_RETRIES = getattr(settings, 'MPESA_MAX_RETRIES', 2)
+MPESA_POOL_SIZE = getattr(settings, 'MPESA_POOL_SIZE', 20)
+MPESA_BREAKER_THRESHOLD = getattr(settings, 'MPESA_BREAKER_THRESHOLD', 5)
+MPESA_BREAKER_COOLDOWN = getattr(settings, 'MPESA_BREAKER_COOLDOWN', 30)
+
+# Latency samples kept per endpoint for the metrics percentiles
+METRICS_WINDOW = 1000
+
+# Daraja tokens last an hour; used when the response leaves expires_in out
+DEFAULT_TOKEN_LIFETIME = 3599
+
+# errorCode of the HTTP 500 Daraja answers an STK query with while the
+# customer has not responded to the push yet
+STK_QUERY_IN_PROGRESS = '500.001.1001'
+
+
+class DarajaUnavailable(Exception):
+    """Daraja could not be reached, or the circuit breaker is open"""
+
+
+def never_sent(error):
+    """True when a request failed before any of it reached the server"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class CircuitBreaker:
+    """
+    Opens after ``threshold`` consecutive failures and rejects calls for
+    ``cooldown`` seconds; then lets a single trial call through (half-open)
+    and closes again if it succeeds.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=METRICS_WINDOW)
+
+    def snapshot(self):
+        latencies = sorted(self.latencies)
+
+        def latency_ms(fraction):
+            # None rather than 0 until the endpoint has been called
+            if not latencies:
+                return None
+            return round(percentile(latencies, fraction) * 1000, 2)
+
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'p50_ms': latency_ms(0.50),
+            'p95_ms': latency_ms(0.95),
+            'p99_ms': latency_ms(0.99),
+        }
+
+
+class DarajaClient:
+    """Pooled, timeout-bounded HTTP client for the Daraja API"""
+
+    # Worth retrying: the request may never have reached Daraja, or it asked us to
+    RETRY_STATUSES = {429, 502, 503, 504}
+
+    def __init__(self, connect_timeout=MPESA_CONNECT_TIMEOUT, read_timeout=MPESA_READ_TIMEOUT,
+                 max_retries=MPESA_MAX_RETRIES, pool_size=MPESA_POOL_SIZE,
+                 breaker_threshold=MPESA_BREAKER_THRESHOLD, breaker_cooldown=MPESA_BREAKER_COOLDOWN):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def metrics(self):
+        """Per-endpoint call, error, retry and latency figures"""
+        with self._metrics_lock:
+            endpoints = {name: metrics.snapshot() for name, metrics in self._metrics.items()}
+        return {'circuit': self.breaker.state, 'endpoints': endpoints}
+
+    def _endpoint_metrics(self, endpoint):
+        with self._metrics_lock:
+            return self._metrics.setdefault(endpoint, EndpointMetrics())
+
+    def request(self, method, url, endpoint, idempotent=True, is_answer=None, **kwargs):
+        """
+        Send one request and return the response.
+
+        Connection failures are retried up to ``max_retries`` times with
+        jittered exponential backoff. Timeouts and retryable HTTP statuses are
+        only retried for ``idempotent`` calls, since a non-idempotent request
+        (an STK push) may already have reached the customer's phone. Raises
+        DarajaUnavailable when Daraja cannot be reached or the breaker is open.
+
+        5xx responses count as breaker failures unless ``is_answer(response)``
+        says the endpoint uses that status for a regular answer.
+        """
+        metrics = self._endpoint_metrics(endpoint)
+        if not self.breaker.allow():
+            metrics.rejected += 1
+            raise DarajaUnavailable(f'M-Pesa {endpoint} is temporarily unavailable')
+
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        succeeded = False
+        try:
+            while True:
+                metrics.calls += 1
+                started = time.perf_counter()
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                    error = None
+                    retryable = idempotent and response.status_code in self.RETRY_STATUSES
+                except requests.RequestException as e:
+                    response = None
+                    error = e
+                    retryable = idempotent or never_sent(e)
+                finally:
+                    metrics.latencies.append(time.perf_counter() - started)
+
+                if not retryable or attempt >= self.max_retries:
+                    break
+                attempt += 1
+                metrics.retries += 1
+                time.sleep(random.uniform(0, 0.2 * 2 ** attempt))
+
+            succeeded = response is not None and (
+                response.status_code < 500 or bool(is_answer and is_answer(response))
+            )
+        finally:
+            # Also on unexpected errors, so a half-open trial always ends
+            if succeeded:
+                self.breaker.record_success()
+            else:
+                metrics.errors += 1
+                self.breaker.record_failure()
+
+        if response is None:
+            raise DarajaUnavailable(f'M-Pesa {endpoint} request failed: {error}')
+        return response
+
+    def get(self, url, endpoint, **kwargs):
+        return self.request('GET', url, endpoint, **kwargs)
+
+    def post(self, url, endpoint, idempotent=False, **kwargs):
+        return self.request('POST', url, endpoint, idempotent=idempotent, **kwargs)
+
+    async def arequest(self, method, url, endpoint, idempotent=True, **kwargs):
+        """request() for async views, run on a worker thread so the event loop keeps serving"""
+        return await sync_to_async(self.request, thread_sensitive=False)(
+            method, url, endpoint, idempotent=idempotent, **kwargs
+        )
+
+    async def apost(self, url, endpoint, idempotent=False, **kwargs):
+        return await self.arequest('POST', url, endpoint, idempotent=idempotent, **kwargs)
+
+
+daraja = DarajaClient()
+
+
+def fetch_access_token():
+    """Request a new OAuth token; returns (token, lifetime in seconds) or None"""
+    credentials = base64.b64encode(
+        f"{settings.MPESA_CONSUMER_KEY}:{settings.MPESA_CONSUMER_SECRET}".encode()
+    ).decode('utf-8')
+
+    try:
+        response = daraja.get(
+            settings.MPESA_AUTH_URL,
+            'oauth',
+            headers={"Authorization": f"Basic {credentials}"}
+        )
+        if response.status_code != 200:
+            logger.warning('M-Pesa auth returned HTTP %s', response.status_code)
+            return None
+        data = response.json()
+        return data['access_token'], int(data.get('expires_in') or DEFAULT_TOKEN_LIFETIME)
+    except (DarajaUnavailable, ValueError, KeyError) as e:
+        logger.warning('Error getting M-Pesa access token: %s', e)
+        return None
+
+
+class AccessTokenManager:
+    """Caches the Daraja access token and refreshes it ahead of expiry"""
+
+    def __init__(self):
+        self._tokens = {}
+        self._refresh_locks = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def cache_key(self):
+        # Different credentials or endpoints (sandbox, stubs) get their own token
+        identity = f'{settings.MPESA_AUTH_URL}|{settings.MPESA_CONSUMER_KEY}'
+        return 'mpesa:token:' + hashlib.md5(identity.encode()).hexdigest()
+
+    def get_token(self):
+        """A valid access token, or None when Daraja cannot be reached"""
+        key = self.cache_key()
+        token, expires_at = self._tokens.get(key) or cache.get(key) or (None, 0)
+        now = time.time()
+
+        if token and now < expires_at - MPESA_TOKEN_REFRESH_MARGIN:
+            self._tokens[key] = (token, expires_at)
+            return token
+
+        if token and now < expires_at:
+            # Still valid: hand it out and fetch the next one off the request path
+            self._refresh_in_background(key)
+            return token
+
+        return self._refresh(key)
+
+    def clear(self):
+        key = self.cache_key()
+        self._tokens.pop(key, None)
+        cache.delete(key)
+
+    def _refresh_lock(self, key):
+        with self._lock:
+            return self._refresh_locks.setdefault(key, threading.Lock())
+
+    def _refresh(self, key):
+        """Fetch a new token; callers arriving meanwhile wait for the same fetch"""
+        with self._refresh_lock(key):
+            token, expires_at = self._tokens.get(key) or cache.get(key) or (None, 0)
+            if token and time.time() < expires_at - MPESA_TOKEN_REFRESH_MARGIN:
+                # Another caller refreshed it while we waited
+                self._tokens[key] = (token, expires_at)
+                return token
+
+            fetched = fetch_access_token()
+            if fetched is None:
+                return token if token and time.time() < expires_at else None
+
+            token, lifetime = fetched
+            expires_at = time.time() + lifetime
+            self._tokens[key] = (token, expires_at)
+            cache.set(key, (token, expires_at), timeout=lifetime)
+            return token
+
+    def _refresh_in_background(self, key):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._refresh(key)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name='mpesa-token-refresh', daemon=True).start()
+
+
+access_tokens = AccessTokenManager()
+
+
+def get_access_token():
+    return access_tokens.get_token()
+
+
+async def aget_access_token():
+    return await sync_to_async(access_tokens.get_token, thread_sensitive=False)()
+
+
+def stk_request_ids(data):
+    """
+    (CheckoutRequestID, MerchantRequestID) from a stored Daraja payload: either
+    the STK push response or the callback body that later replaced it.
+    """
+    if not isinstance(data, dict):
+        return '', ''
+    callback = (data.get('Body') or {}).get('stkCallback') or {}
+    source = callback or data
+    return source.get('CheckoutRequestID') or '', source.get('MerchantRequestID') or ''
+
+
+def backfill_payment_request_ids(batch_size=1000, stdout=None):
+    """Fill checkout/merchant request ids of payments that only have them in response_data"""
+    from .models import Payment
+
+    updated = 0
+    last_id = 0
+    while True:
+        batch = list(
+            Payment.objects.filter(
+                pk__gt=last_id,
+                checkout_request_id='',
+                response_data__isnull=False
+            ).order_by('pk').only('pk', 'response_data')[:batch_size]
+        )
+        if not batch:
+            break
+        last_id = batch[-1].pk
+
+        changed = []
+        for payment in batch:
+            payment.checkout_request_id, payment.merchant_request_id = stk_request_ids(payment.response_data)
+            if payment.checkout_request_id:
+                changed.append(payment)
+        Payment.objects.bulk_update(changed, ['checkout_request_id', 'merchant_request_id'])
+        updated += len(changed)
+        if stdout:
+            stdout.write(f'  backfilled {updated} payments')
+    return updated
+
+
+def stk_password(timestamp):
+    """The base64 shortcode+passkey+timestamp password STK requests are signed with"""
+    return base64.b64encode(
+        (settings.MPESA_SHORTCODE + settings.MPESA_PASSKEY + timestamp).encode()
+    ).decode('utf-8')
+
+
+def stk_query_in_progress(response):
+    """True for the HTTP 500 an STK query gets while the push is still pending"""
+    try:
+        data = response.json()
+    except ValueError:
+        return False
+    return isinstance(data, dict) and data.get('errorCode') == STK_QUERY_IN_PROGRESS
+
+
+def query_stk_status(checkout_request_id, access_token):
+    """
+    Ask Daraja for the outcome of an STK push. Returns the response JSON: it
+    carries ResultCode/ResultDesc once the customer has answered, and an
+    errorCode while the request is still being processed. Daraja sends that
+    in-progress answer with HTTP 500; it does not count against the breaker.
+    """
+    timestamp = time.strftime('%Y%m%d%H%M%S')
+    response = daraja.post(
+        settings.MPESA_QUERY_URL,
+        'stk_query',
+        idempotent=True,
+        is_answer=stk_query_in_progress,
+        json={
+            'BusinessShortCode': settings.MPESA_SHORTCODE,
+            'Password': stk_password(timestamp),
+            'Timestamp': timestamp,
+            'CheckoutRequestID': checkout_request_id,
+        },
+        headers={
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json',
+        }
+    )
+    return response.json()
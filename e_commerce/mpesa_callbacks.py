@@ -0,0 +1,204 @@
+"""
+M-Pesa callback inbox.
+
+Safaricom retries a callback when it is not acknowledged quickly, so the
+callback endpoint only stores the raw payload (record_callback, a single
+INSERT) and answers straight away. The process_mpesa_callbacks command then
+drains the inbox in batches: rows are claimed with SELECT ... FOR UPDATE SKIP
+LOCKED so several workers can run side by side, repeated deliveries of the
+same CheckoutRequestID are marked duplicate, and payments that already reached
+a final state are left alone, so applying a callback twice changes nothing.
+
+Callbacks can overtake the STK push response that stores the payment's
+CheckoutRequestID; those stay pending and are retried until
+MPESA_CALLBACK_MAX_ATTEMPTS passes have failed to find their payment.
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import MpesaCallback, Order, Payment
+from .order_stats import invalidate_order_stats
+from .payment_events import notify_payment_status
+
+
+logger = logging.getLogger(__name__)
+
+MPESA_CALLBACK_BATCH_SIZE = getattr(settings, 'MPESA_CALLBACK_BATCH_SIZE', 200)
+MPESA_CALLBACK_POLL_INTERVAL = getattr(settings, 'MPESA_CALLBACK_POLL_INTERVAL', 1)
+MPESA_CALLBACK_MAX_ATTEMPTS = getattr(settings, 'MPESA_CALLBACK_MAX_ATTEMPTS', 10)
+
+# Payments in these states have had their callback applied already
+FINAL_PAYMENT_STATUSES = ('completed', 'failed', 'cancelled', 'refunded')
+
+
+def stk_callback(payload):
+    if not isinstance(payload, dict):
+        return {}
+    return (payload.get('Body') or {}).get('stkCallback') or {}
+
+
+def record_callback(payload):
+    """Store a raw callback payload for the worker to apply"""
+    return MpesaCallback.objects.create(
+        checkout_request_id=str(stk_callback(payload).get('CheckoutRequestID') or '')[:100],
+        payload=payload
+    )
+
+
+def callback_metadata(callback):
+    """CallbackMetadata items as a {Name: Value} dict"""
+    items = (callback.get('CallbackMetadata') or {}).get('Item') or []
+    return {item.get('Name'): item.get('Value') for item in items if isinstance(item, dict)}
+
+
+def apply_stk_result(payment, result, payload, now):
+    """
+    Update ``payment`` and its order in memory from an STK result: the
+    stkCallback of a callback or an STK push query response, which carry the
+    same ResultCode/ResultDesc. Returns False when the payment was already
+    final and nothing changed.
+    """
+    if payment.status in FINAL_PAYMENT_STATUSES:
+        return False
+
+    if result.get('ResultCode') in (0, '0'):
+        metadata = callback_metadata(result)
+        payment.status = 'completed'
+        payment.mpesa_receipt = str(metadata.get('MpesaReceiptNumber') or '')
+        payment.completed_at = now
+        payment.response_data = payload
+
+        order = payment.order
+        order.status = 'confirmed'
+        order.confirmed_at = now
+        order.updated_at = now
+    else:
+        payment.status = 'failed'
+        payment.failure_reason = result.get('ResultDesc') or ''
+        payment.response_data = payload
+    return True
+
+
+def apply_callback(payload, payment, now):
+    """apply_stk_result() for a raw callback payload"""
+    return apply_stk_result(payment, stk_callback(payload), payload, now)
+
+
+def save_applied(payments):
+    """Write payments changed by apply_stk_result(), and their orders, in bulk"""
+    Payment.objects.bulk_update(
+        payments,
+        ['status', 'mpesa_receipt', 'completed_at', 'failure_reason', 'response_data']
+    )
+    orders = [payment.order for payment in payments if payment.status == 'completed']
+    Order.objects.bulk_update(orders, ['status', 'confirmed_at', 'updated_at'])
+    # bulk_update sends no post_save
+    invalidate_order_stats(*(order.user_id for order in orders))
+    notify_payment_status(payment.id for payment in payments)
+
+
+def process_batch(batch_size=MPESA_CALLBACK_BATCH_SIZE, after=0):
+    """
+    Apply up to ``batch_size`` pending callbacks with ids above ``after``.
+    Returns the claimed callbacks, in id order.
+    """
+    with transaction.atomic():
+        callbacks = list(
+            MpesaCallback.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', id__gt=after)
+            .order_by('id')[:batch_size]
+        )
+        if not callbacks:
+            return []
+
+        checkout_ids = {callback.checkout_request_id for callback in callbacks if callback.checkout_request_id}
+        payments = {
+            payment.checkout_request_id: payment
+            for payment in Payment.objects.select_for_update()
+            .select_related('order')
+            .filter(checkout_request_id__in=checkout_ids)
+        }
+
+        now = timezone.now()
+        seen = set()
+        changed_payments = []
+        for callback in callbacks:
+            callback.attempts += 1
+            checkout_request_id = callback.checkout_request_id
+            payment = payments.get(checkout_request_id)
+
+            if not checkout_request_id:
+                callback.status = 'failed'
+                callback.error = 'Payload has no CheckoutRequestID'
+            elif checkout_request_id in seen:
+                callback.status = 'duplicate'
+            elif payment is None:
+                # The STK push response may not have been stored yet
+                if callback.attempts >= MPESA_CALLBACK_MAX_ATTEMPTS:
+                    callback.status = 'unmatched'
+                    callback.error = 'No payment with this CheckoutRequestID'
+            elif apply_callback(callback.payload, payment, now):
+                callback.status = 'processed'
+                changed_payments.append(payment)
+            else:
+                callback.status = 'duplicate'
+
+            if checkout_request_id and payment is not None:
+                seen.add(checkout_request_id)
+            if callback.status != 'pending':
+                callback.processed_at = now
+
+        save_applied(changed_payments)
+        MpesaCallback.objects.bulk_update(callbacks, ['status', 'attempts', 'error', 'processed_at'])
+
+    return callbacks
+
+
+def drain(batch_size=MPESA_CALLBACK_BATCH_SIZE):
+    """
+    One pass over the pending callbacks; returns how many were claimed.
+    Callbacks left pending are retried on the next pass, not within this one.
+    """
+    total = 0
+    after = 0
+    while True:
+        callbacks = process_batch(batch_size, after)
+        total += len(callbacks)
+        if len(callbacks) < batch_size:
+            return total
+        after = callbacks[-1].id
+
+
+def run_worker(stop, batch_size=MPESA_CALLBACK_BATCH_SIZE, interval=MPESA_CALLBACK_POLL_INTERVAL):
+    """Drain the inbox every ``interval`` seconds until the ``stop`` event is set"""
+    try:
+        while not stop.is_set():
+            try:
+                drain(batch_size)
+            except Exception:
+                logger.exception('Failed to process M-Pesa callbacks')
+            stop.wait(interval)
+    finally:
+        connection.close()
+
+
+def start_workers(count, batch_size=MPESA_CALLBACK_BATCH_SIZE, interval=MPESA_CALLBACK_POLL_INTERVAL):
+    """Start ``count`` worker threads; returns (stop event, threads)"""
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=run_worker,
+            args=(stop, batch_size, interval),
+            name=f'mpesa-callbacks-{n}',
+            daemon=True
+        )
+        for n in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    return stop, threads
@@ -0,0 +1,47 @@
+"""
+Cached per-user order counters.
+
+The order list tabs and the account overview show how many orders a user has
+in each status. All counts come from one conditional-aggregate query and are
+cached per user; any order save or delete (placing, cancelling, admin edits)
+and the bulk status updates of the M-Pesa workers call
+invalidate_order_stats().
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+
+from .models import Order
+
+
+ORDER_STATS_TTL = getattr(settings, 'ORDER_STATS_TTL', 10 * 60)
+
+
+def order_stats_key(user_id):
+    return f'order_stats:user:{user_id}'
+
+
+def build_order_stats(user_id):
+    return Order.objects.filter(user_id=user_id).aggregate(
+        all=Count('id'),
+        **{status: Count('id', filter=Q(status=status)) for status, _ in Order.ORDER_STATUS}
+    )
+
+
+def get_order_stats(user):
+    """{'all': n, <status>: n, ...} for every order status"""
+    key = order_stats_key(user.pk)
+    stats = cache.get(key)
+    if stats is None:
+        stats = build_order_stats(user.pk)
+        cache.set(key, stats, timeout=ORDER_STATS_TTL)
+    return stats
+
+
+def invalidate_order_stats(*user_ids):
+    """Drop the cached counters once the current transaction commits"""
+    keys = [order_stats_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
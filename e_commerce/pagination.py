@@ -0,0 +1,235 @@
+"""
+Listing pagination.
+
+Numbered pages of public listings keep Django's Paginator, but take the
+total from a cached count instead of running COUNT(*) on every request.
+Per-user lists such as the wishlist change with every add and remove, so
+they count exactly (``cache_count=False``). Passing ``?cursor=`` switches a
+listing to keyset (seek) pagination: each page is fetched with
+``WHERE (sort columns) < (last row's values) ORDER BY ... LIMIT n``, so
+page 500 costs the same as page 1. Cursors are opaque base64 strings that
+carry the sort values of the boundary row.
+"""
+
+import base64
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.http import urlencode
+
+
+COUNT_CACHE_TTL = getattr(settings, 'LISTING_COUNT_TTL', 5 * 60)
+
+
+def cached_count(queryset, timeout=COUNT_CACHE_TTL):
+    """COUNT(*) for ``queryset``, shared through the cache for ``timeout`` seconds"""
+    try:
+        sql = str(queryset.query)
+    except EmptyResultSet:
+        # .none() and filters such as pk__in=[] have no SQL; they match nothing
+        return 0
+    key = 'listing_count:' + hashlib.md5(sql.encode()).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout=timeout)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator that takes its total from cached statistics"""
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self._known_count = count
+
+    @cached_property
+    def count(self):
+        if self._known_count is not None:
+            return self._known_count
+        return cached_count(self.object_list)
+
+
+def encode_cursor(values, direction):
+    payload = json.dumps({'v': values, 'd': direction}, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (values, direction), or (None, 'next') for a missing or bad cursor"""
+    if not cursor:
+        return None, 'next'
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values, direction = payload['v'], payload['d']
+    except (ValueError, TypeError, KeyError):
+        return None, 'next'
+    if not isinstance(values, list) or direction not in ('next', 'prev'):
+        return None, 'next'
+    return values, direction
+
+
+class KeysetPage:
+    """One keyset page; iterable like a Django Page"""
+
+    # Templates branch on this; a Django Page has no such attribute
+    is_keyset = True
+    number = None
+
+    def __init__(self, object_list, paginator, next_values, previous_values, params):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = encode_cursor(next_values, 'next') if next_values else None
+        self.previous_cursor = encode_cursor(previous_values, 'prev') if previous_values else None
+        self._params = params
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def _querystring(self, cursor):
+        params = self._params.copy()
+        params.pop('page', None)
+        params['cursor'] = cursor or ''
+        return urlencode(params, doseq=True)
+
+    @property
+    def next_querystring(self):
+        return self._querystring(self.next_cursor)
+
+    @property
+    def previous_querystring(self):
+        return self._querystring(self.previous_cursor)
+
+
+class KeysetPaginator:
+    """
+    Seek pagination over ``queryset`` ordered by ``ordering``.
+
+    ``ordering`` is a sequence such as ('-total_sales', '-views', '-id'); a
+    primary key tie-breaker is appended when missing so every row has a
+    unique position. ``count`` is an (approximate) total for display only.
+    """
+
+    def __init__(self, queryset, per_page, ordering=None, count=None, cache_count=True):
+        ordering = [
+            {'pk': 'id', '-pk': '-id'}.get(field, field)
+            for field in (ordering or queryset.query.order_by or queryset.model._meta.ordering)
+        ]
+        if not any(field.lstrip('-') == 'id' for field in ordering):
+            descending = ordering[-1].startswith('-') if ordering else False
+            ordering.append('-id' if descending else 'id')
+        self.ordering = ordering
+        self.queryset = queryset
+        self.per_page = per_page
+        self._count = count
+        self.cache_count = cache_count
+
+    @cached_property
+    def count(self):
+        if self._count is not None:
+            return self._count
+        return cached_count(self.queryset) if self.cache_count else self.queryset.count()
+
+    @property
+    def num_pages(self):
+        return max(1, -(-self.count // self.per_page))
+
+    page_range = range(0)
+
+    def _to_python(self, field, value):
+        try:
+            model_field = self.queryset.model._meta.get_field(field)
+        except FieldDoesNotExist:
+            # Annotations such as the search rank
+            return value
+        return model_field.to_python(value)
+
+    def _seek(self, values, forward):
+        """Q for rows strictly after (forward) or before the given sort values"""
+        fields = [field.lstrip('-') for field in self.ordering]
+        values = [self._to_python(field, value) for field, value in zip(fields, values)]
+
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            descending = field.startswith('-')
+            name = fields[i]
+            lookup = 'lt' if descending == forward else 'gt'
+            clause = Q(**{f'{name}__{lookup}': values[i]})
+            for previous_name, previous_value in zip(fields[:i], values[:i]):
+                clause &= Q(**{previous_name: previous_value})
+            condition |= clause
+        return condition
+
+    def _values(self, obj):
+        return [getattr(obj, field.lstrip('-')) for field in self.ordering]
+
+    def page(self, cursor, params=None):
+        values, direction = decode_cursor(cursor)
+        if values is not None and len(values) != len(self.ordering):
+            values, direction = None, 'next'
+
+        forward = direction == 'next'
+        queryset = self.queryset
+        if values is not None:
+            queryset = queryset.filter(self._seek(values, forward))
+
+        if forward:
+            queryset = queryset.order_by(*self.ordering)
+        else:
+            queryset = queryset.order_by(*[
+                field[1:] if field.startswith('-') else '-' + field for field in self.ordering
+            ])
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if not forward:
+            rows.reverse()
+
+        next_values = previous_values = None
+        if rows:
+            if has_more or not forward:
+                next_values = self._values(rows[-1])
+            if values is not None and (forward or has_more):
+                previous_values = self._values(rows[0])
+
+        return KeysetPage(rows, self, next_values, previous_values, params or {})
+
+
+def paginate(request, queryset, per_page, ordering=None, count=None, page_param='page', cache_count=True):
+    """
+    Page ``queryset`` for ``request``.
+
+    Requests carrying a ``cursor`` parameter get a KeysetPage; everything
+    else gets a numbered Django Page whose total comes from ``count`` or the
+    cached count. Lists whose total must follow every change (the user's own
+    items) pass ``cache_count=False`` for an exact COUNT(*).
+    """
+    if 'cursor' in request.GET:
+        paginator = KeysetPaginator(queryset, per_page, ordering=ordering, count=count, cache_count=cache_count)
+        return paginator.page(request.GET.get('cursor'), params=request.GET)
+
+    if cache_count:
+        paginator = CachedCountPaginator(queryset, per_page, count=count)
+    else:
+        paginator = Paginator(queryset, per_page)
+    return paginator.get_page(request.GET.get(page_param))
@@ -0,0 +1,144 @@
+"""
+Payment status change notifications.
+
+check_payment_status long-polls: a client that already knows a payment's
+status waits here until that payment changes instead of re-requesting every
+few seconds. Whoever changes a payment calls notify_payment_status() inside
+the same transaction. On PostgreSQL that issues NOTIFY, which is delivered on
+commit to every ASGI process; each process holds one LISTEN connection, in a
+background thread started by the first waiting request, and wakes the
+waiting requests in whatever event loop they run in. Thousands of waiting
+clients cost one connection and no queries until something happens. Changes
+made in the same process (and on other databases) are published in-process
+on commit.
+
+Long-polling needs ASGI. Under WSGI every async view runs in a throwaway
+event loop on a worker thread, so check_payment_status answers at once with
+a retry_after hint and the page polls instead (see long_poll_supported).
+"""
+
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection, transaction
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'payment_status'
+
+# Longest a status request may be held open, in seconds
+PAYMENT_STATUS_MAX_WAIT = getattr(settings, 'PAYMENT_STATUS_MAX_WAIT', 25)
+
+# Seconds a polling client (no long-poll support) waits between requests
+POLL_INTERVAL = 3
+
+
+def long_poll_supported(request):
+    """Only ASGI servers can hold a request open without tying up a worker"""
+    return isinstance(request, ASGIRequest)
+
+
+def notify_payment_status(payment_ids):
+    """Wake requests waiting on any of ``payment_ids`` once the current transaction commits"""
+    payment_ids = sorted({int(payment_id) for payment_id in payment_ids})
+    if not payment_ids:
+        return
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_notify(%s, id::text) FROM unnest(%s::integer[]) AS id',
+                [CHANNEL, payment_ids]
+            )
+    transaction.on_commit(lambda: hub.publish(payment_ids))
+
+
+class PaymentStatusHub:
+    """Wakes asyncio waiters, keyed by payment id, from any thread"""
+
+    def __init__(self):
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def publish(self, payment_ids):
+        with self._lock:
+            waiters = [waiter for payment_id in payment_ids for waiter in self._waiters.get(payment_id, ())]
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The loop closed while its request was finishing
+                pass
+
+    @contextlib.contextmanager
+    def watch(self, payment_id):
+        """
+        Subscribe to changes of ``payment_id``; yields an asyncio.Event set on
+        the next change. Subscribe before reading the payment so a change that
+        lands in between is not missed.
+        """
+        loop = asyncio.get_running_loop()
+        self._ensure_listener()
+        waiter = (loop, asyncio.Event())
+        with self._lock:
+            self._waiters.setdefault(payment_id, set()).add(waiter)
+        try:
+            yield waiter[1]
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(payment_id)
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[payment_id]
+
+    def _ensure_listener(self):
+        """Start this process's LISTEN thread (once)"""
+        if connection.vendor != 'postgresql' or self._listener is not None:
+            return
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='payment-status-listener', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        """LISTEN on the payment channel for the life of the process, reconnecting on errors"""
+        import psycopg
+        from psycopg.conninfo import make_conninfo
+
+        database = settings.DATABASES['default']
+        conninfo = make_conninfo(**{
+            key: value for key, value in {
+                'dbname': database.get('NAME'),
+                'user': database.get('USER'),
+                'password': database.get('PASSWORD'),
+                'host': database.get('HOST'),
+                'port': database.get('PORT'),
+            }.items() if value
+        })
+        while True:
+            try:
+                with psycopg.connect(conninfo, autocommit=True) as listener:
+                    listener.execute(f'LISTEN {CHANNEL}')
+                    for notification in listener.notifies():
+                        self.publish([int(notification.payload)])
+            except Exception:
+                logger.exception('Payment status listener failed; reconnecting')
+                time.sleep(1)
+
+
+hub = PaymentStatusHub()
+
+
+async def wait_for(event, timeout):
+    """Wait up to ``timeout`` seconds (capped at PAYMENT_STATUS_MAX_WAIT); True if ``event`` was set"""
+    try:
+        await asyncio.wait_for(event.wait(), min(timeout, PAYMENT_STATUS_MAX_WAIT))
+        return True
+    except asyncio.TimeoutError:
+        return False
@@ -0,0 +1,16 @@
+"""
+Latency percentiles shared by the funnel benchmark, request profiling and the
+Daraja client metrics.
+"""
+
+import math
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    # The tolerance keeps float error (0.07 * 100 = 7.000000000000001) from
+    # moving up a rank
+    rank = max(1, math.ceil(fraction * len(sorted_values) - 1e-9))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
@@ -0,0 +1,318 @@
+"""
+Sampled per-view request profiling.
+
+With REQUEST_PROFILING on, RequestProfilingMiddleware profiles a
+REQUEST_PROFILING_SAMPLE_RATE fraction of requests: how many queries ran and
+how long was spent in the database, in template rendering and in the view,
+plus fingerprints of queries that ran more than once in the same request (the
+N+1 pattern). Profiles are aggregated in memory per URL name; each metric
+keeps a fixed-size reservoir of samples for percentiles, so memory stays flat
+however long the process runs. Requests that are not sampled cost one
+random() call, and queries outside sampled requests one context lookup.
+
+Staff can read this process's aggregate as JSON at /api/profiling/. With
+REQUEST_PROFILING_SNAPSHOT_DIR set, it is also written there every
+REQUEST_PROFILING_SNAPSHOT_INTERVAL seconds, one file per process and
+snapshot, keeping the latest REQUEST_PROFILING_SNAPSHOT_KEEP.
+"""
+
+import json
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import Template as DjangoTemplate
+from django.utils import timezone
+
+from .percentiles import percentile
+
+
+logger = logging.getLogger(__name__)
+
+REQUEST_PROFILING = getattr(settings, 'REQUEST_PROFILING', False)
+REQUEST_PROFILING_SAMPLE_RATE = getattr(settings, 'REQUEST_PROFILING_SAMPLE_RATE', 0.01)
+REQUEST_PROFILING_MAX_SAMPLES = getattr(settings, 'REQUEST_PROFILING_MAX_SAMPLES', 1000)
+REQUEST_PROFILING_SNAPSHOT_DIR = getattr(settings, 'REQUEST_PROFILING_SNAPSHOT_DIR', None)
+REQUEST_PROFILING_SNAPSHOT_INTERVAL = getattr(settings, 'REQUEST_PROFILING_SNAPSHOT_INTERVAL', 5 * 60)
+REQUEST_PROFILING_SNAPSHOT_KEEP = getattr(settings, 'REQUEST_PROFILING_SNAPSHOT_KEEP', 48)
+
+METRICS = ('queries', 'db_ms', 'template_ms', 'view_ms')
+
+# A query repeated this many times in one request is reported as N+1
+N_PLUS_ONE_REPEATS = 5
+
+# Distinct repeated queries tracked per view
+MAX_FINGERPRINTS = 50
+
+# IN (%s, %s, ...) lists differ in length between requests
+PLACEHOLDER_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+
+_profile = ContextVar('request_profile', default=None)
+
+
+def fingerprint(sql):
+    """The SQL with parameter lists collapsed, identical for repeats of one query"""
+    return PLACEHOLDER_LIST.sub('(...)', sql)
+
+
+class RequestProfile:
+    """What one sampled request spent, filled in by the query and template hooks"""
+
+    __slots__ = ('queries', 'db_time', 'template_time', 'fingerprints')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.fingerprints = Counter()
+
+
+def _record_query(execute, sql, params, many, context):
+    profile = _profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.db_time += time.perf_counter() - started
+        profile.queries += 1
+        profile.fingerprints[fingerprint(sql)] += 1
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    # connection_created can fire inside a connection.execute_wrapper() block,
+    # whose exit pops the last wrapper: go first so that stays its own
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _record_query)
+
+
+def _instrument_templates():
+    render = DjangoTemplate.render
+    if getattr(render, 'profiled', False):
+        return
+
+    def profiled_render(self, context=None, request=None):
+        profile = _profile.get()
+        if profile is None:
+            return render(self, context, request)
+        started = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            profile.template_time += time.perf_counter() - started
+
+    profiled_render.profiled = True
+    DjangoTemplate.render = profiled_render
+
+
+class ViewStats:
+    """Aggregate of the sampled requests of one URL name"""
+
+    def __init__(self, max_samples, rng):
+        self.max_samples = max_samples
+        self.rng = rng
+        self.requests = 0
+        self.samples = {metric: [] for metric in METRICS}
+        self.repeated = {}
+
+    def record(self, values, fingerprints):
+        self.requests += 1
+        # Reservoir sampling: every request has the same chance to be kept,
+        # and all metrics keep the same requests
+        if self.requests <= self.max_samples:
+            slot = None
+        else:
+            slot = self.rng.randrange(self.requests)
+            if slot >= self.max_samples:
+                slot = -1
+        if slot != -1:
+            for metric in METRICS:
+                if slot is None:
+                    self.samples[metric].append(values[metric])
+                else:
+                    self.samples[metric][slot] = values[metric]
+
+        for sql, repeats in fingerprints.items():
+            if repeats < 2:
+                continue
+            repeated = self.repeated.get(sql)
+            if repeated is None:
+                if len(self.repeated) >= MAX_FINGERPRINTS:
+                    continue
+                repeated = self.repeated[sql] = {'sql': sql, 'requests': 0, 'max_repeats': 0}
+            repeated['requests'] += 1
+            repeated['max_repeats'] = max(repeated['max_repeats'], repeats)
+
+    def summary(self):
+        result = {'requests': self.requests}
+        for metric in METRICS:
+            values = sorted(self.samples[metric])
+            result[metric] = {
+                'p50': round(percentile(values, 0.50), 2),
+                'p95': round(percentile(values, 0.95), 2),
+                'p99': round(percentile(values, 0.99), 2),
+                'max': round(values[-1], 2) if values else 0,
+            }
+        result['repeated_queries'] = [
+            {**repeated, 'n_plus_one': repeated['max_repeats'] >= N_PLUS_ONE_REPEATS}
+            for repeated in sorted(
+                self.repeated.values(),
+                key=lambda repeated: (repeated['max_repeats'], repeated['requests']),
+                reverse=True
+            )
+        ]
+        return result
+
+
+class ProfileStore:
+    """Per-URL-name ViewStats of this process"""
+
+    def __init__(self, max_samples=REQUEST_PROFILING_MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.rng = random.Random()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+            self.started_at = timezone.now()
+
+    def record(self, view_name, profile, view_time):
+        values = {
+            'queries': profile.queries,
+            'db_ms': profile.db_time * 1000,
+            'template_ms': profile.template_time * 1000,
+            'view_ms': view_time * 1000,
+        }
+        with self.lock:
+            stats = self.views.get(view_name)
+            if stats is None:
+                stats = self.views[view_name] = ViewStats(self.max_samples, self.rng)
+            stats.record(values, profile.fingerprints)
+
+    def snapshot(self):
+        with self.lock:
+            views = {view_name: stats.summary() for view_name, stats in sorted(self.views.items())}
+            started_at = self.started_at
+        return {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'sample_rate': REQUEST_PROFILING_SAMPLE_RATE,
+            'since': started_at.isoformat(),
+            'generated_at': timezone.now().isoformat(),
+            'views': views,
+        }
+
+
+store = ProfileStore()
+
+
+def write_snapshot(directory=REQUEST_PROFILING_SNAPSHOT_DIR, keep=REQUEST_PROFILING_SNAPSHOT_KEEP):
+    """Write the current aggregate to ``directory`` and drop this process's oldest snapshots"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    prefix = f'profile-{socket.gethostname()}-{os.getpid()}-'
+    path = directory / f"{prefix}{timezone.now().strftime('%Y%m%d%H%M%S')}.json"
+    partial = path.with_suffix('.tmp')
+    partial.write_text(json.dumps(store.snapshot(), indent=2))
+    os.replace(partial, path)
+
+    for old in sorted(directory.glob(f'{prefix}*.json'))[:-keep or None]:
+        old.unlink(missing_ok=True)
+    return path
+
+
+def _run_snapshots():
+    while True:
+        time.sleep(REQUEST_PROFILING_SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except Exception:
+            logger.exception('Failed to write request profiling snapshot')
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def install():
+    """Hook query and template timing into this process (once)"""
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        connection_created.connect(_instrument_connection, dispatch_uid='request_profiling')
+        for connection in connections.all(initialized_only=True):
+            _instrument_connection(None, connection)
+        _instrument_templates()
+        if REQUEST_PROFILING_SNAPSHOT_DIR:
+            threading.Thread(target=_run_snapshots, name='profiling-snapshots', daemon=True).start()
+        _installed = True
+
+
+class RequestProfilingMiddleware:
+    """
+    Profiles a sample of requests into ``store``. Place it last in MIDDLEWARE
+    so view time covers the view and its template rendering only.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not REQUEST_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        install()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if random.random() >= REQUEST_PROFILING_SAMPLE_RATE:
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _profile.reset(token)
+        self.record(request, profile, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= REQUEST_PROFILING_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        # Context variables follow the request into sync_to_async threads
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _profile.reset(token)
+        self.record(request, profile, time.perf_counter() - started)
+        return response
+
+    def record(self, request, profile, view_time):
+        match = request.resolver_match
+        store.record(match.view_name if match else '<unresolved>', profile, view_time)
@@ -0,0 +1,151 @@
+"""
+Query plan checks for the hot views.
+
+Walks the pages shoppers hit most (home, category listings in every sort
+order, search, product, cart, checkout and the account pages) as the
+benchmark user, records every statement they send, and EXPLAINs each one.
+A statement that reads a large table with a sequential scan means an index
+is missing or unusable, which only shows once the catalog is big; tables
+with fewer than ``min_rows`` rows are ignored since scanning those is the
+right plan. Everything runs inside a transaction that is rolled back, so the
+walk leaves no trace in the database.
+
+Used by the check_query_plans command; seed a catalog first, e.g.
+``python manage.py seed_data --scale 100000``.
+"""
+
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from django.urls import reverse
+
+from .benchmark import FunnelBenchmark
+from .home_rails import build_home_rails
+from .search import search_enabled
+
+
+SORTS = ('popular', 'price_low', 'price_high', 'newest', 'rating')
+
+# Statements worth explaining; INSERTs and savepoints have no access path
+EXPLAINED = re.compile(r'^\s*(SELECT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+# SQLite: "SCAN products" (or "SCAN U0" for an aliased table) without an index
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)$')
+
+# Table aliases in Django's SQL, e.g. FROM "orders" U0
+TABLE_ALIAS = re.compile(r'(?:FROM|JOIN)\s+"(\w+)"\s+(?:AS\s+)?"?(\w+)"?', re.IGNORECASE)
+
+Finding = namedtuple('Finding', 'view table rows sql')
+
+
+@contextmanager
+def recording(statements):
+    """Append (sql, params) of every statement sent on ``connection``"""
+    def record(execute, sql, params, many, context):
+        if not many:
+            statements.append((sql, params))
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(record):
+        yield
+
+
+def sequential_scans(sql, params):
+    """Tables read with a sequential scan by this statement"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            nodes = [node['Plan'] for node in plan]
+            tables = []
+            while nodes:
+                node = nodes.pop()
+                if node.get('Node Type') == 'Seq Scan':
+                    tables.append(node['Relation Name'])
+                nodes.extend(node.get('Plans', ()))
+            return tables
+
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            scanned = [SQLITE_SCAN.match(row[-1]) for row in cursor.fetchall()]
+            aliases = {alias: table for table, alias in TABLE_ALIAS.findall(sql)}
+            tables = set(connection.introspection.table_names(cursor))
+            # Subqueries and CTEs are scanned too; only real tables count
+            return [
+                aliases.get(match.group(1), match.group(1))
+                for match in scanned
+                if match and aliases.get(match.group(1), match.group(1)) in tables
+            ]
+
+    raise NotImplementedError(f'Query plans are not supported on {connection.vendor}')
+
+
+class QueryPlanCheck:
+    """Record the hot views' statements and find sequential scans of large tables"""
+
+    def __init__(self, min_rows=10000):
+        self.min_rows = min_rows
+        self.table_rows = {}
+        self.statements = {}
+
+    def views(self, walk):
+        """(name, callable) for every hot view, bound to the benchmark client"""
+        client = walk.client
+        product_id, product_slug, _ = walk.products[0]
+        category = reverse('category_products', args=[walk.category_slugs[0]])
+
+        views = [
+            ('home', lambda: client.get(reverse('home'))),
+            ('home rails', build_home_rails),
+        ]
+        views.extend(
+            (f'category_products ({sort})', lambda sort=sort: client.get(category, {'sort': sort}))
+            for sort in SORTS
+        )
+        if search_enabled():
+            # The icontains fallback used by other databases always scans
+            views.append(('search', lambda: client.get(reverse('search'), {'q': walk.search_terms[0]})))
+        views.extend([
+            ('product_detail', lambda: client.get(reverse('product_detail', args=[product_slug]))),
+            ('add_to_cart', lambda: client.post(reverse('add_to_cart', args=[product_id]), {'quantity': 1})),
+            ('cart', lambda: client.get(reverse('cart'))),
+            ('checkout', lambda: client.get(reverse('checkout'))),
+            ('account_overview', lambda: client.get(reverse('account_overview'))),
+            ('account_orders', lambda: client.get(reverse('account_orders'))),
+            ('account_inbox', lambda: client.get(reverse('account_inbox'))),
+            ('account_reviews', lambda: client.get(reverse('account_reviews'))),
+            ('wishlist', lambda: client.get(reverse('wishlist'))),
+        ])
+        return views
+
+    def record(self):
+        walk = FunnelBenchmark()
+        walk.prepare()
+        for name, view in self.views(walk):
+            statements = self.statements[name] = []
+            with recording(statements):
+                view()
+
+    def rows(self, table):
+        if table not in self.table_rows:
+            with connection.cursor() as cursor:
+                cursor.execute(f'SELECT COUNT(*) FROM {connection.ops.quote_name(table)}')
+                self.table_rows[table] = cursor.fetchone()[0]
+        return self.table_rows[table]
+
+    def run(self):
+        """Findings for every large-table sequential scan, in view order"""
+        findings = []
+        with transaction.atomic():
+            self.record()
+            for name, statements in self.statements.items():
+                for sql, params in statements:
+                    if not EXPLAINED.match(sql):
+                        continue
+                    for table in sequential_scans(sql, params):
+                        if self.rows(table) >= self.min_rows:
+                            findings.append(Finding(name, table, self.rows(table), sql))
+            transaction.set_rollback(True)
+        return findings
@@ -0,0 +1,283 @@
+"""
+Materialized product rankings.
+
+Product rails (the home page, related and vendor products on product pages,
+recommendations in the cart) show the top in-stock products of a category,
+vendor or brand by sales, views, recency or discount. Instead of sorting every
+in-stock product of the scope on each request, the best RANKING_SIZE product
+ids of every scope and metric are stored, with their scores, in the
+product_rankings table. A rail is then one lookup of its rankings and one
+batched fetch of the listed products; the fetch re-checks that they are still
+active and in stock, so between refreshes a rail can only get shorter.
+
+The refresh_rankings command rebuilds every ranking with one window query per
+metric and scope type; category rankings cover the whole subtree. Run it with
+--interval (or from cron) every RANKING_MAX_AGE seconds or less. Between
+rebuilds, reserve_stock/restore_stock and product saves merge the new scores
+of the products they touched into the vendor and brand rankings those
+products belong to (update_rankings). Category and catalog-wide 'all'
+rankings are only rebuilt: a product is in every ranking of its category's
+ancestors, so every order would otherwise lock the same few top-level rows.
+
+A ranking that does not exist yet is built on first read, and so is one whose
+last full build is older than RANKING_MAX_AGE, in case the command is not
+running; of concurrent readers, the one that claims it rebuilds it while the
+others keep serving the stored entries.
+"""
+
+import heapq
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, FloatField, Q, When, Window
+from django.db.models.functions import Cast, RowNumber
+from django.utils import timezone
+
+from .category_tree import get_category_tree
+from .models import Product, ProductRanking
+
+
+RANKING_SIZE = getattr(settings, 'RANKING_SIZE', 48)
+RANKING_MAX_AGE = getattr(settings, 'RANKING_MAX_AGE', 30 * 60)
+
+IN_STOCK = Q(is_active=True, stock__gt=0)
+
+# metric: (products that qualify, score; higher ranks first)
+METRICS = {
+    'sales': (Q(), F('total_sales')),
+    'views': (Q(), F('views')),
+    'newest': (Q(), F('created_at')),
+    'discount': (
+        Q(compare_price__gt=F('price')),
+        Cast(F('compare_price') - F('price'), FloatField()) / Cast('compare_price', FloatField())
+    ),
+}
+
+# Scopes other than 'all' and the product field that places a product in them
+SCOPE_FIELDS = {
+    'category': 'category_id',
+    'vendor': 'vendor_id',
+    'brand': 'brand_id',
+}
+
+# Candidates fetched per rail, relative to its length, to cover products
+# that sold out since the ranking was stored
+OVERFETCH = 2
+
+
+class Rail(namedtuple('Rail', 'scope scope_ids metric limit exclude min_score', defaults=((), None))):
+    """
+    Up to ``limit`` products from the rankings of ``scope_ids`` (merged by
+    score), skipping the product ids in ``exclude`` and scores below
+    ``min_score``. The 'all' scope has the single scope id 0.
+    """
+    __slots__ = ()
+
+
+def _plain(score):
+    """Scores as stored in JSON: numbers, with timestamps for dates"""
+    if isinstance(score, datetime):
+        return score.timestamp()
+    return score
+
+
+def _best_first(entry):
+    return -entry[1], entry[0]
+
+
+def ranked_queryset(metric):
+    """In-stock products that qualify for ``metric``, annotated with their ``score``"""
+    condition, score = METRICS[metric]
+    return Product.objects.filter(IN_STOCK, condition).annotate(score=score)
+
+
+def build_ranking(scope, scope_id, metric, size=RANKING_SIZE):
+    """Compute one ranking from the products table"""
+    products = ranked_queryset(metric)
+    if scope == 'category':
+        products = products.filter(category_id__in=get_category_tree().descendant_ids(scope_id))
+    elif scope != 'all':
+        products = products.filter(**{SCOPE_FIELDS[scope]: scope_id})
+    ranked = products.order_by('-score', 'id').values_list('id', 'score')[:size]
+    return [[product_id, _plain(score)] for product_id, score in ranked]
+
+
+def rebuild_rankings(size=RANKING_SIZE):
+    """Recompute every ranking; returns the number of rankings written"""
+    tree = get_category_tree()
+    now = timezone.now()
+    rankings = []
+
+    for metric in METRICS:
+        for scope, field in SCOPE_FIELDS.items():
+            partitions = defaultdict(list)
+            for scope_id, product_id, score in ranked_queryset(metric).annotate(
+                position=Window(
+                    RowNumber(),
+                    partition_by=F(field),
+                    order_by=[F('score').desc(), F('id').asc()]
+                )
+            ).filter(position__lte=size).values_list(field, 'id', 'score'):
+                partitions[scope_id].append([product_id, _plain(score)])
+
+            if scope == 'category':
+                # Top products overall and of each subtree are among the top
+                # products of the categories they span
+                rankings.append(('all', 0, metric, heapq.nsmallest(
+                    size, (entry for entries in partitions.values() for entry in entries), key=_best_first
+                )))
+                partitions = {
+                    category_id: heapq.nsmallest(size, (
+                        entry
+                        for descendant_id in tree.descendant_ids(category_id)
+                        for entry in partitions.get(descendant_id, ())
+                    ), key=_best_first)
+                    for category_id in tree.listed_ids
+                }
+            rankings.extend(
+                (scope, scope_id, metric, entries)
+                for scope_id, entries in partitions.items() if scope_id is not None
+            )
+
+    with transaction.atomic():
+        ProductRanking.objects.bulk_create(
+            [
+                ProductRanking(scope=scope, scope_id=scope_id, metric=metric, entries=entries, refreshed_at=now)
+                for scope, scope_id, metric, entries in rankings
+            ],
+            batch_size=500,
+            update_conflicts=True,
+            unique_fields=['scope', 'scope_id', 'metric'],
+            update_fields=['entries', 'refreshed_at']
+        )
+        # Scopes that no longer have any qualifying products
+        ProductRanking.objects.filter(refreshed_at__lt=now).update(entries=[], refreshed_at=now)
+    return len(rankings)
+
+
+def _ranking_filter(keys):
+    condition = Q()
+    for scope, scope_id, metric in keys:
+        condition |= Q(scope=scope, scope_id=scope_id, metric=metric)
+    return condition
+
+
+def get_rankings(keys):
+    """
+    {(scope, scope_id, metric): [[product_id, score], ...]}, building missing
+    rankings and rebuilding those older than RANKING_MAX_AGE
+    """
+    keys = set(keys)
+    if not keys:
+        return {}
+
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=RANKING_MAX_AGE)
+    rankings = {}
+    for pk, scope, scope_id, metric, entries, refreshed_at in ProductRanking.objects.filter(
+        _ranking_filter(keys)
+    ).values_list('pk', 'scope', 'scope_id', 'metric', 'entries', 'refreshed_at'):
+        # Claiming the ranking first keeps concurrent readers from all rebuilding it
+        if refreshed_at < stale_before and ProductRanking.objects.filter(
+            pk=pk, refreshed_at=refreshed_at
+        ).update(refreshed_at=now):
+            entries = build_ranking(scope, scope_id, metric)
+            ProductRanking.objects.filter(pk=pk).update(entries=entries)
+        rankings[scope, scope_id, metric] = entries
+
+    missing = keys - rankings.keys()
+    if missing:
+        built = [
+            ProductRanking(
+                scope=scope, scope_id=scope_id, metric=metric,
+                entries=build_ranking(scope, scope_id, metric), refreshed_at=now
+            )
+            for scope, scope_id, metric in missing
+        ]
+        ProductRanking.objects.bulk_create(built, ignore_conflicts=True)
+        rankings.update(
+            ((ranking.scope, ranking.scope_id, ranking.metric), ranking.entries) for ranking in built
+        )
+    return rankings
+
+
+def ranked_products(*rails):
+    """
+    Products for each Rail, in rank order, with one lookup of all their
+    rankings and one fetch of all their products. Returns one list per rail.
+    """
+    rankings = get_rankings(
+        (rail.scope, scope_id, rail.metric)
+        for rail in rails for scope_id in rail.scope_ids if scope_id is not None
+    )
+
+    candidates = []
+    for rail in rails:
+        exclude = set(rail.exclude)
+        scores = {}
+        for scope_id in rail.scope_ids:
+            for product_id, score in rankings.get((rail.scope, scope_id, rail.metric), ()):
+                if product_id in exclude or (rail.min_score is not None and score < rail.min_score):
+                    continue
+                scores[product_id] = max(score, scores.get(product_id, score))
+        candidates.append(
+            heapq.nsmallest(rail.limit * OVERFETCH, scores, key=lambda product_id: (-scores[product_id], product_id))
+        )
+
+    wanted = {product_id for product_ids in candidates for product_id in product_ids}
+    products = {}
+    if wanted:
+        products = {
+            product.id: product
+            for product in Product.objects.filter(IN_STOCK, pk__in=wanted).prefetch_related('images')
+        }
+    return [
+        [products[product_id] for product_id in product_ids if product_id in products][:rail.limit]
+        for rail, product_ids in zip(rails, candidates)
+    ]
+
+
+def update_rankings(product_ids, metrics=None, size=RANKING_SIZE):
+    """
+    Merge the current scores of ``product_ids`` into the existing rankings of
+    their scopes: products move, enter or (when they no longer qualify) leave.
+    A product that falls behind one just outside a full ranking keeps its place
+    until the next rebuild, as do products moved to another scope. Only vendor
+    and brand rankings are updated; category and 'all' rankings are left to
+    the rebuild.
+    """
+    product_ids = set(product_ids)
+    metrics = metrics or tuple(METRICS)
+    if not product_ids:
+        return
+
+    products = Product.objects.filter(pk__in=product_ids).annotate(**{
+        f'{metric}_score': Case(When(IN_STOCK & METRICS[metric][0], then=METRICS[metric][1]), default=None)
+        for metric in metrics
+    }).values_list('id', 'vendor_id', 'brand_id', *(f'{metric}_score' for metric in metrics))
+
+    scores = defaultdict(dict)
+    for product_id, vendor_id, brand_id, *product_scores in products:
+        scope_ids = [('vendor', vendor_id), ('brand', brand_id)]
+        for metric, score in zip(metrics, product_scores):
+            for scope, scope_id in scope_ids:
+                if scope_id is not None:
+                    scores[scope, scope_id, metric][product_id] = _plain(score)
+    if not scores:
+        return
+
+    with transaction.atomic():
+        changed = []
+        for ranking in ProductRanking.objects.select_for_update().filter(_ranking_filter(scores)).order_by('pk'):
+            entries = dict(ranking.entries)
+            for product_id, score in scores[ranking.scope, ranking.scope_id, ranking.metric].items():
+                if score is None:
+                    entries.pop(product_id, None)
+                else:
+                    entries[product_id] = score
+            ranking.entries = [list(entry) for entry in heapq.nsmallest(size, entries.items(), key=_best_first)]
+            changed.append(ranking)
+        # refreshed_at stays the time of the last full build, which RANKING_MAX_AGE bounds
+        ProductRanking.objects.bulk_update(changed, ['entries'])
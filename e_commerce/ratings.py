@@ -0,0 +1,95 @@
+"""
+Denormalized product rating aggregates.
+
+Product keeps rating_avg, rating_count and a per-star histogram
+(rating_1_count .. rating_5_count) over its approved reviews. Review signals
+apply deltas with a single UPDATE, and rebuild_product_ratings()
+recomputes everything from the reviews table (see the rebuild_ratings
+management command).
+"""
+
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Q, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+from .models import Product, Review
+
+
+STARS = (1, 2, 3, 4, 5)
+
+
+def histogram_field(star):
+    return f'rating_{star}_count'
+
+
+def apply_rating_change(product_id, removed=None, added=None):
+    """
+    Move one approved rating out of and/or into a product's aggregates.
+
+    ``removed`` and ``added`` are star values (or None). The new average is
+    computed from the updated histogram inside the same UPDATE, so concurrent
+    reviews on the same product never overwrite each other.
+    """
+    if removed == added:
+        return
+
+    deltas = {star: 0 for star in STARS}
+    if removed:
+        deltas[removed] -= 1
+    if added:
+        deltas[added] += 1
+
+    new_counts = {star: F(histogram_field(star)) + deltas[star] for star in STARS}
+    new_total = sum(new_counts.values(), Value(0))
+    new_sum = sum((star * new_counts[star] for star in STARS), Value(0))
+
+    updates = {histogram_field(star): new_counts[star] for star in STARS if deltas[star]}
+    updates['rating_count'] = F('rating_count') + sum(deltas.values())
+    updates['rating_avg'] = Coalesce(
+        Cast(new_sum, FloatField()) / NullIf(Cast(new_total, FloatField()), Value(0.0)),
+        Value(0.0),
+    )
+
+    Product.objects.filter(pk=product_id).update(**updates)
+
+
+def rebuild_product_ratings(product_ids=None, batch_size=1000):
+    """Recompute rating aggregates from approved reviews"""
+    products = Product.objects.all()
+    reviews = Review.objects.filter(is_approved=True)
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+        reviews = reviews.filter(product_id__in=product_ids)
+
+    stats = reviews.values('product_id').annotate(
+        total=Count('id'),
+        **{f'star_{star}': Count('id', filter=Q(rating=star)) for star in STARS}
+    ).order_by('product_id')
+
+    fields = ['rating_avg', 'rating_count'] + [histogram_field(star) for star in STARS]
+    reset = {field: 0 for field in fields}
+
+    updated = 0
+    with transaction.atomic():
+        products.update(**reset)
+
+        batch = []
+        for row in stats.iterator(chunk_size=batch_size):
+            product = Product(pk=row['product_id'], rating_count=row['total'])
+            rating_sum = 0
+            for star in STARS:
+                setattr(product, histogram_field(star), row[f'star_{star}'])
+                rating_sum += star * row[f'star_{star}']
+            product.rating_avg = round(rating_sum / row['total'], 2)
+            batch.append(product)
+
+            if len(batch) >= batch_size:
+                Product.objects.bulk_update(batch, fields)
+                updated += len(batch)
+                batch = []
+
+        if batch:
+            Product.objects.bulk_update(batch, fields)
+            updated += len(batch)
+
+    return updated
@@ -0,0 +1,137 @@
+"""
+M-Pesa payment reconciliation.
+
+A payment whose STK callback never arrives stays in ``processing``. The
+reconcile_mpesa_payments command sweeps those payments once they are older
+than MPESA_RECONCILE_AFTER seconds: it walks them in id-ordered batches,
+queries Daraja for each through a bounded thread pool (sharing one rate
+limit, so a large backlog cannot trip Daraja's throttling), and applies the
+answers in one transaction per batch exactly like callbacks are applied.
+Payments Daraja still reports as in progress are left for the next sweep.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Payment
+from .mpesa import DarajaUnavailable, daraja, get_access_token, query_stk_status
+from .mpesa_callbacks import apply_stk_result, save_applied
+
+
+logger = logging.getLogger(__name__)
+
+MPESA_RECONCILE_AFTER = getattr(settings, 'MPESA_RECONCILE_AFTER', 5 * 60)
+MPESA_RECONCILE_BATCH_SIZE = getattr(settings, 'MPESA_RECONCILE_BATCH_SIZE', 100)
+MPESA_RECONCILE_WORKERS = getattr(settings, 'MPESA_RECONCILE_WORKERS', 4)
+MPESA_RECONCILE_RATE = getattr(settings, 'MPESA_RECONCILE_RATE', 10)
+
+
+class RateLimiter:
+    """Spaces calls ``1 / rate`` seconds apart across all threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Reconciler:
+    """One sweep over the stale processing M-Pesa payments"""
+
+    def __init__(self, older_than=MPESA_RECONCILE_AFTER, batch_size=MPESA_RECONCILE_BATCH_SIZE,
+                 workers=MPESA_RECONCILE_WORKERS, rate=MPESA_RECONCILE_RATE, stdout=None):
+        self.older_than = older_than
+        self.batch_size = batch_size
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.stdout = stdout
+        self.stats = {'queried': 0, 'completed': 0, 'failed': 0, 'in_progress': 0, 'errors': 0}
+
+    def stale_payments(self):
+        cutoff = timezone.now() - timedelta(seconds=self.older_than)
+        return Payment.objects.filter(
+            payment_method='mpesa',
+            status='processing',
+            created_at__lt=cutoff
+        ).exclude(checkout_request_id='')
+
+    def query(self, checkout_request_id):
+        """(checkout_request_id, Daraja result, {} while still in progress, or None on errors)"""
+        self.limiter.wait()
+        # Cached; refreshed ahead of expiry during long sweeps
+        access_token = get_access_token()
+        if not access_token:
+            return checkout_request_id, None
+        try:
+            result = query_stk_status(checkout_request_id, access_token)
+        except (DarajaUnavailable, ValueError) as e:
+            logger.warning('STK query for %s failed: %s', checkout_request_id, e)
+            return checkout_request_id, None
+        if result.get('ResultCode') in (None, ''):
+            # errorCode 500.001.1001: the customer has not answered yet
+            return checkout_request_id, {}
+        return checkout_request_id, result
+
+    def apply(self, results):
+        """Apply query results to payments that are still processing"""
+        answered = {checkout_request_id: result for checkout_request_id, result in results if result}
+        if not answered:
+            return
+        now = timezone.now()
+        with transaction.atomic():
+            changed = []
+            for payment in (
+                Payment.objects.select_for_update()
+                .select_related('order')
+                .filter(checkout_request_id__in=answered, status='processing')
+            ):
+                result = answered[payment.checkout_request_id]
+                if apply_stk_result(payment, result, result, now):
+                    changed.append(payment)
+                    self.stats[payment.status] += 1
+            save_applied(changed)
+
+    def run(self):
+        if not get_access_token():
+            raise RuntimeError('Could not get an M-Pesa access token')
+
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='stk-query') as pool:
+            while True:
+                batch = list(
+                    self.stale_payments().filter(pk__gt=last_id)
+                    .order_by('pk')
+                    .values_list('pk', 'checkout_request_id')[:self.batch_size]
+                )
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+
+                results = list(pool.map(self.query, [checkout_request_id for _, checkout_request_id in batch]))
+                self.stats['queried'] += len(results)
+                self.stats['errors'] += sum(1 for _, result in results if result is None)
+                self.stats['in_progress'] += sum(1 for _, result in results if result == {})
+                self.apply(results)
+
+                if self.stdout:
+                    self.stdout.write(
+                        '  {queried} queried, {completed} completed, {failed} failed, '
+                        '{in_progress} in progress, {errors} errors'.format(**self.stats)
+                    )
+
+        return {**self.stats, 'stk_query': daraja.metrics()['endpoints'].get('stk_query')}
@@ -0,0 +1,53 @@
+"""
+Which products has a user reviewed?
+
+Order pages, the pending-reviews page, product pages and review submission
+all need this for one user and several products. The ids of every product
+the user has reviewed are loaded with one query and cached per user as a
+frozenset, so each check is a set lookup. Review saves and deletes call
+invalidate_reviewed_products().
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Review
+
+
+REVIEWED_PRODUCTS_TTL = getattr(settings, 'REVIEWED_PRODUCTS_TTL', 60 * 60)
+
+
+def reviewed_products_key(user_id):
+    return f'reviewed_products:user:{user_id}'
+
+
+def reviewed_product_ids(user, refresh=False):
+    """
+    frozenset of the ids of products ``user`` has reviewed (approved or not).
+    ``refresh`` reads the database instead of the cache, for write paths.
+    """
+    if not user.is_authenticated:
+        return frozenset()
+
+    key = reviewed_products_key(user.pk)
+    product_ids = None if refresh else cache.get(key)
+    if product_ids is None:
+        product_ids = frozenset(Review.objects.filter(user_id=user.pk).values_list('product_id', flat=True))
+        cache.set(key, product_ids, timeout=REVIEWED_PRODUCTS_TTL)
+    return product_ids
+
+
+def has_reviewed(user, product_id, refresh=False):
+    return product_id in reviewed_product_ids(user, refresh=refresh)
+
+
+def unreviewed(user, product_ids):
+    """The ``product_ids`` the user has not reviewed yet, in order"""
+    reviewed = reviewed_product_ids(user)
+    return [product_id for product_id in product_ids if product_id not in reviewed]
+
+
+def invalidate_reviewed_products(user_id):
+    """Drop the cached set once the current transaction commits"""
+    transaction.on_commit(lambda: cache.delete(reviewed_products_key(user_id)))
@@ -0,0 +1,156 @@
+"""
+Product search.
+
+On PostgreSQL every product carries a weighted ``search_vector`` built from
+its name, brand, category, specifications and description. Signals refresh
+it when a product or its specifications change, and the rebuild_search_index
+command fills it in bulk. Queries prefix-match every term against the vector
+and rank by text relevance blended with total_sales. When nothing matches,
+similar_products() looks for trigram word similarity on the product name
+instead, to tolerate typos; callers decide that from the page of results they
+already fetched, so a search that matches costs no extra query.
+
+Other databases fall back to the original icontains matching.
+"""
+
+import re
+
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (
+    SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+)
+from django.db import connection
+from django.db.models import (
+    ExpressionWrapper, F, FloatField, OuterRef, Q, Subquery, TextField, Value
+)
+from django.db.models.functions import Coalesce, Concat, Ln
+
+from .models import Brand, Category, Product, ProductSpecification
+
+
+SEARCH_CONFIG = getattr(settings, 'SEARCH_CONFIG', 'english')
+SEARCH_SALES_WEIGHT = getattr(settings, 'SEARCH_SALES_WEIGHT', 0.1)
+
+# Product fields that feed the search document
+SEARCH_FIELDS = {'name', 'short_description', 'description', 'brand', 'category'}
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def search_enabled():
+    return connection.vendor == 'postgresql'
+
+
+def search_document():
+    """Weighted tsvector expression for Product, usable in update()"""
+    brand_name = Subquery(
+        Brand.objects.filter(pk=OuterRef('brand_id')).values('name')[:1]
+    )
+    category_name = Subquery(
+        Category.objects.filter(pk=OuterRef('category_id')).order_by().values('name')[:1]
+    )
+    specifications = Subquery(
+        ProductSpecification.objects.filter(
+            product_id=OuterRef('pk')
+        ).order_by().values('product_id').annotate(
+            text=StringAgg(Concat('name', Value(' '), 'value'), delimiter=' ')
+        ).values('text')[:1]
+    )
+
+    return (
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector(Coalesce(brand_name, Value(''), output_field=TextField()), weight='A', config=SEARCH_CONFIG)
+        + SearchVector(Coalesce(category_name, Value(''), output_field=TextField()), weight='B', config=SEARCH_CONFIG)
+        + SearchVector(Coalesce(specifications, Value(''), output_field=TextField()), weight='C', config=SEARCH_CONFIG)
+        + SearchVector('short_description', 'description', weight='D', config=SEARCH_CONFIG)
+    )
+
+
+def refresh_search_vectors(queryset):
+    """Recompute search_vector for every product in ``queryset``"""
+    if not search_enabled():
+        return 0
+    return queryset.order_by().update(search_vector=search_document())
+
+
+def rebuild_search_index(batch_size=10000, stdout=None):
+    """Refresh every product's search vector in primary key batches"""
+    if not search_enabled():
+        return 0
+
+    updated = 0
+    last_id = 0
+    while True:
+        batch_ids = list(
+            Product.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not batch_ids:
+            break
+        updated += refresh_search_vectors(
+            Product.objects.filter(pk__gte=batch_ids[0], pk__lte=batch_ids[-1])
+        )
+        last_id = batch_ids[-1]
+        if stdout:
+            stdout.write(f'  indexed {updated} products')
+    return updated
+
+
+def popularity():
+    """Multiplier that lifts better-selling products among similar matches"""
+    return Value(1.0) + Value(float(SEARCH_SALES_WEIGHT)) * Ln(F('total_sales') + 1)
+
+
+def parse_terms(text):
+    return TERM_RE.findall(text.lower())
+
+
+def search_products(text, queryset=None):
+    """Return products matching every term of ``text``, best matches first"""
+    if queryset is None:
+        queryset = Product.objects.filter(is_active=True)
+
+    terms = parse_terms(text)
+    if not terms:
+        return queryset.none()
+
+    if not search_enabled():
+        return queryset.filter(
+            Q(name__icontains=text) |
+            Q(description__icontains=text) |
+            Q(brand__name__icontains=text) |
+            Q(category__name__icontains=text)
+        ).distinct().order_by('-total_sales', 'id')
+
+    # Every term must match, each as a word prefix
+    query = SearchQuery(
+        ' & '.join(f'{term}:*' for term in terms),
+        search_type='raw',
+        config=SEARCH_CONFIG
+    )
+    return queryset.filter(search_vector=query).annotate(
+        rank=ExpressionWrapper(
+            SearchRank(F('search_vector'), query) * popularity(),
+            output_field=FloatField()
+        )
+    ).order_by('-rank', '-total_sales', 'id')
+
+
+def similar_products(text, queryset=None):
+    """
+    Products with a word of the name spelled like ``text``, for searches that
+    matched nothing. Similarity to the whole name would be diluted by the
+    other words. Empty on databases without pg_trgm.
+    """
+    if queryset is None:
+        queryset = Product.objects.filter(is_active=True)
+
+    if not parse_terms(text) or not search_enabled():
+        return queryset.none()
+
+    return queryset.filter(name__trigram_word_similar=text).annotate(
+        rank=ExpressionWrapper(
+            TrigramWordSimilarity(text, 'name') * popularity(),
+            output_field=FloatField()
+        )
+    ).order_by('-rank', '-total_sales', 'id')
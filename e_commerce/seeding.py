@@ -0,0 +1,395 @@
+"""
+Bulk generator for load-test catalogs.
+
+CatalogGenerator grows the database to ``scale`` generated products together
+with shoppers, specifications, variants, reviews, orders (with items and
+payments) and carts, all written with bulk_create. Work is split into chunks
+of ``batch_size`` rows, each seeded from (seed, kind, chunk start), so the
+same seed always produces the same data whether the chunks run in one process
+or are spread over ``workers`` forked processes. Re-running with a larger
+scale only adds what is missing.
+
+bulk_create bypasses model signals, so rating aggregates are computed while
+generating and the search index and caches are refreshed once at the end.
+"""
+
+import multiprocessing
+import random
+import time
+from collections import Counter
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection, connections, transaction
+
+from .facets import invalidate_all_facets
+from .home_rails import invalidate_home_rails
+from .models import (
+    Brand, Cart, CartItem, Category, Order, OrderItem, Payment, PickupStation,
+    Product, ProductSpecification, ProductVariant, Review, User, Vendor
+)
+from .ratings import STARS, histogram_field
+from .search import rebuild_search_index, search_enabled
+
+
+PRODUCT_SKU_PREFIX = 'GEN-'
+ORDER_NUMBER_PREFIX = 'GEN-'
+SHOPPER_PREFIX = 'gen_shopper'
+
+# Generated rows per product
+SHOPPERS_PER_PRODUCT = 1 / 20
+ORDERS_PER_PRODUCT = 1 / 10
+CARTS_PER_PRODUCT = 1 / 50
+VARIANT_SHARE = 0.3
+
+ADJECTIVES = [
+    'Classic', 'Smart', 'Ultra', 'Compact', 'Pro', 'Lite', 'Max', 'Eco',
+    'Premium', 'Portable', 'Wireless', 'Digital', 'Deluxe', 'Mini', 'Plus'
+]
+NOUNS = {
+    'Televisions': ['LED TV', 'Smart TV', 'QLED TV', 'Android TV'],
+    'Audio & Sound': ['Soundbar', 'Speaker', 'Headphones', 'Earbuds', 'Subwoofer'],
+    'Cameras': ['Camera', 'Action Camera', 'Webcam', 'Tripod'],
+    'Smartphones': ['Smartphone', 'Phone', 'Feature Phone'],
+    'Tablets': ['Tablet', 'Kids Tablet', 'E-Reader'],
+    'Phone Accessories': ['Charger', 'Power Bank', 'Phone Case', 'USB Cable'],
+    'Men\'s Fashion': ['Shirt', 'Trousers', 'Jacket', 'Polo'],
+    'Women\'s Fashion': ['Dress', 'Blouse', 'Skirt', 'Handbag'],
+    'Kids Fashion': ['T-Shirt', 'Shorts', 'School Bag'],
+    'Shoes': ['Sneakers', 'Sandals', 'Boots', 'Loafers'],
+    'Kitchen Appliances': ['Blender', 'Microwave', 'Kettle', 'Cooker', 'Fridge'],
+    'Furniture': ['Sofa', 'Office Chair', 'Coffee Table', 'Bookshelf'],
+    'Bedding': ['Duvet', 'Bedsheet Set', 'Pillow', 'Mattress'],
+    'Laptops': ['Laptop', 'Notebook', 'Ultrabook'],
+    'Desktops': ['Desktop', 'All-in-One PC', 'Monitor'],
+    'Computer Accessories': ['Mouse', 'Keyboard', 'Flash Drive', 'Router'],
+}
+SPECIFICATIONS = {
+    'Warranty': ['6 Months', '1 Year', '2 Years'],
+    'Colour': ['Black', 'White', 'Silver', 'Blue', 'Red', 'Grey'],
+    'Origin': ['China', 'Kenya', 'India', 'Vietnam', 'South Korea'],
+    'Weight': ['Under 1kg', '1-3kg', '3-10kg', 'Over 10kg'],
+    'Power': ['Battery', 'Mains', 'USB', 'None'],
+    'Material': ['Plastic', 'Metal', 'Cotton', 'Leather', 'Glass'],
+}
+VARIANT_COLOURS = ['Black', 'White', 'Blue', 'Red', 'Green']
+FIRST_NAMES = ['John', 'Mary', 'Peter', 'Grace', 'David', 'Faith', 'James', 'Ann', 'Brian', 'Mercy']
+LAST_NAMES = ['Kamau', 'Wanjiku', 'Omondi', 'Akinyi', 'Mwangi', 'Njeri', 'Otieno', 'Chebet', 'Kiprop', 'Mutua']
+REVIEW_TEXT = {
+    5: ('Excellent product!', 'Very satisfied with this purchase. Quality is top-notch.'),
+    4: ('Good value for money', 'Works as expected. Would buy again.'),
+    3: ('Decent product', 'Does the job but nothing exceptional.'),
+    2: ('Not great', 'Quality is lower than I expected.'),
+    1: ('Disappointed', 'Stopped working after a week.'),
+}
+ORDER_STATUSES = ['pending', 'confirmed', 'processing', 'shipped', 'delivered', 'cancelled']
+ORDER_STATUS_WEIGHTS = [10, 10, 10, 15, 50, 5]
+
+# Set in each worker (or the parent when running in-process)
+_context = None
+
+
+def _init_worker(context):
+    global _context
+    _context = context
+
+
+def _rng(kind, start):
+    return random.Random(f"{_context['seed']}:{kind}:{start}")
+
+
+def _shopper_chunk(bounds):
+    start, end = bounds
+    rng = _rng('shoppers', start)
+    users = [
+        User(
+            username=f'{SHOPPER_PREFIX}{n}',
+            email=f'{SHOPPER_PREFIX}{n}@example.com',
+            phone_number=f'+2547{n:08d}',
+            first_name=rng.choice(FIRST_NAMES),
+            last_name=rng.choice(LAST_NAMES),
+            password=_context['password'],
+        )
+        for n in range(start, end)
+    ]
+    User.objects.bulk_create(users, batch_size=_context['batch_size'])
+    return len(users)
+
+
+def _product_chunk(bounds):
+    start, end = bounds
+    rng = _rng('products', start)
+    shoppers = _context['shoppers']
+
+    products = []
+    ratings = []
+    for n in range(start, end):
+        category_id, nouns = rng.choice(_context['categories'])
+        brand_id, brand_name = rng.choice(_context['brands'])
+        name = f'{brand_name} {rng.choice(ADJECTIVES)} {rng.choice(nouns)} {n}'
+        price = Decimal(rng.randrange(199, 250000))
+
+        # Reviews are decided first so the product row carries its aggregates
+        reviewers = rng.sample(shoppers, min(rng.choice((0, 0, 1, 2, 3, 5)), len(shoppers)))
+        stars = [rng.choices(STARS, weights=(1, 1, 3, 6, 9))[0] for _ in reviewers]
+        histogram = Counter(stars)
+
+        product = Product(
+            vendor_id=rng.choice(_context['vendors']),
+            category_id=category_id,
+            brand_id=brand_id,
+            name=name,
+            slug=f'generated-product-{n}',
+            sku=f'{PRODUCT_SKU_PREFIX}{n:08d}',
+            description=f'{name}. Genuine {brand_name} product with official warranty, delivered across Kenya.',
+            short_description=f'Genuine {brand_name}, official warranty',
+            price=price,
+            compare_price=(price * Decimal('1.25')).quantize(Decimal('1')) if rng.random() < 0.5 else None,
+            stock=rng.randint(0, 500),
+            is_featured=rng.random() < 0.02,
+            views=rng.randint(0, 5000),
+            total_sales=rng.randint(0, 1000),
+            rating_count=len(stars),
+            rating_avg=(Decimal(sum(stars)) / len(stars)).quantize(Decimal('0.01')) if stars else Decimal('0'),
+        )
+        for star in STARS:
+            setattr(product, histogram_field(star), histogram[star])
+        products.append(product)
+        ratings.append(list(zip(reviewers, stars)))
+
+    batch_size = _context['batch_size']
+    with transaction.atomic():
+        Product.objects.bulk_create(products, batch_size=batch_size)
+
+        specifications = []
+        variants = []
+        reviews = []
+        for product, product_ratings in zip(products, ratings):
+            for order, spec_name in enumerate(rng.sample(sorted(SPECIFICATIONS), 4)):
+                specifications.append(ProductSpecification(
+                    product_id=product.pk,
+                    name=spec_name,
+                    value=rng.choice(SPECIFICATIONS[spec_name]),
+                    order=order
+                ))
+            if rng.random() < VARIANT_SHARE:
+                for i, colour in enumerate(rng.sample(VARIANT_COLOURS, 3)):
+                    variants.append(ProductVariant(
+                        product_id=product.pk,
+                        name=f'Colour: {colour}',
+                        sku=f'{product.sku}-V{i}',
+                        stock=rng.randint(0, 100)
+                    ))
+            for user_id, star in product_ratings:
+                title, comment = REVIEW_TEXT[star]
+                reviews.append(Review(
+                    product_id=product.pk,
+                    user_id=user_id,
+                    rating=star,
+                    title=title,
+                    comment=comment,
+                    is_verified_purchase=rng.random() < 0.5,
+                    is_approved=True,
+                    helpful_count=rng.randint(0, 25)
+                ))
+
+        ProductSpecification.objects.bulk_create(specifications, batch_size=batch_size)
+        ProductVariant.objects.bulk_create(variants, batch_size=batch_size)
+        Review.objects.bulk_create(reviews, batch_size=batch_size)
+
+    return len(products) + len(specifications) + len(variants) + len(reviews)
+
+
+def _sample_products(rng, counts):
+    """Look up one random generated product per entry of ``counts``"""
+    numbers = [rng.randrange(_context['products']) for _ in counts]
+    skus = {f'{PRODUCT_SKU_PREFIX}{n:08d}' for n in numbers}
+    rows = {
+        sku: (pk, price, vendor_id, name, sku)
+        for sku, pk, price, vendor_id, name in Product.objects.filter(sku__in=skus).values_list(
+            'sku', 'pk', 'price', 'vendor_id', 'name'
+        )
+    }
+    return [rows.get(f'{PRODUCT_SKU_PREFIX}{n:08d}') for n in numbers]
+
+
+def _order_chunk(bounds):
+    start, end = bounds
+    rng = _rng('orders', start)
+
+    lines = [rng.randint(1, 4) for _ in range(start, end)]
+    sampled = iter(_sample_products(rng, range(sum(lines))))
+
+    orders = []
+    order_lines = []
+    for n, line_count in zip(range(start, end), lines):
+        items = [(row, rng.randint(1, 3)) for row in (next(sampled) for _ in range(line_count)) if row]
+        if not items:
+            continue
+        subtotal = sum(row[1] * quantity for row, quantity in items)
+        delivery_fee = Decimal(rng.choice((0, 150, 200, 300)))
+        orders.append(Order(
+            order_number=f'{ORDER_NUMBER_PREFIX}{n:010d}',
+            user_id=rng.choice(_context['shoppers']),
+            status=rng.choices(ORDER_STATUSES, weights=ORDER_STATUS_WEIGHTS)[0],
+            delivery_method='pickup_station',
+            pickup_station_id=rng.choice(_context['stations']),
+            subtotal=subtotal,
+            delivery_fee=delivery_fee,
+            total=subtotal + delivery_fee,
+        ))
+        order_lines.append(items)
+
+    batch_size = _context['batch_size']
+    with transaction.atomic():
+        Order.objects.bulk_create(orders, batch_size=batch_size)
+
+        order_items = []
+        payments = []
+        for order, items in zip(orders, order_lines):
+            for (product_id, price, vendor_id, name, sku), quantity in items:
+                order_items.append(OrderItem(
+                    order_id=order.pk,
+                    product_id=product_id,
+                    vendor_id=vendor_id,
+                    product_name=name,
+                    product_sku=sku,
+                    quantity=quantity,
+                    price=price,
+                    total=price * quantity
+                ))
+            paid = order.status not in ('pending', 'cancelled')
+            payments.append(Payment(
+                order_id=order.pk,
+                transaction_id=f'TXN-{order.order_number}',
+                payment_method=rng.choice(('mpesa', 'mpesa', 'card', 'cash')),
+                status='completed' if paid else order.status,
+                amount=order.total,
+            ))
+
+        OrderItem.objects.bulk_create(order_items, batch_size=batch_size)
+        Payment.objects.bulk_create(payments, batch_size=batch_size)
+
+    return len(orders) + len(order_items) + len(payments)
+
+
+def _cart_chunk(bounds):
+    start, end = bounds
+    rng = _rng('carts', start)
+    shoppers = _context['shoppers'][start:end]
+
+    lines = [rng.randint(1, 3) for _ in shoppers]
+    sampled = iter(_sample_products(rng, range(sum(lines))))
+
+    with transaction.atomic():
+        carts = Cart.objects.bulk_create(
+            [Cart(user_id=user_id) for user_id in shoppers], batch_size=_context['batch_size']
+        )
+        items = []
+        for cart, line_count in zip(carts, lines):
+            seen = set()
+            for _ in range(line_count):
+                row = next(sampled)
+                if row and row[0] not in seen:
+                    seen.add(row[0])
+                    items.append(CartItem(cart_id=cart.pk, product_id=row[0], quantity=rng.randint(1, 3), price=row[1]))
+        CartItem.objects.bulk_create(items, batch_size=_context['batch_size'])
+
+    return len(carts) + len(items)
+
+
+def _chunks(start, end, size):
+    return [(lo, min(lo + size, end)) for lo in range(start, end, size)]
+
+
+class CatalogGenerator:
+    """Grows the database to a load-test catalog of ``scale`` products"""
+
+    def __init__(self, scale, seed=42, batch_size=5000, workers=1, stdout=None):
+        self.scale = scale
+        self.seed = seed
+        self.batch_size = batch_size
+        self.workers = workers
+        self.stdout = stdout
+        self.rows = 0
+
+    def log(self, message):
+        if self.stdout:
+            self.stdout.write(message)
+
+    def run(self):
+        started = time.perf_counter()
+        context = {'seed': self.seed, 'batch_size': self.batch_size, 'products': self.scale}
+
+        shopper_count = max(50, int(self.scale * SHOPPERS_PER_PRODUCT))
+        existing = User.objects.filter(username__startswith=SHOPPER_PREFIX).count()
+        context['password'] = make_password('password123')
+        self.phase('shoppers', _shopper_chunk, existing, shopper_count, context)
+
+        context['shoppers'] = list(
+            User.objects.filter(username__startswith=SHOPPER_PREFIX).order_by('pk').values_list('pk', flat=True)
+        )
+        context['vendors'] = list(Vendor.objects.values_list('pk', flat=True))
+        context['brands'] = list(Brand.objects.filter(is_active=True).values_list('pk', 'name'))
+        context['stations'] = list(PickupStation.objects.filter(is_active=True).values_list('pk', flat=True))
+        context['categories'] = [
+            (pk, NOUNS[name]) for pk, name in Category.objects.filter(name__in=NOUNS).values_list('pk', 'name')
+        ]
+        if not (context['vendors'] and context['brands'] and context['stations'] and context['categories']):
+            raise RuntimeError('Generated catalogs need the base seed data (vendors, brands, categories, stations)')
+
+        existing = Product.objects.filter(sku__startswith=PRODUCT_SKU_PREFIX).count()
+        self.phase('products', _product_chunk, existing, self.scale, context)
+
+        existing = Order.objects.filter(order_number__startswith=ORDER_NUMBER_PREFIX).count()
+        self.phase('orders', _order_chunk, existing, int(self.scale * ORDERS_PER_PRODUCT), context)
+
+        cart_count = min(len(context['shoppers']), int(self.scale * CARTS_PER_PRODUCT))
+        existing = Cart.objects.filter(user__username__startswith=SHOPPER_PREFIX).count()
+        self.phase('carts', _cart_chunk, existing, cart_count, context)
+
+        # bulk_create skips the signals that keep search and caches current
+        if search_enabled():
+            rebuild_search_index(stdout=self.stdout)
+        invalidate_home_rails()
+        invalidate_all_facets()
+
+        elapsed = time.perf_counter() - started
+        self.log(f'✓ Generated {self.rows} rows in {elapsed:.1f}s ({self.rows / elapsed:,.0f} rows/s)')
+        return self.rows
+
+    def phase(self, name, task, start, end, context):
+        if start >= end:
+            self.log(f'  {name}: already at {start}')
+            return
+
+        phase_started = time.perf_counter()
+        chunks = _chunks(start, end, self.batch_size)
+        rows = 0
+        for done, chunk_rows in enumerate(self.map(task, chunks, context), 1):
+            rows += chunk_rows
+            if done % 10 == 0 or done == len(chunks):
+                self.log(f'  {name}: {done}/{len(chunks)} chunks, {rows} rows')
+
+        elapsed = time.perf_counter() - phase_started
+        self.rows += rows
+        self.log(f'✓ {name}: {rows} rows ({rows / elapsed:,.0f} rows/s)')
+
+    def map(self, task, chunks, context):
+        # SQLite allows a single writer, so parallel workers would only contend
+        parallel = (
+            self.workers > 1 and len(chunks) > 1 and connection.vendor != 'sqlite'
+            and 'fork' in multiprocessing.get_all_start_methods()
+        )
+        if not parallel:
+            _init_worker(context)
+            for chunk in chunks:
+                yield task(chunk)
+            return
+
+        # Forked children must not share the parent's database connections
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(
+            self.workers, initializer=_init_worker, initargs=(context,)
+        ) as pool:
+            yield from pool.imap_unordered(task, chunks)
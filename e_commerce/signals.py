@@ -0,0 +1,188 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+
+from .category_tree import invalidate_category_tree
+from .delivery import invalidate_delivery_table
+from .facets import invalidate_all_facets, invalidate_category_facets
+from .home_rails import invalidate_home_rails
+from .models import (
+    Banner, Brand, Category, DeliveryZone, Order, PickupStation, Product,
+    ProductSpecification, Review, Vendor
+)
+from .order_stats import invalidate_order_stats
+from .rankings import update_rankings
+from .ratings import apply_rating_change
+from .reviewed_products import invalidate_reviewed_products
+from .search import SEARCH_FIELDS, refresh_search_vectors
+from .suggest import BRAND, CATEGORY, PRODUCT, index_item, unindex_item
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Banner)
+@receiver(post_delete, sender=Banner)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Vendor)
+@receiver(post_delete, sender=Vendor)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def refresh_home_rails(sender, **kwargs):
+    """Rebuild the home rails when anything they show changes"""
+    update_fields = kwargs.get('update_fields')
+    # View counter bumps only affect ordering; the TTL picks those up
+    if update_fields and set(update_fields) == {'views'}:
+        return
+    invalidate_home_rails()
+
+
+@receiver(pre_save, sender=Review)
+def remember_review_rating(sender, instance, **kwargs):
+    """Keep the stored rating so post_save can apply the difference"""
+    instance._previous_rating = None
+    if instance.pk:
+        previous = Review.objects.filter(pk=instance.pk).values(
+            'product_id', 'rating', 'is_approved'
+        ).first()
+        instance._previous_rating = previous
+
+
+@receiver(post_save, sender=Review)
+def update_product_rating(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_rating', None)
+    added = instance.rating if instance.is_approved else None
+
+    if previous and previous['product_id'] != instance.product_id:
+        if previous['is_approved']:
+            apply_rating_change(previous['product_id'], removed=previous['rating'])
+        previous = None
+
+    removed = previous['rating'] if previous and previous['is_approved'] else None
+    apply_rating_change(instance.product_id, removed=removed, added=added)
+
+
+@receiver(post_delete, sender=Review)
+def remove_product_rating(sender, instance, **kwargs):
+    if instance.is_approved:
+        apply_rating_change(instance.product_id, removed=instance.rating)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def refresh_reviewed_products(sender, instance, **kwargs):
+    invalidate_reviewed_products(instance.user_id)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def refresh_category_tree(sender, **kwargs):
+    invalidate_category_tree()
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def refresh_order_stats(sender, instance, **kwargs):
+    invalidate_order_stats(instance.user_id)
+
+
+@receiver(post_save, sender=DeliveryZone)
+@receiver(post_delete, sender=DeliveryZone)
+@receiver(post_save, sender=PickupStation)
+@receiver(post_delete, sender=PickupStation)
+def refresh_delivery_table(sender, **kwargs):
+    invalidate_delivery_table()
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_search_vector(sender, instance, update_fields=None, **kwargs):
+    # Stock, counter and rating updates leave the search document unchanged
+    if update_fields and not SEARCH_FIELDS.intersection(update_fields):
+        return
+    refresh_search_vectors(Product.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=ProductSpecification)
+@receiver(post_delete, sender=ProductSpecification)
+def refresh_specification_search_vector(sender, instance, **kwargs):
+    refresh_search_vectors(Product.objects.filter(pk=instance.product_id))
+
+
+@receiver(post_save, sender=Brand)
+def refresh_brand_search_vectors(sender, instance, created=False, **kwargs):
+    if not created:
+        refresh_search_vectors(Product.objects.filter(brand=instance))
+
+
+@receiver(post_save, sender=Category)
+def refresh_category_search_vectors(sender, instance, created=False, **kwargs):
+    if not created:
+        refresh_search_vectors(Product.objects.filter(category=instance))
+
+
+@receiver(post_save, sender=Product)
+def update_product_suggestions(sender, instance, **kwargs):
+    index_item(PRODUCT, instance.pk, instance.name, instance.slug, instance.is_active, instance.total_sales)
+
+
+@receiver(post_save, sender=Brand)
+def update_brand_suggestions(sender, instance, **kwargs):
+    index_item(BRAND, instance.pk, instance.name, instance.slug, instance.is_active)
+
+
+@receiver(post_save, sender=Category)
+def update_category_suggestions(sender, instance, **kwargs):
+    index_item(CATEGORY, instance.pk, instance.name, instance.slug, instance.is_active)
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Brand)
+@receiver(post_delete, sender=Category)
+def remove_suggestion(sender, instance, **kwargs):
+    kind = {Product: PRODUCT, Brand: BRAND, Category: CATEGORY}[sender]
+    unindex_item(kind, instance.pk)
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_category(sender, instance, update_fields=None, **kwargs):
+    """Keep the stored category so a moved product leaves its old listing too"""
+    instance._previous_category_id = None
+    if instance.pk and (update_fields is None or {'category', 'category_id'} & set(update_fields)):
+        instance._previous_category_id = Product.objects.filter(pk=instance.pk).values_list(
+            'category_id', flat=True
+        ).first()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def refresh_product_facets(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'views', 'total_sales'}:
+        return
+    invalidate_category_facets(instance.category_id)
+    previous_category_id = getattr(instance, '_previous_category_id', None)
+    if previous_category_id != instance.category_id:
+        invalidate_category_facets(previous_category_id)
+
+
+@receiver(post_save, sender=ProductSpecification)
+@receiver(post_delete, sender=ProductSpecification)
+def refresh_specification_facets(sender, instance, **kwargs):
+    category_id = Product.objects.filter(pk=instance.product_id).values_list('category_id', flat=True).first()
+    invalidate_category_facets(category_id)
+
+
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def refresh_all_facets(sender, **kwargs):
+    invalidate_all_facets()
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_rankings(sender, instance, update_fields=None, **kwargs):
+    # Views are ranked by the periodic rebuild only
+    if update_fields and set(update_fields) == {'views'}:
+        return
+    product_id = instance.pk
+    transaction.on_commit(lambda: update_rankings([product_id]), robust=True)
@@ -0,0 +1,80 @@
+"""
+Process-local snapshots of small, rarely changing tables.
+
+The category tree, the delivery table and the facet indexes keep rows they
+read on every request in process memory. Each snapshot is tagged with a
+version number stored in the shared cache: writes bump the version (see
+signals.py) so every process reloads on its next read, and a TTL bounds
+staleness for writes that bypass signals.
+
+A version that is missing from the cache starts at a random number rather
+than at zero, so after the cache is flushed or evicts the key, no process
+keeps serving a snapshot it loaded before.
+"""
+
+import random
+import threading
+import time
+
+from django.core.cache import cache
+
+
+def current_versions(keys):
+    """Versions of ``keys`` in order, starting missing ones at a random number"""
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, random.getrandbits(31), timeout=None)
+        versions.update(cache.get_many(missing))
+    return tuple(versions.get(key) for key in keys)
+
+
+def current_version(key):
+    return current_versions([key])[0]
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Missing: the next read starts a new random version
+        pass
+
+
+class VersionedSnapshot:
+    """
+    The value of ``load()``, kept in this process until the version under
+    ``version_key`` changes or ``ttl`` seconds have passed.
+    """
+
+    def __init__(self, version_key, load, ttl):
+        self.version_key = version_key
+        self.load = load
+        self.ttl = ttl
+        self._value = None
+        self._version = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _fresh(self, version):
+        return (
+            self._value is not None and self._version == version
+            and time.monotonic() - self._loaded_at < self.ttl
+        )
+
+    def get(self):
+        version = current_version(self.version_key)
+        if self._fresh(version):
+            return self._value
+
+        with self._lock:
+            if not self._fresh(version):
+                self._value = self.load()
+                self._version = version
+                self._loaded_at = time.monotonic()
+            return self._value
+
+    def invalidate(self):
+        """Make every process reload on its next read"""
+        bump_version(self.version_key)
@@ -0,0 +1,375 @@
+"""
+Search-as-you-type suggestions.
+
+Product, brand and category names are held in a process-local prefix index:
+per kind, a sorted list of lowercase keys (one per word suffix of each name,
+so "galaxy" finds "Samsung Galaxy A15") searched with bisect. Suggestions are
+the best matches of the whole match set: exact names first, then by weight
+(sales).
+
+A short prefix matches a large share of the catalog, so the sorted keys are
+cut into blocks of KEY_BLOCK_SIZE and a segment tree over the blocks keeps
+the best SUGGEST_LIMIT items of every block range. A lookup scans at most
+the two blocks at the ends of its match range and merges the lists of
+O(log n) tree nodes for the blocks in between; a change to an item rescans
+only the blocks holding its keys and re-merges their ancestors. Neither
+walks the match set, however large it is.
+
+Signals keep the index current for changes made in this process, and it is
+rebuilt in the background every SUGGEST_INDEX_TTL seconds to pick up changes
+made elsewhere (and to even out blocks grown by additions).
+"""
+
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.db import connection
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from .models import Brand, Category, Product
+
+
+SUGGEST_INDEX_TTL = getattr(settings, 'SUGGEST_INDEX_TTL', 15 * 60)
+SUGGEST_LIMIT = 8
+
+# Keys per block: lookups scan up to two blocks, updates rescan one per key
+KEY_BLOCK_SIZE = 64
+
+PRODUCT = 'product'
+BRAND = 'brand'
+CATEGORY = 'category'
+KINDS = (PRODUCT, BRAND, CATEGORY)
+
+# Sorts after any character a key can hold
+KEY_END = '\U0010ffff'
+
+
+def word_offsets(name):
+    """Where the keys of a normalized name start: 'samsung galaxy a15' -> [0, 8, 15]"""
+    return [0] + [offset + 1 for offset, char in enumerate(name) if char == ' ']
+
+
+class RankedKeys:
+    """
+    The keys of one kind of item in sorted blocks, with a segment tree of the
+    best items of each block range.
+
+    A key is stored as (slot, offset): the item's slot and the offset of the
+    key's first word in the item's lowercase name, so keys take no memory of
+    their own. Keys sort by (key, offset, slot), which puts whole names
+    (offset 0) first among equal keys. Items are numbered by slot in rank
+    order when loaded, so the build ranks by slot alone; changes after that
+    rank with rank().
+    """
+
+    def __init__(self, rows=(), block_size=KEY_BLOCK_SIZE):
+        # [(item_id, name, slug, weight) or None, ...] and lowercase names, by slot
+        self.items = sorted(rows, key=lambda item: (-item[3], item[1], item[0]))
+        self.names = [' '.join(item[1].lower().split()) for item in self.items]
+        self.slot_of = {item[0]: slot for slot, item in enumerate(self.items)}
+
+        slots = array('i')
+        offsets = array('H')
+        for slot, name in enumerate(self.names):
+            for offset in word_offsets(name):
+                slots.append(slot)
+                offsets.append(offset)
+        # Generated in slot order; stable sorts by offset, then key, complete
+        # the (key, offset, slot) order
+        order = sorted(range(len(slots)), key=offsets.__getitem__)
+        order.sort(key=lambda i: self.names[slots[i]][offsets[i]:])
+
+        # Block i holds the keys from bounds[i] up to bounds[i + 1]
+        self.slots = []
+        self.offsets = []
+        self.bounds = []
+        for start in range(0, len(order), block_size):
+            block = order[start:start + block_size]
+            self.slots.append(array('i', [slots[i] for i in block]))
+            self.offsets.append(array('H', [offsets[i] for i in block]))
+            self.bounds.append(self._entry(slots[block[0]], offsets[block[0]]) if start else ('',))
+        if not self.slots:
+            self.slots, self.offsets, self.bounds = [array('i')], [array('H')], [('',)]
+
+        # Leaves from leaves_at on; node n covers nodes 2n and 2n + 1
+        self.leaves_at = 1
+        while self.leaves_at < len(self.slots):
+            self.leaves_at *= 2
+        self.tree = [[] for _ in range(2 * self.leaves_at)]
+        for block, block_slots in enumerate(self.slots):
+            self.tree[self.leaves_at + block] = sorted(set(block_slots))[:SUGGEST_LIMIT]
+        for node in range(self.leaves_at - 1, 0, -1):
+            self.tree[node] = sorted(set(self.tree[2 * node] + self.tree[2 * node + 1]))[:SUGGEST_LIMIT]
+
+    def rank(self, slot):
+        """The heaviest (best selling) items first"""
+        item_id, name, _, weight = self.items[slot]
+        return -weight, name, item_id
+
+    def best(self, *ranked, limit=SUGGEST_LIMIT):
+        """The ``limit`` best distinct slots of lists each sorted best first"""
+        best = []
+        for slot in heapq.merge(*ranked, key=self.rank):
+            if slot not in best:
+                best.append(slot)
+                if len(best) == limit:
+                    break
+        return best
+
+    def get(self, item_id):
+        slot = self.slot_of.get(item_id)
+        return None if slot is None else self.items[slot]
+
+    def _entry(self, slot, offset):
+        """The sort key of a stored key"""
+        return self.names[slot][offset:], offset, slot
+
+    def _place(self, slot, offset):
+        """(block, position) where the key (slot, offset) is or belongs"""
+        entry = self._entry(slot, offset)
+        block = bisect_right(self.bounds, entry) - 1
+        slots, offsets = self.slots[block], self.offsets[block]
+        position = bisect_left(
+            range(len(slots)), entry, key=lambda i: self._entry(slots[i], offsets[i])
+        )
+        return block, position
+
+    def _refresh(self, blocks):
+        """Rebuild the leaves of ``blocks`` and every node above them"""
+        nodes = set()
+        for block in blocks:
+            self.tree[self.leaves_at + block] = heapq.nsmallest(SUGGEST_LIMIT, set(self.slots[block]), key=self.rank)
+            nodes.add((self.leaves_at + block) // 2)
+        while nodes:
+            for node in nodes:
+                self.tree[node] = self.best(self.tree[2 * node], self.tree[2 * node + 1])
+            nodes = {node // 2 for node in nodes if node > 1}
+
+    def add(self, item_id, name, slug, weight):
+        self.remove(item_id)
+        slot = self.slot_of[item_id] = len(self.items)
+        self.items.append((item_id, name, slug, weight))
+        self.names.append(' '.join(name.lower().split()))
+        blocks = set()
+        for offset in word_offsets(self.names[slot]):
+            block, position = self._place(slot, offset)
+            self.slots[block].insert(position, slot)
+            self.offsets[block].insert(position, offset)
+            blocks.add(block)
+        self._refresh(blocks)
+
+    def remove(self, item_id):
+        slot = self.slot_of.pop(item_id, None)
+        if slot is None:
+            return
+        blocks = set()
+        for offset in word_offsets(self.names[slot]):
+            block, position = self._place(slot, offset)
+            slots, offsets = self.slots[block], self.offsets[block]
+            if position < len(slots) and slots[position] == slot and offsets[position] == offset:
+                del slots[position]
+                del offsets[position]
+                blocks.add(block)
+        # Slots are not reused before the next load
+        self.items[slot] = self.names[slot] = None
+        self._refresh(blocks)
+
+    def set_weight(self, item_id, weight):
+        slot = self.slot_of.get(item_id)
+        if slot is not None:
+            item_id, name, slug, _ = self.items[slot]
+            self.items[slot] = (item_id, name, slug, weight)
+            self._refresh({self._place(slot, offset)[0] for offset in word_offsets(self.names[slot])})
+
+    def _matching(self, block, prefix, start):
+        slots, offsets = self.slots[block], self.offsets[block]
+        matches = set()
+        for position in range(start, len(slots)):
+            slot = slots[position]
+            if not self.names[slot].startswith(prefix, offsets[position]):
+                break
+            matches.add(slot)
+        return sorted(matches, key=self.rank)
+
+    def _exact(self, prefix, block, position, limit):
+        """Items named ``prefix``: the whole-name keys heading the match range"""
+        matches = []
+        while block < len(self.slots):
+            slots, offsets = self.slots[block], self.offsets[block]
+            while position < len(slots) and offsets[position] == 0 and self.names[slots[position]] == prefix:
+                matches.append(slots[position])
+                position += 1
+            if position < len(slots):
+                break
+            block, position = block + 1, 0
+        return heapq.nsmallest(limit, matches, key=self.rank)
+
+    def lookup(self, prefix, limit):
+        """Items of the ``limit`` best slots with a key starting with ``prefix``"""
+        # The first and last blocks may hold other keys; those between only matches
+        first = max(bisect_left(self.bounds, (prefix,)) - 1, 0)
+        last = max(bisect_left(self.bounds, (prefix + KEY_END,)) - 1, 0)
+        slots, offsets = self.slots[first], self.offsets[first]
+        start = bisect_left(
+            range(len(slots)), prefix, key=lambda i: self.names[slots[i]][offsets[i]:]
+        )
+        ranked = [self._matching(first, prefix, start)]
+        if last > first:
+            ranked.append(self._matching(last, prefix, 0))
+
+        low, high = self.leaves_at + first + 1, self.leaves_at + last
+        while low < high:
+            if low & 1:
+                ranked.append(self.tree[low])
+                low += 1
+            if high & 1:
+                high -= 1
+                ranked.append(self.tree[high])
+            low //= 2
+            high //= 2
+
+        exact = self._exact(prefix, first, start, limit)
+        best = exact + [slot for slot in self.best(*ranked, limit=limit) if slot not in exact]
+        return [self.items[slot] for slot in best[:limit]]
+
+
+class PrefixIndex:
+    """Prefix index over (kind, id) items with a display name and weight"""
+
+    def __init__(self):
+        self.kinds = {kind: RankedKeys() for kind in KINDS}
+        self.lock = threading.Lock()
+
+    def get(self, kind, item_id):
+        """(item_id, name, slug, weight) of an indexed item, or None"""
+        return self.kinds[kind].get(item_id)
+
+    def add(self, kind, item_id, name, slug, weight=0):
+        with self.lock:
+            self.kinds[kind].add(item_id, name, slug, weight)
+
+    def remove(self, kind, item_id):
+        with self.lock:
+            self.kinds[kind].remove(item_id)
+
+    def set_weight(self, kind, item_id, weight):
+        with self.lock:
+            self.kinds[kind].set_weight(item_id, weight)
+
+    def load(self, rows):
+        """Replace the contents with (kind, id, name, slug, weight) rows"""
+        items = {kind: [] for kind in KINDS}
+        for kind, item_id, name, slug, weight in rows:
+            items[kind].append((item_id, name, slug, weight))
+        kinds = {kind: RankedKeys(items.pop(kind)) for kind in KINDS}
+        with self.lock:
+            self.kinds = kinds
+
+    def lookup(self, prefix, limit=SUGGEST_LIMIT):
+        """Best matches for ``prefix`` grouped by kind, at most SUGGEST_LIMIT each"""
+        prefix = ' '.join(prefix.lower().split())
+        if not prefix:
+            return {kind: [] for kind in KINDS}
+
+        limit = min(limit, SUGGEST_LIMIT)
+        with self.lock:
+            return {kind: keys.lookup(prefix, limit) for kind, keys in self.kinds.items()}
+
+
+_index = PrefixIndex()
+_loaded_at = None
+_load_lock = threading.Lock()
+_refreshing = False
+
+
+def index_rows():
+    for item_id, name, slug, total_sales in Product.objects.filter(
+        is_active=True
+    ).values_list('id', 'name', 'slug', 'total_sales').iterator(chunk_size=5000):
+        yield PRODUCT, item_id, name, slug, total_sales
+
+    for item_id, name, slug in Brand.objects.filter(is_active=True).values_list('id', 'name', 'slug'):
+        yield BRAND, item_id, name, slug, 0
+
+    for item_id, name, slug in Category.objects.filter(is_active=True).values_list('id', 'name', 'slug'):
+        yield CATEGORY, item_id, name, slug, 0
+
+
+def rebuild_index():
+    global _loaded_at
+    _index.load(index_rows())
+    _loaded_at = time.monotonic()
+
+
+def _refresh_in_background():
+    global _refreshing
+    try:
+        rebuild_index()
+    finally:
+        _refreshing = False
+        connection.close()
+
+
+def get_index():
+    """Return the loaded index, building it on first use"""
+    global _refreshing
+
+    if _loaded_at is None:
+        with _load_lock:
+            if _loaded_at is None:
+                rebuild_index()
+    elif time.monotonic() - _loaded_at > SUGGEST_INDEX_TTL and not _refreshing:
+        with _load_lock:
+            if not _refreshing:
+                _refreshing = True
+                threading.Thread(target=_refresh_in_background, daemon=True).start()
+    return _index
+
+
+def index_loaded():
+    return _loaded_at is not None
+
+
+def index_item(kind, item_id, name, slug, is_active, weight=0):
+    """Apply one saved row to the index, if this process has loaded it"""
+    if not index_loaded():
+        return
+
+    if not is_active:
+        _index.remove(kind, item_id)
+        return
+
+    current = _index.get(kind, item_id)
+    if current and current[1:3] == (name, slug):
+        _index.set_weight(kind, item_id, weight)
+    else:
+        _index.add(kind, item_id, name, slug, weight)
+
+
+def unindex_item(kind, item_id):
+    if index_loaded():
+        _index.remove(kind, item_id)
+
+
+def suggest(prefix, limit=SUGGEST_LIMIT):
+    """JSON-ready product, brand and category suggestions for ``prefix``"""
+    matches = get_index().lookup(prefix, limit=limit)
+    return {
+        'products': [
+            {'id': item_id, 'name': name, 'url': reverse('product_detail', args=[slug])}
+            for item_id, name, slug, _ in matches[PRODUCT]
+        ],
+        'brands': [
+            {'id': item_id, 'name': name, 'url': f"{reverse('search')}?{urlencode({'q': name})}"}
+            for item_id, name, slug, _ in matches[BRAND]
+        ],
+        'categories': [
+            {'id': item_id, 'name': name, 'url': reverse('category_products', args=[slug])}
+            for item_id, name, slug, _ in matches[CATEGORY]
+        ],
+    }
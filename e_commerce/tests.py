@@ -1,3 +1,1152 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import socket
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import Counter, OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Avg, Count, Sum
+from django.http import HttpResponse
+from django.template import engines
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from . import facets, payment_events, profiling, view_counter, views
+from .benchmark import DarajaStub, StepStats, callback_payload
+from .category_tree import get_category_tree
+from .delivery import get_delivery_table, quote
+from .facets import FacetIndex, get_facet_index
+from .inventory import InsufficientStock, reserve_stock
+from .models import (
+    Address, Banner, Brand, Cart, CartItem, Category, DeliveryZone, MpesaCallback, Order, Payment, PickupStation,
+    Product, ProductRanking, ProductSpecification, ProductVariant, Review, User, Vendor, Wishlist
+)
+from .mpesa import (
+    AccessTokenManager, CircuitBreaker, DarajaClient, DarajaUnavailable, EndpointMetrics, daraja, stk_request_ids
+)
+from .mpesa_callbacks import drain
+from .order_stats import get_order_stats
+from .pagination import cached_count
+from .profiling import N_PLUS_ONE_REPEATS, ProfileStore, RequestProfilingMiddleware
+from .query_plans import sequential_scans
+from .rankings import RANKING_MAX_AGE, Rail, ranked_products, rebuild_rankings, update_rankings
+from .reconciliation import Reconciler
+from .reviewed_products import has_reviewed, unreviewed
+from .snapshots import VersionedSnapshot
+from .suggest import BRAND, PRODUCT, SUGGEST_LIMIT, PrefixIndex, RankedKeys
+from .view_counter import flush_views, pending_views, record_view
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Stand-in for the search page template, which is not part of the tree; it
+# reads what a results page shows for every product
+SEARCH_TEMPLATE = (
+    '{% for product in products %}'
+    '{{ product.name }} {{ product.brand.name }} {{ product.category.name }} {{ product.price }}'
+    '{% endfor %}'
+)
+
+
+SEARCH_TEMPLATES = [{
+    **settings.TEMPLATES[0],
+    'APP_DIRS': False,
+    'OPTIONS': {
+        **settings.TEMPLATES[0]['OPTIONS'],
+        'loaders': [
+            ('django.template.loaders.locmem.Loader', {'e_commerce/search.html': SEARCH_TEMPLATE}),
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ],
+    },
+}]
+
+
+class DarajaClientTests(SimpleTestCase):
+    def test_calls_go_through_the_stub(self):
+        client = DarajaClient()
+        with DarajaStub() as stub:
+            response = client.post(f'{stub.base_url}/mpesa/stkpush/v1/processrequest', 'stk_push', json={})
+        self.assertEqual(response.json()['ResponseCode'], '0')
+        self.assertEqual(client.metrics()['endpoints']['stk_push']['calls'], 1)
+
+    def test_connection_failures_are_retried_then_open_the_breaker(self):
+        client = DarajaClient(max_retries=1, breaker_threshold=2, breaker_cooldown=60)
+        url = f'http://127.0.0.1:{unused_port()}/'
+
+        for _ in range(2):
+            with self.assertRaises(DarajaUnavailable):
+                client.get(url, 'oauth')
+        self.assertEqual(client.metrics()['circuit'], 'open')
+        self.assertEqual(client.metrics()['endpoints']['oauth']['calls'], 4)
+
+        # Open breaker: rejected without touching the network
+        with self.assertRaises(DarajaUnavailable):
+            client.get(url, 'oauth')
+        self.assertEqual(client.metrics()['endpoints']['oauth']['rejected'], 1)
+
+    def test_unexpected_errors_end_the_half_open_trial(self):
+        client = DarajaClient(max_retries=0, breaker_threshold=1, breaker_cooldown=0)
+        client.breaker.record_failure()
+
+        def broken_answer(response):
+            raise RuntimeError('unexpected')
+
+        with DarajaStub() as stub:
+            url = f'{stub.base_url}/mpesa/stkpushquery/v1/query'
+            stub.pending.add('ws_CO_1')
+            with self.assertRaises(RuntimeError):
+                client.post(url, 'stk_query', json={'CheckoutRequestID': 'ws_CO_1'}, is_answer=broken_answer)
+            self.assertFalse(client.breaker.trial_running)
+            # The next call is let through as a new trial
+            response = client.post(url, 'stk_query', json={'CheckoutRequestID': 'ws_CO_2'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.metrics()['circuit'], 'closed')
+
+    def test_endpoint_latency_percentiles(self):
+        metrics = EndpointMetrics()
+        self.assertIsNone(metrics.snapshot()['p99_ms'])
+        metrics.latencies.extend(n / 1000 for n in range(100, 0, -1))
+        snapshot = metrics.snapshot()
+        self.assertEqual((snapshot['p50_ms'], snapshot['p95_ms'], snapshot['p99_ms']), (50.0, 95.0, 99.0))
+
+
+class AccessTokenManagerTests(SimpleTestCase):
+    def test_token_is_fetched_once_and_reused(self):
+        tokens = AccessTokenManager()
+        with DarajaStub() as stub, override_settings(**stub.settings()):
+            tokens.clear()
+            self.assertEqual(tokens.get_token(), 'stub-access-token')
+            stub.server.shutdown()
+            self.assertEqual(tokens.get_token(), 'stub-access-token')
+
+
+class PaymentRequestIdTests(SimpleTestCase):
+    def test_backfill_migration_reads_ids_like_the_runtime(self):
+        migration = import_module('e_commerce.migrations.0005_payment_request_ids')
+        payloads = [
+            None, [], 'text', {}, {'Body': None}, {'Body': {'stkCallback': {}}},
+            {'CheckoutRequestID': 'ws_CO_1', 'MerchantRequestID': 'merchant-1', 'ResponseCode': '0'},
+            {'CheckoutRequestID': 'ws_CO_2'},
+            callback_payload('ws_CO_3', 'merchant-3', 100, '254711111111'),
+            {'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_4', 'ResultCode': 1032}}},
+        ]
+        for data in payloads:
+            with self.subTest(data=data):
+                self.assertEqual(migration.request_ids(data), stk_request_ids(data))
+
+
+class MpesaCallbackInboxTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='buyer', email='buyer@example.com', phone_number='0711111111')
+        order = Order.objects.create(user=user, delivery_method='pickup_station', subtotal=100, total=100)
+        self.payment = Payment.objects.create(
+            order=order, payment_method='mpesa', amount=100, checkout_request_id='ws_CO_1'
+        )
+
+    def post_callback(self, checkout_request_id):
+        body = json.dumps(callback_payload(checkout_request_id, 'merchant-1', 100, '254711111111'))
+        return self.client.post(reverse('mpesa_callback'), body, content_type='application/json')
+
+    def test_callback_is_queued_and_applied_once(self):
+        for _ in range(3):
+            with self.assertNumQueries(1):
+                response = self.post_callback('ws_CO_1')
+            self.assertEqual(response.json()['ResultCode'], 0)
+        self.assertEqual(Payment.objects.get().status, 'pending')
+
+        self.assertEqual(drain(), 3)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.payment.order.status, 'confirmed')
+        self.assertEqual(
+            sorted(MpesaCallback.objects.values_list('status', flat=True)),
+            ['duplicate', 'duplicate', 'processed']
+        )
+
+    def test_unmatched_callback_stays_pending_for_a_retry(self):
+        self.post_callback('ws_CO_unknown')
+        drain()
+        callback = MpesaCallback.objects.get()
+        self.assertEqual((callback.status, callback.attempts), ('pending', 1))
+
+
+class PaymentStatusLongPollTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', email='buyer@example.com', phone_number='0711111111')
+        order = Order.objects.create(user=self.user, delivery_method='pickup_station', subtotal=100, total=100)
+        self.payment = Payment.objects.create(
+            order=order, payment_method='mpesa', amount=100, status='processing', checkout_request_id='ws_CO_1'
+        )
+        self.url = reverse('check_payment_status', args=[self.payment.id])
+
+    async def test_returns_at_once_when_the_status_differs(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url, {'status': 'pending', 'wait': 5})
+        self.assertEqual(response.json()['status'], 'processing')
+
+    async def test_waiting_request_wakes_when_the_payment_changes(self):
+        await self.async_client.aforce_login(self.user)
+        request = asyncio.ensure_future(
+            self.async_client.get(self.url, {'status': 'processing', 'wait': 5})
+        )
+        await asyncio.sleep(0.2)
+        self.assertFalse(request.done())
+
+        started = time.monotonic()
+        await Payment.objects.filter(id=self.payment.id).aupdate(status='completed')
+        payment_events.hub.publish([self.payment.id])
+        response = await request
+        self.assertEqual(response.json()['status'], 'completed')
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_wsgi_requests_are_answered_at_once_for_polling(self):
+        self.client.force_login(self.user)
+        started = time.monotonic()
+        response = self.client.get(self.url, {'status': 'processing', 'wait': 5})
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(response.json()['retry_after'], payment_events.POLL_INTERVAL)
+
+    def test_one_listener_thread_serves_every_event_loop(self):
+        hub = payment_events.PaymentStatusHub()
+        listens = []
+        stop = threading.Event()
+
+        async def watch():
+            with hub.watch(self.payment.id):
+                pass
+
+        def listen(hub):
+            listens.append(threading.current_thread())
+            stop.wait()
+
+        with mock.patch.object(payment_events.PaymentStatusHub, '_listen', listen), \
+                mock.patch.object(payment_events, 'connection', mock.Mock(vendor='postgresql')):
+            asyncio.run(watch())
+            asyncio.run(watch())
+        stop.set()
+        hub._listener.join(timeout=2)
+        self.assertEqual(len(listens), 1)
+
+
+class ReconcilerTests(TestCase):
+    def test_stale_processing_payments_are_settled_from_the_stk_query(self):
+        user = User.objects.create_user(username='buyer', email='buyer@example.com', phone_number='0711111111')
+        order = Order.objects.create(user=user, delivery_method='pickup_station', subtotal=100, total=100)
+        stale = Payment.objects.create(
+            order=order, payment_method='mpesa', amount=100, status='processing', checkout_request_id='ws_CO_1'
+        )
+        fresh = Payment.objects.create(
+            order=order, payment_method='mpesa', amount=100, status='processing', checkout_request_id='ws_CO_2'
+        )
+        Payment.objects.filter(id=stale.id).update(created_at=timezone.now() - timedelta(hours=1))
+
+        with DarajaStub() as stub, override_settings(**stub.settings()):
+            stats = Reconciler(older_than=60, workers=2, rate=0).run()
+
+        self.assertEqual((stats['queried'], stats['completed']), (1, 1))
+        self.assertEqual(Payment.objects.get(id=stale.id).status, 'completed')
+        self.assertEqual(Payment.objects.get(id=fresh.id).status, 'processing')
+        self.assertEqual(Order.objects.get(id=order.id).status, 'confirmed')
+
+    def test_payments_still_in_progress_do_not_open_the_breaker(self):
+        user = User.objects.create_user(username='buyer', email='buyer@example.com', phone_number='0711111111')
+        order = Order.objects.create(user=user, delivery_method='pickup_station', subtotal=100, total=100)
+        for n in range(5):
+            Payment.objects.create(
+                order=order, payment_method='mpesa', amount=100, status='processing',
+                checkout_request_id=f'ws_CO_pending_{n}'
+            )
+        answered = Payment.objects.create(
+            order=order, payment_method='mpesa', amount=100, status='processing', checkout_request_id='ws_CO_paid'
+        )
+        Payment.objects.update(created_at=timezone.now() - timedelta(hours=1))
+
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        with DarajaStub() as stub, override_settings(**stub.settings()), mock.patch.object(daraja, 'breaker', breaker):
+            stub.pending.update(f'ws_CO_pending_{n}' for n in range(5))
+            stats = Reconciler(older_than=60, workers=1, rate=0).run()
+
+        self.assertEqual((stats['in_progress'], stats['completed'], stats['errors']), (5, 1, 0))
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(Payment.objects.get(id=answered.id).status, 'completed')
+        self.assertEqual(Payment.objects.filter(status='processing').count(), 5)
+
+
+class ProductRatingTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(username=f'buyer{n}', email=f'buyer{n}@example.com', phone_number=f'071111111{n}')
+            for n in range(3)
+        ]
+        vendor = Vendor.objects.create(
+            user=self.users[0], business_name='Shop', description='d', business_registration='r', tax_id='t',
+            phone='0711111110', email='shop@example.com', address='a'
+        )
+        category = Category.objects.create(name='Phones', slug='phones')
+        self.products = [
+            Product.objects.create(
+                vendor=vendor, category=category, name=f'Phone {n}', slug=f'phone-{n}', sku=f'PH-{n}',
+                description='d', short_description='s', price=100
+            )
+            for n in range(2)
+        ]
+
+    def assertRatingsMatchReviews(self):
+        for product in Product.objects.filter(pk__in=[product.pk for product in self.products]):
+            approved = Review.objects.filter(product=product, is_approved=True)
+            stats = approved.aggregate(avg=Avg('rating'), count=Count('id'))
+            self.assertEqual(product.rating_count, stats['count'])
+            self.assertAlmostEqual(product.rating_avg, stats['avg'] or 0)
+            for star in range(1, 6):
+                self.assertEqual(getattr(product, f'rating_{star}_count'), approved.filter(rating=star).count())
+
+    def test_review_changes_keep_ratings_in_step_with_the_reviews(self):
+        first = Review.objects.create(product=self.products[0], user=self.users[0], rating=5, title='t', comment='c')
+        self.assertRatingsMatchReviews()
+
+        first.is_approved = True
+        first.save()
+        self.assertRatingsMatchReviews()
+
+        second = Review.objects.create(
+            product=self.products[0], user=self.users[1], rating=2, title='t', comment='c', is_approved=True
+        )
+        Review.objects.create(
+            product=self.products[1], user=self.users[2], rating=4, title='t', comment='c', is_approved=True
+        )
+        self.assertRatingsMatchReviews()
+
+        second.rating = 3
+        second.save()
+        self.assertRatingsMatchReviews()
+
+        second.product = self.products[1]
+        second.save()
+        self.assertRatingsMatchReviews()
+
+        first.is_approved = False
+        first.save()
+        self.assertRatingsMatchReviews()
+
+        second.delete()
+        first.delete()
+        self.assertRatingsMatchReviews()
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', phone_number='0711111111', password='pw'
+        )
+        vendor = Vendor.objects.create(
+            user=self.user, business_name='Shop', description='d', business_registration='r', tax_id='t',
+            phone='0711111111', email='shop@example.com', address='a'
+        )
+        category = Category.objects.create(name='Phones', slug='phones')
+        self.phone, self.case = [
+            Product.objects.create(
+                vendor=vendor, category=category, name=name, slug=name.lower(), sku=name.upper(),
+                description='d', short_description='s', price=100, stock=stock
+            )
+            for name, stock in (('Phone', 5), ('Case', 2))
+        ]
+        self.blue = ProductVariant.objects.create(product=self.phone, name='Blue', sku='PHONE-BLUE', stock=1)
+        self.cart = Cart.objects.create(user=self.user)
+        self.order = Order.objects.create(user=self.user, delivery_method='pickup_station', subtotal=0, total=0)
+
+    def line(self, product, quantity, variant=None):
+        return CartItem.objects.create(cart=self.cart, product=product, variant=variant, quantity=quantity, price=100)
+
+    def stock(self):
+        self.phone.refresh_from_db()
+        self.case.refresh_from_db()
+        self.blue.refresh_from_db()
+        return self.phone.stock, self.case.stock, self.blue.stock
+
+    def test_every_line_is_reserved(self):
+        lines = [self.line(self.phone, 2), self.line(self.case, 1), self.line(self.phone, 1, self.blue)]
+        with transaction.atomic():
+            items = reserve_stock(self.order, lines)
+
+        self.assertEqual(len(items), 3)
+        self.assertEqual(self.stock(), (2, 1, 0))
+        self.assertEqual((self.phone.total_sales, self.case.total_sales), (3, 1))
+        self.assertEqual(self.order.items.get(variant=self.blue).variant_name, 'Blue')
+
+    def test_shortfall_rolls_back_and_lists_the_short_lines(self):
+        lines = [self.line(self.phone, 2), self.line(self.case, 3), self.line(self.phone, 2, self.blue)]
+        with self.assertRaises(InsufficientStock) as raised, transaction.atomic():
+            reserve_stock(self.order, lines)
+
+        shortfalls = raised.exception.shortfalls
+        self.assertEqual(
+            [(shortfall.product_id, shortfall.variant_id, shortfall.available) for shortfall in shortfalls],
+            [(self.case.id, None, 2), (self.phone.id, self.blue.id, 1)]
+        )
+        self.assertEqual(self.stock(), (5, 2, 1))
+        self.assertFalse(self.order.items.exists())
+
+    def test_cancelling_restores_the_stock(self):
+        with transaction.atomic():
+            reserve_stock(self.order, [self.line(self.phone, 3), self.line(self.phone, 1, self.blue)])
+        self.assertEqual(self.stock(), (1, 2, 0))
+
+        self.client.force_login(self.user)
+        self.client.post(reverse('cancel_order', args=[self.order.id]))
+        self.assertEqual(self.stock(), (5, 2, 1))
+        self.assertEqual(self.phone.total_sales, 0)
+
+        # A repeated cancel must not give the stock back twice
+        self.client.post(reverse('cancel_order', args=[self.order.id]))
+        self.assertEqual(self.stock(), (5, 2, 1))
+
+
+class ViewCounterTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='seller', email='seller@example.com', phone_number='0711111111')
+        vendor = Vendor.objects.create(
+            user=user, business_name='Shop', description='d', business_registration='r', tax_id='t',
+            phone='0711111111', email='shop@example.com', address='a'
+        )
+        category = Category.objects.create(name='Phones', slug='phones')
+        self.products = [
+            Product.objects.create(
+                vendor=vendor, category=category, name=f'Phone {n}', slug=f'phone-{n}', sku=f'PH-{n}',
+                description='d', short_description='s', price=100, views=10
+            )
+            for n in range(3)
+        ]
+        # No background flusher, so only the test writes the buffer back
+        patcher = mock.patch.multiple(view_counter, _pending=Counter(), _ensure_flusher=mock.DEFAULT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def views(self):
+        return list(Product.objects.order_by('pk').values_list('views', flat=True))
+
+    def test_buffered_views_are_written_back_once(self):
+        first, second, _ = self.products
+        for product_id in (first.pk, first.pk, first.pk, second.pk):
+            record_view(product_id)
+        self.assertEqual(self.views(), [10, 10, 10])
+        self.assertEqual(pending_views(first.pk), 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(flush_views(), 4)
+        # Increments of 3 and 1: one UPDATE each
+        self.assertEqual(sum(query['sql'].startswith('UPDATE') for query in queries.captured_queries), 2)
+        self.assertEqual(self.views(), [13, 11, 10])
+        self.assertEqual(pending_views(first.pk), 0)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(flush_views(), 0)
+        self.assertEqual(self.views(), [13, 11, 10])
+
+    def test_failed_writes_stay_buffered(self):
+        record_view(self.products[0].pk)
+        with mock.patch.object(Product.objects, 'filter', side_effect=RuntimeError('database gone')):
+            with self.assertRaises(RuntimeError):
+                flush_views()
+        self.assertEqual(pending_views(self.products[0].pk), 1)
+        self.assertEqual(flush_views(), 1)
+        self.assertEqual(self.views(), [11, 10, 10])
+
+
+class CartSummaryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', phone_number='0711111111', password='pw'
+        )
+        vendor = Vendor.objects.create(
+            user=self.user, business_name='Shop', description='d', business_registration='r', tax_id='t',
+            phone='0711111111', email='shop@example.com', address='a'
+        )
+        category = Category.objects.create(name='Phones', slug='phones')
+        self.product = Product.objects.create(
+            vendor=vendor, category=category, name='Phone', slug='phone', sku='PHONE',
+            description='d', short_description='s', price=100, stock=5
+        )
+        self.client.force_login(self.user)
+
+    def badge(self):
+        context = self.client.get(reverse('cart')).context
+        return context['cart_item_count'], context['cart_subtotal']
+
+    def test_badge_follows_adds_and_removes(self):
+        self.assertEqual(self.badge(), (0, 0))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('add_to_cart', args=[self.product.id]), {'quantity': 2})
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(self.badge(), (2, 200))
+
+        item = CartItem.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('remove_cart_item', args=[item.id]))
+        self.assertEqual(self.badge(), (0, 0))
+
+
+class OrderStatsTests(TestCase):
+    def test_counts_are_cached_until_an_order_changes(self):
+        cache.clear()
+        user = User.objects.create_user(username='buyer', email='buyer@example.com', phone_number='0711111111')
+        order = Order.objects.create(user=user, delivery_method='pickup_station', subtotal=100, total=100)
+        Order.objects.create(user=user, delivery_method='pickup_station', subtotal=50, total=50, status='delivered')
+
+        with self.assertNumQueries(1):
+            stats = get_order_stats(user)
+        self.assertEqual((stats['all'], stats['pending'], stats['delivered']), (2, 1, 1))
+        with self.assertNumQueries(0):
+            get_order_stats(user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order.status = 'cancelled'
+            order.save()
+        stats = get_order_stats(user)
+        self.assertEqual((stats['pending'], stats['cancelled']), (0, 1))
+
+
+class ReviewedProductsTests(TestCase):
+    def test_reviewed_set_is_cached_and_refreshed_on_review(self):
+        cache.clear()
+        user = User.objects.create_user(username='buyer', email='buyer@example.com', phone_number='0711111111')
+        vendor = Vendor.objects.create(
+            user=user, business_name='Shop', description='d', business_registration='r', tax_id='t',
+            phone='0711111111', email='shop@example.com', address='a'
+        )
+        category = Category.objects.create(name='Phones', slug='phones')
+        products = [
+            Product.objects.create(
+                vendor=vendor, category=category, name=f'Phone {n}', slug=f'phone-{n}', sku=f'PH-{n}',
+                description='d', short_description='s', price=100
+            )
+            for n in range(3)
+        ]
+        ids = [product.id for product in products]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(product=products[0], user=user, rating=5, title='t', comment='c')
+        with self.assertNumQueries(1):
+            self.assertEqual(unreviewed(user, ids), ids[1:])
+        with self.assertNumQueries(0):
+            self.assertTrue(has_reviewed(user, ids[0]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(product=products[1], user=user, rating=4, title='t', comment='c')
+        self.assertEqual(unreviewed(user, ids), ids[2:])
+
+    def test_delivered_order_links_unreviewed_items_to_the_review_form(self):
+        cache.clear()
+        user = User.objects.create_user(username='buyer', email='buyer@example.com', phone_number='0711111111')
+        vendor = Vendor.objects.create(
+            user=user, business_name='Shop', description='d', business_registration='r', tax_id='t',
+            phone='0711111111', email='shop@example.com', address='a'
+        )
+        category = Category.objects.create(name='Phones', slug='phones')
+        product = Product.objects.create(
+            vendor=vendor, category=category, name='Phone', slug='phone', sku='PH-1',
+            description='d', short_description='s', price=100
+        )
+        order = Order.objects.create(
+            user=user, delivery_method='pickup_station', subtotal=100, total=100, status='delivered'
+        )
+        order.items.create(
+            product=product, vendor=vendor, product_name='Phone', product_sku='PH-1', quantity=1, price=100, total=100
+        )
+        self.client.force_login(user)
+
+        review_url = reverse('submit_review', args=[product.id])
+        response = self.client.get(reverse('order_detail', args=[order.id]))
+        self.assertContains(response, review_url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(review_url, {'rating': 4, 'title': 't', 'comment': 'c'})
+        self.assertRedirects(response, reverse('product_detail', args=[product.slug]), fetch_redirect_response=False)
+        self.assertTrue(Review.objects.filter(product=product, user=user, is_verified_purchase=True).exists())
+        self.assertNotContains(self.client.get(reverse('order_detail', args=[order.id])), review_url)
+
+
+class PrefixIndexTests(SimpleTestCase):
+    def setUp(self):
+        # Many light matches that sort before the best seller
+        self.index = PrefixIndex()
+        self.index.load(
+            [(PRODUCT, i, f'Sandal {i:04d}', f'sandal-{i}', 1) for i in range(1000)]
+            + [(PRODUCT, 5000, 'Smart TV', 'smart-tv', 900), (BRAND, 1, 'Sony', 'sony', 0)]
+        )
+
+    def names(self, prefix, kind=PRODUCT):
+        return [name for _, name, _, _ in self.index.lookup(prefix)[kind]]
+
+    def test_ranks_the_whole_match_set(self):
+        for prefix in ('s', 'sm', 'smart'):
+            self.assertEqual(self.names(prefix)[0], 'Smart TV')
+        self.assertEqual(self.names('s', BRAND), ['Sony'])
+        self.assertEqual(self.names('tv'), ['Smart TV'])
+
+    def test_ranked_prefixes_follow_weight_changes(self):
+        self.index.set_weight(PRODUCT, 7, 1000)
+        self.assertEqual(self.names('s')[:2], ['Sandal 0007', 'Smart TV'])
+
+        self.index.set_weight(PRODUCT, 5000, 0)
+        self.assertNotIn('Smart TV', self.names('s'))
+        self.assertEqual(len(self.names('s')), SUGGEST_LIMIT)
+
+        self.index.remove(PRODUCT, 7)
+        self.index.add(PRODUCT, 5001, 'Sound bar', 'sound-bar', 50)
+        self.assertEqual(self.names('so')[0], 'Sound bar')
+        self.assertEqual(self.names('s')[0], 'Sound bar')
+        self.assertNotIn('Sandal 0007', self.names('s'))
+
+    def test_exact_names_come_first(self):
+        self.index.add(PRODUCT, 5002, 'Sandal', 'sandal', 0)
+        self.assertEqual(self.names('sandal')[0], 'Sandal')
+        self.assertEqual(self.names('sony', BRAND), ['Sony'])
+
+    def test_lookups_and_updates_do_not_walk_the_match_set(self):
+        self.index.load([(PRODUCT, i, f'Sandal {i:04d}', f'sandal-{i}', i % 100) for i in range(5000)])
+        with mock.patch.object(RankedKeys, 'rank', autospec=True, side_effect=RankedKeys.rank) as rank:
+            for update in (
+                lambda: self.index.lookup('s'),
+                lambda: self.index.set_weight(PRODUCT, 2500, 1000),
+                lambda: self.index.remove(PRODUCT, 2500),
+                lambda: self.index.add(PRODUCT, 6000, 'Sandal new', 'sandal-new', 1000),
+            ):
+                rank.reset_mock()
+                update()
+                self.assertLess(rank.call_count, 500)
+        self.assertEqual(self.names('s')[0], 'Sandal new')
+
+
+class FacetIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='seller', email='seller@example.com', phone_number='0733333333')
+        vendor = Vendor.objects.create(
+            user=user, business_name='Shop', description='d', business_registration='r', tax_id='t',
+            phone='0733333333', email='shop@example.com', address='a'
+        )
+        self.phones = Category.objects.create(name='Phones', slug='phones')
+        self.android = Category.objects.create(name='Android', slug='android', parent=self.phones)
+        self.brands = [Brand.objects.create(name=name, slug=name.lower()) for name in ('Acme', 'Zed')]
+        self.products = [
+            Product.objects.create(
+                vendor=vendor, category=self.android if n % 2 else self.phones, brand=self.brands[n % 2],
+                name=f'Phone {n}', slug=f'phone-{n}', sku=f'PH-{n}', description='d', short_description='s',
+                price=100 * (n + 1), stock=5
+            )
+            for n in range(6)
+        ]
+        for n, product in enumerate(self.products):
+            ProductSpecification.objects.create(product=product, name='RAM', value=f'{4 + 4 * (n % 3)}GB')
+
+    def test_counts_ignore_each_facets_own_filter(self):
+        facets = get_facet_index(self.phones).facets(
+            max_price=400, brand_ids=[self.brands[0].id], subcategory_ids=[self.android.id]
+        )
+        self.assertEqual(facets['total'], 0)
+        self.assertEqual([brand['product_count'] for brand in facets['brands']], [0, 2])
+        self.assertEqual(facets['subcategories'][0]['product_count'], 0)
+
+        facets = get_facet_index(self.phones).facets(brand_ids=[self.brands[0].id])
+        self.assertEqual(facets['total'], 3)
+        self.assertEqual(facets['price_range'], {'min_price': 100, 'max_price': 500})
+        self.assertEqual(
+            facets['spec_filters']['RAM'],
+            [{'value': '12GB', 'count': 1}, {'value': '4GB', 'count': 1}, {'value': '8GB', 'count': 1}]
+        )
+
+    def test_price_bounds_between_cents(self):
+        index = get_facet_index(self.phones)
+        self.assertIsInstance(index.prices, array)
+        self.assertEqual(index.facets(min_price=Decimal('100.001'))['total'], 5)
+        self.assertEqual(index.facets(max_price=Decimal('199.999'))['total'], 1)
+        self.assertEqual(index.facets(min_price=Decimal('200'), max_price=Decimal('200.00'))['total'], 1)
+        self.assertEqual(
+            index.facets()['price_range'], {'min_price': Decimal('100.00'), 'max_price': Decimal('600.00')}
+        )
+
+    def test_moved_products_leave_the_old_category(self):
+        tablets = Category.objects.create(name='Tablets', slug='tablets')
+        self.assertEqual(get_facet_index(self.phones).facets()['total'], 6)
+        self.assertEqual(get_facet_index(tablets).facets()['total'], 0)
+        self.products[0].category = tablets
+        self.products[0].save()
+        self.assertEqual(get_facet_index(self.phones).facets()['total'], 5)
+        self.assertEqual(get_facet_index(tablets).facets()['total'], 1)
+
+    def test_index_is_rebuilt_after_a_cache_flush(self):
+        self.assertEqual(get_facet_index(self.phones).facets()['total'], 6)
+        # Bypasses signals; only the flush tells processes to rebuild
+        Product.objects.filter(pk=self.products[0].pk).update(stock=0)
+        cache.clear()
+        self.assertEqual(get_facet_index(self.phones).facets()['total'], 5)
+
+    def test_sparse_sets_count_like_bitmaps(self):
+        filters = [{}, {'max_price': 400}, {'brand_ids': [self.brands[0].id]}, {'rating': 1}]
+        dense = [FacetIndex(self.phones).facets(**kwargs) for kwargs in filters]
+        with mock.patch.object(facets, 'SPARSE_SHARE', 1):
+            index = FacetIndex(self.phones)
+            self.assertIsInstance(index.brands[self.brands[0].id][1], array)
+            self.assertEqual([index.facets(**kwargs) for kwargs in filters], dense)
+
+    def test_products_stocked_while_building_are_skipped(self):
+        Product.objects.filter(pk=self.products[0].pk).update(stock=0)
+        ProductSpecification.objects.create(product=self.products[1], name='RAM', value='8GB')
+        brands = Brand.objects.filter
+
+        def restock(*args, **kwargs):
+            # Runs between the product query and the specification query
+            Product.objects.filter(pk=self.products[0].pk).update(stock=5)
+            return brands(*args, **kwargs)
+
+        with mock.patch.object(Brand.objects, 'filter', side_effect=restock):
+            index = FacetIndex(self.phones)
+        self.assertEqual(index.size, 5)
+        self.assertEqual(
+            index.facets()['spec_filters']['RAM'],
+            [{'value': '12GB', 'count': 2}, {'value': '4GB', 'count': 1}, {'value': '8GB', 'count': 2}]
+        )
+
+    def test_indexes_are_evicted_by_size(self):
+        index_size = FacetIndex(self.phones).nbytes
+        with mock.patch.multiple(facets, _indexes=OrderedDict(), FACET_INDEX_CACHE_BYTES=index_size * 3 // 2):
+            get_facet_index(self.phones)
+            get_facet_index(self.android)
+            self.assertEqual(list(facets._indexes), [self.android.id])
+
+    def test_indexes_over_the_budget_are_not_kept(self):
+        index_size = FacetIndex(self.phones).nbytes
+        with mock.patch.multiple(facets, _indexes=OrderedDict(), FACET_INDEX_CACHE_BYTES=index_size - 1):
+            get_facet_index(self.android)
+            self.assertEqual(get_facet_index(self.phones).facets()['total'], 6)
+            self.assertEqual(list(facets._indexes), [self.android.id])
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', email='buyer@example.com', phone_number='0744444444')
+        vendor = Vendor.objects.create(
+            user=self.user, business_name='Shop', description='d', business_registration='r', tax_id='t',
+            phone='0744444444', email='shop@example.com', address='a'
+        )
+        category = Category.objects.create(name='Phones', slug='phones')
+        self.products = [
+            Product.objects.create(
+                vendor=vendor, category=category, name=f'Phone {n}', slug=f'phone-{n}', sku=f'PH-{n}',
+                description='d', short_description='s', price=100, stock=5
+            )
+            for n in range(30)
+        ]
+
+    def test_empty_searches_count_zero(self):
+        self.assertEqual(cached_count(Product.objects.none()), 0)
+        with self.settings(TEMPLATES=SEARCH_TEMPLATES):
+            for params in ({}, {'q': ''}, {'q': '!!'}):
+                response = self.client.get(reverse('search'), params)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.context['total_results'], 0)
+
+    def test_similar_spellings_are_looked_up_only_without_matches(self):
+        with self.settings(TEMPLATES=SEARCH_TEMPLATES), mock.patch.object(
+            views, 'similar_products', wraps=views.similar_products
+        ) as similar_products:
+            self.assertEqual(self.client.get(reverse('search'), {'q': 'Phone'}).context['total_results'], 30)
+            similar_products.assert_not_called()
+            self.client.get(reverse('search'), {'q': 'Phnoe'})
+            similar_products.assert_called_once_with('Phnoe')
+
+    def test_wishlist_pages_follow_adds_and_removes(self):
+        self.client.force_login(self.user)
+        for product in self.products[:24]:
+            Wishlist.objects.create(user=self.user, product=product)
+        self.assertEqual(self.client.get(reverse('wishlist')).context['wishlist_items'].paginator.num_pages, 1)
+
+        Wishlist.objects.create(user=self.user, product=self.products[24])
+        page = self.client.get(reverse('wishlist'), {'page': 2}).context['wishlist_items']
+        self.assertEqual((page.paginator.count, len(page)), (25, 1))
+
+    def test_wishlist_links_follow_the_pagination_mode(self):
+        self.client.force_login(self.user)
+        for product in self.products[:25]:
+            Wishlist.objects.create(user=self.user, product=product)
+        response = self.client.get(reverse('wishlist'))
+        self.assertContains(response, 'href="?page=2"')
+        self.assertNotContains(response, 'cursor=')
+
+        response = self.client.get(reverse('wishlist'), {'cursor': ''})
+        self.assertTrue(response.context['wishlist_items'].is_keyset)
+        self.assertContains(response, 'href="?cursor=')
+        self.assertNotContains(response, 'href="?page=')
+
+
+class VersionedSnapshotTests(SimpleTestCase):
+    def test_reloads_on_invalidation_and_after_a_cache_flush(self):
+        cache.clear()
+        loads = []
+        snapshot = VersionedSnapshot('test:version', lambda: loads.append(1) or len(loads), ttl=60)
+
+        self.assertEqual((snapshot.get(), snapshot.get()), (1, 1))
+        snapshot.invalidate()
+        self.assertEqual(snapshot.get(), 2)
+        # A flush must not bring back the version the snapshot was loaded at
+        cache.clear()
+        self.assertEqual(snapshot.get(), 3)
+
+
+class DeliveryTableTests(TestCase):
+    def test_quotes_come_from_memory_and_follow_admin_edits(self):
+        cache.clear()
+        station = PickupStation.objects.create(
+            name='CBD', code='CBD', region='Nairobi', city='Nairobi', address='a',
+            phone_number='0711111111', operating_hours='8-5', delivery_fee=120
+        )
+        zone = DeliveryZone.objects.create(region='Nairobi', city='Westlands', delivery_fee=250, estimated_days=2)
+        address = Address(region='Nairobi', city='Westlands')
+
+        get_delivery_table()
+        with self.assertNumQueries(0):
+            self.assertEqual(quote('pickup_station').fee, 120)
+            self.assertEqual(quote('pickup_station', station_id=str(station.id)).station, station)
+            self.assertEqual(quote('home_delivery', address)[:2], (250, 2))
+            self.assertEqual(quote('home_delivery', Address(region='Coast', city='Lamu')).fee, 300)
+
+        zone.delivery_fee = 280
+        zone.save()
+        self.assertEqual(quote('home_delivery', address).fee, 280)
+
+
+class CategoryTreeTests(TestCase):
+    def test_descendants_and_ancestors_at_any_depth(self):
+        cache.clear()
+        electronics = Category.objects.create(name='Electronics', slug='electronics')
+        tvs = Category.objects.create(name='TVs', slug='tvs', parent=electronics)
+        oled = Category.objects.create(name='OLED', slug='oled', parent=tvs)
+        hidden = Category.objects.create(name='Hidden', slug='hidden', parent=tvs, is_active=False)
+
+        get_category_tree()
+        with self.assertNumQueries(0):
+            tree = get_category_tree()
+            self.assertEqual(tree.descendant_ids(electronics.id), {electronics.id, tvs.id, oled.id})
+            self.assertEqual(tree.children(tvs.id), [oled])
+            self.assertEqual([category.slug for category in tree.ancestors(oled.id)], ['electronics', 'tvs', 'oled'])
+            self.assertEqual(tree.ancestors(oled.id)[0].parent, None)
+            self.assertIsNone(tree.get('hidden'))
+
+        hidden.is_active = True
+        hidden.save()
+        self.assertIn(hidden.id, get_category_tree().descendant_ids(electronics.id))
+
+
+class RankingsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='seller', email='seller@example.com', phone_number='0722222222')
+        self.vendor = Vendor.objects.create(
+            user=user, business_name='Shop', description='d', business_registration='r', tax_id='t',
+            phone='0722222222', email='shop@example.com', address='a'
+        )
+        self.electronics = Category.objects.create(name='Electronics', slug='electronics')
+        self.tvs = Category.objects.create(name='TVs', slug='tvs', parent=self.electronics)
+        self.products = [
+            Product.objects.create(
+                vendor=self.vendor, category=self.tvs if n % 2 else self.electronics, name=f'TV {n}',
+                slug=f'tv-{n}', sku=f'TV-{n}', description='d', short_description='s',
+                price=100, stock=5, total_sales=n * 10
+            )
+            for n in range(5)
+        ]
+        rebuild_rankings()
+
+    def test_category_rankings_cover_subtrees(self):
+        best, related = ranked_products(
+            Rail('category', [self.electronics.id], 'sales', 3),
+            Rail('category', [self.tvs.id], 'sales', 3, [self.products[3].id])
+        )
+        self.assertEqual(best, [self.products[4], self.products[3], self.products[2]])
+        self.assertEqual(related, [self.products[1]])
+
+    def test_sales_and_stock_changes_update_rankings(self):
+        rail = Rail('vendor', [self.vendor.id], 'sales', 5)
+        Product.objects.filter(pk=self.products[0].pk).update(total_sales=100)
+        Product.objects.filter(pk=self.products[4].pk).update(stock=0)
+        update_rankings([self.products[0].pk, self.products[4].pk])
+
+        with self.assertNumQueries(3):
+            products, = ranked_products(rail)
+        self.assertEqual(products, [self.products[0], self.products[3], self.products[2], self.products[1]])
+
+    def test_updates_leave_category_and_catalog_wide_rankings_to_the_rebuild(self):
+        Product.objects.filter(pk=self.products[0].pk).update(total_sales=100)
+        with CaptureQueriesContext(connection) as queries:
+            update_rankings([self.products[0].pk])
+        self.assertFalse(any(
+            "'all'" in query['sql'] or "'category'" in query['sql'] for query in queries.captured_queries
+        ))
+
+        rails = Rail('all', [0], 'sales', 1), Rail('category', [self.electronics.id], 'sales', 1)
+        self.assertEqual(ranked_products(*rails), [[self.products[4]], [self.products[4]]])
+        rebuild_rankings()
+        self.assertEqual(ranked_products(*rails), [[self.products[0]], [self.products[0]]])
+
+    def test_stale_ranking_is_rebuilt_on_read(self):
+        rail = Rail('all', [0], 'sales', 1)
+        Product.objects.filter(pk=self.products[0].pk).update(total_sales=100)
+        self.assertEqual(ranked_products(rail), [[self.products[4]]])
+
+        ProductRanking.objects.update(refreshed_at=timezone.now() - timedelta(seconds=RANKING_MAX_AGE + 1))
+        self.assertEqual(ranked_products(rail), [[self.products[0]]])
+        ranking = ProductRanking.objects.get(scope='all', metric='sales')
+        self.assertGreater(ranking.refreshed_at, timezone.now() - timedelta(seconds=RANKING_MAX_AGE))
+        # Fresh again: read as stored
+        with self.assertNumQueries(3):
+            ranked_products(rail)
+
+    def test_missing_ranking_is_built_on_read(self):
+        ProductRanking.objects.all().delete()
+        newest, = ranked_products(Rail('all', [0], 'newest', 1))
+        self.assertEqual(newest, [self.products[4]])
+        self.assertTrue(ProductRanking.objects.filter(scope='all', metric='newest').exists())
+
+
+class QueryPlanTests(TestCase):
+    def test_sequential_scans_are_reported_by_table(self):
+        listing = Product.objects.filter(is_active=True, stock__gt=0, category_id=1).order_by(
+            '-total_sales', '-views', '-id'
+        )
+        unindexed = Product.objects.filter(short_description='s')
+        aliased = Product.objects.filter(id__in=Review.objects.filter(title='t').values('product_id'))
+        self.assertEqual(sequential_scans(*listing.query.sql_with_params()), [])
+        self.assertEqual(sequential_scans(*unindexed.query.sql_with_params()), ['products'])
+        self.assertEqual(sequential_scans(*aliased.query.sql_with_params()), ['reviews'])
+
+
+class RequestProfilingTests(TestCase):
+    def test_sampled_requests_are_aggregated_per_view(self):
+        def view(request):
+            for n in range(N_PLUS_ONE_REPEATS):
+                Product.objects.filter(pk=n).exists()
+            Product.objects.filter(pk__in=[1, 2, 3]).count()
+            return HttpResponse(engines['django'].from_string('{{ n }}').render({'n': 1}))
+
+        store = ProfileStore(max_samples=2)
+        request = RequestFactory().get('/')
+        request.resolver_match = resolve(reverse('home'))
+        with mock.patch.multiple(profiling, REQUEST_PROFILING=True, REQUEST_PROFILING_SAMPLE_RATE=1, store=store):
+            middleware = RequestProfilingMiddleware(view)
+            for _ in range(3):
+                middleware(request)
+
+        stats = store.snapshot()['views']['home']
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['queries']['max'], N_PLUS_ONE_REPEATS + 1)
+        self.assertEqual(len(store.views['home'].samples['view_ms']), 2)
+        self.assertGreater(stats['template_ms']['max'], 0)
+        self.assertEqual(len(stats['repeated_queries']), 1)
+        self.assertTrue(stats['repeated_queries'][0]['n_plus_one'])
+        self.assertEqual(stats['repeated_queries'][0]['requests'], 3)
+
+    def test_query_hook_added_inside_an_execute_wrapper_block_survives_it(self):
+        def record(execute, sql, params, many, context):
+            return execute(sql, params, many, context)
+
+        with mock.patch.object(connection, 'execute_wrappers', []):
+            with connection.execute_wrapper(record):
+                # As when the block's first query opens the connection
+                profiling._instrument_connection(None, connection)
+            self.assertEqual(connection.execute_wrappers, [profiling._record_query])
+
+    def test_profiling_endpoint_is_staff_only(self):
+        user = User.objects.create_user(
+            username='staff', email='staff@example.com', phone_number='0733333333', password='pw'
+        )
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('profiling_stats')).status_code, 302)
+
+        user.is_staff = True
+        user.save()
+        response = self.client.get(reverse('profiling_stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('views', response.json())
+
+
+class StepStatsTests(SimpleTestCase):
+    def test_summary_reports_percentiles_in_milliseconds(self):
+        stats = StepStats()
+        for n in range(1, 101):
+            stats.record(n / 1000, n % 7, ok=n != 50)
+        summary = stats.summary()
+        self.assertEqual((summary['requests'], summary['errors'], summary['queries']), (100, 1, 6))
+        self.assertEqual((summary['p50_ms'], summary['p95_ms'], summary['p99_ms']), (50.0, 95.0, 99.0))
+        self.assertEqual(StepStats().summary()['p99_ms'], 0)
+
+
+class SeedDataTests(TestCase):
+    def generated(self):
+        products = Product.objects.filter(sku__startswith='GEN-')
+        return {
+            'products': products.count(),
+            'specifications': ProductSpecification.objects.filter(product__in=products).count(),
+            'shoppers': User.objects.filter(username__startswith='gen_shopper').count(),
+            'orders': Order.objects.filter(order_number__startswith='GEN-').count(),
+            'payments': Payment.objects.filter(order__order_number__startswith='GEN-').count(),
+            'carts': Cart.objects.filter(user__username__startswith='gen_shopper').count(),
+        }
+
+    def test_scale_grows_the_generated_catalog(self):
+        call_command('seed_data', scale=200, batch_size=64, stdout=io.StringIO())
+        self.assertEqual(self.generated(), {
+            'products': 200, 'specifications': 800, 'shoppers': 50, 'orders': 20, 'payments': 20, 'carts': 4
+        })
+        generated = Product.objects.filter(sku__startswith='GEN-')
+        self.assertEqual(
+            generated.aggregate(total=Sum('rating_count'))['total'],
+            Review.objects.filter(product__in=generated).count()
+        )
+
+        # A larger scale only adds what is missing
+        call_command('seed_data', scale=1200, batch_size=64, stdout=io.StringIO())
+        self.assertEqual(self.generated(), {
+            'products': 1200, 'specifications': 4800, 'shoppers': 60, 'orders': 120, 'payments': 120, 'carts': 24
+        })
+
+
+class QueryBudgetTests:
+    """
+    Pins the number of queries and the peak memory allocated by each hot view
+    on a cold cache. Subclasses seed catalogs of different sizes against the
+    same budgets, and the product page's product gets more reviews in the
+    larger catalog. product_detail is pinned at its exact count, so a query
+    per review or image fails at either size; the other views keep two
+    queries of headroom, fewer than the products, cart lines or orders they
+    render.
+    """
+
+    SCALE = None
+
+    # view: (queries, peak allocated KiB)
+    BUDGETS = {
+        'home': (14, 2048),
+        'category_products': (12, 1536),
+        'search': (7, 512),
+        'product_detail': (18, 1024),
+        'cart': (16, 768),
+        'checkout': (16, 768),
+        'order_list': (9, 512),
+        'order_detail': (16, 512),
+        'account_overview': (10, 384),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', scale=cls.SCALE, stdout=io.StringIO())
+        # Seeded banners have no image, which the home slider requires
+        Banner.objects.update(image='banners/test.jpg')
+
+        busiest = Order.objects.values('user').annotate(orders=Count('id')).order_by('-orders', 'user')[0]
+        cls.user = User.objects.get(pk=busiest['user'])
+        cls.order = Order.objects.filter(user=cls.user).order_by('pk').first()
+        cls.product = Product.objects.filter(is_active=True).order_by('-rating_count', 'pk').first()
+
+        # Reviews of the product page's product grow with the catalog, so a
+        # per-review query shows up at the larger size
+        reviewers = User.objects.exclude(pk=cls.user.pk).exclude(review__product=cls.product)
+        Review.objects.bulk_create(
+            Review(product=cls.product, user=reviewer, rating=4, title='t', comment='c', is_approved=True)
+            for reviewer in reviewers.order_by('pk')[:cls.SCALE // 50]
+        )
+
+        cart, _ = Cart.objects.get_or_create(user=cls.user)
+        cart.items.all().delete()
+        for product in Product.objects.filter(is_active=True, stock__gt=0).order_by('category_id', 'pk')[::50][:5]:
+            CartItem.objects.create(cart=cart, product=product, quantity=1, price=product.price)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def get(self, name, *args, **params):
+        return self.client.get(reverse(name, args=args), params)
+
+    def order_list(self):
+        # /orders/ resolves to account_orders first, so call the view directly
+        request = RequestFactory().get('/orders/')
+        request.user = self.user
+        request.session = self.client.session
+        return views.order_list(request)
+
+    def assertWithinBudget(self, view, request):
+        max_queries, max_kib = self.BUDGETS[view]
+        # Warm up once so template compilation and imports are not measured
+        request()
+        cache.clear()
+
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                response = request()
+            peak_kib = tracemalloc.get_traced_memory()[1] / 1024
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(queries), max_queries,
+            f'{view} ran {len(queries)} queries:\n' + '\n'.join(query['sql'] for query in queries)
+        )
+        self.assertLessEqual(peak_kib, max_kib, f'{view} allocated {peak_kib:.0f} KiB')
+
+    def test_home(self):
+        self.assertWithinBudget('home', lambda: self.get('home'))
+
+    def test_category_products(self):
+        self.assertWithinBudget('category_products', lambda: self.get('category_products', 'electronics'))
+
+    def test_search(self):
+        with self.settings(TEMPLATES=SEARCH_TEMPLATES):
+            self.assertWithinBudget('search', lambda: self.get('search', q=self.product.name.split()[-1]))
+
+    def test_product_detail(self):
+        self.assertWithinBudget('product_detail', lambda: self.get('product_detail', self.product.slug))
+
+    def test_cart(self):
+        self.assertWithinBudget('cart', lambda: self.get('cart'))
+
+    def test_checkout(self):
+        self.assertWithinBudget('checkout', lambda: self.get('checkout'))
+
+    def test_order_list(self):
+        self.assertWithinBudget('order_list', self.order_list)
+
+    def test_order_detail(self):
+        self.assertWithinBudget('order_detail', lambda: self.get('order_detail', self.order.id))
+
+    def test_account_overview(self):
+        self.assertWithinBudget('account_overview', lambda: self.get('account_overview'))
+
+
+class SmallCatalogQueryBudgetTests(QueryBudgetTests, TestCase):
+    SCALE = 100
+
+
+class LargeCatalogQueryBudgetTests(QueryBudgetTests, TestCase):
+    SCALE = 2000
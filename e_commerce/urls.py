@@ -4,6 +4,7 @@ from e_commerce import views
 urlpatterns = [
     path('', views.home, name='home'),
     path('search/', views.search, name='search'),
+    path('api/search/suggest/', views.search_suggest, name='search_suggest'),
     
     # Main account pages
     path('account/', views.account_overview, name='account_overview'),
@@ -27,6 +28,9 @@ urlpatterns = [
     path('api/notification/<int:notification_id>/read/', views.api_mark_notification_read, name='api_mark_notification_read'),
     path('api/notifications/read-all/', views.api_mark_all_notifications_read, name='api_mark_all_notifications_read'),
 
+    # Request profiling (staff only)
+    path('api/profiling/', views.profiling_stats, name='profiling_stats'),
+
    
     path('wishlist/', views.wishlist, name='wishlist'),
     path('orders/', views.orders, name='orders'),
@@ -40,6 +44,7 @@ urlpatterns = [
     path('health-beauty/', views.health_beauty, name='health'),
     path('sports/', views.sports, name='sports'),
     path('product/<slug:slug>/', views.product_detail, name='product_detail'),
+    path('product/<int:product_id>/review/', views.submit_review, name='submit_review'),
     path('add-to-cart/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
     path('remove-from-cart/<int:product_id>/', views.remove_from_cart, name='remove_from_cart'),
     path('update-cart/<int:product_id>/', views.update_cart, name='update_cart'),
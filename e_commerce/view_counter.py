@@ -0,0 +1,105 @@
+"""
+Write-behind product view counting.
+
+Product page views are counted in process memory and written back in bulk
+by a background flusher thread every VIEW_COUNT_FLUSH_INTERVAL seconds (or
+sooner once VIEW_COUNT_MAX_PENDING products are waiting). Each flush issues
+one ``UPDATE ... SET views = views + n`` per distinct increment, so concurrent
+processes never overwrite each other's counts. Stored totals are eventually
+consistent; pending views are flushed at interpreter exit as well.
+"""
+
+import atexit
+import logging
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from .models import Product
+
+
+logger = logging.getLogger(__name__)
+
+VIEW_COUNT_FLUSH_INTERVAL = getattr(settings, 'VIEW_COUNT_FLUSH_INTERVAL', 30)
+VIEW_COUNT_MAX_PENDING = getattr(settings, 'VIEW_COUNT_MAX_PENDING', 1000)
+
+_pending = Counter()
+_pending_lock = threading.Lock()
+_wake = threading.Event()
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def record_view(product_id):
+    """Count one view of ``product_id``; no database write happens here"""
+    with _pending_lock:
+        _pending[product_id] += 1
+        backlog = len(_pending)
+
+    _ensure_flusher()
+    if backlog >= VIEW_COUNT_MAX_PENDING:
+        _wake.set()
+
+
+def pending_views(product_id):
+    """Views recorded in this process but not written yet"""
+    return _pending.get(product_id, 0)
+
+
+def flush_views():
+    """Write buffered views to the database; returns the number of views written"""
+    with _pending_lock:
+        if not _pending:
+            return 0
+        counts = dict(_pending)
+        _pending.clear()
+
+    # One UPDATE per distinct increment rather than one per product
+    by_increment = defaultdict(list)
+    for product_id, increment in counts.items():
+        by_increment[increment].append(product_id)
+
+    try:
+        with transaction.atomic():
+            for increment, product_ids in by_increment.items():
+                Product.objects.filter(pk__in=product_ids).update(views=F('views') + increment)
+    except Exception:
+        # Put the counts back so the next flush retries them
+        with _pending_lock:
+            _pending.update(counts)
+        raise
+
+    return sum(counts.values())
+
+
+def _run_flusher():
+    while True:
+        _wake.wait(VIEW_COUNT_FLUSH_INTERVAL)
+        _wake.clear()
+        try:
+            flush_views()
+        except Exception:
+            logger.exception('Failed to flush product view counts')
+        finally:
+            connection.close()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_run_flusher, name='product-view-flusher', daemon=True)
+            _flusher.start()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush_views()
+    except Exception:
+        logger.exception('Failed to flush product view counts at exit')
@@ -1,6 +1,7 @@
 
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.db.models import Q, Count, Avg
 from django.core.paginator import Paginator
@@ -33,6 +34,22 @@ from django.contrib.auth.tokens import default_token_generator
 from django.template.loader import render_to_string
 from django.http import JsonResponse
 from .models import User
+from .home_rails import get_home_rails
+from .cart_summary import invalidate_cart_summary
+from .search import search_products, similar_products
+from .suggest import suggest
+from .facets import get_facet_index, parse_ids, parse_price
+from .pagination import paginate
+from .category_tree import get_category_or_404, get_category_tree
+from .rankings import Rail, ranked_products
+from .view_counter import pending_views, record_view
+from .inventory import InsufficientStock, reserve_stock, restore_stock
+from .delivery import get_delivery_table
+from .order_stats import get_order_stats
+from .reviewed_products import has_reviewed, reviewed_product_ids, unreviewed
+from .mpesa import DarajaUnavailable, aget_access_token, daraja, get_access_token
+from . import payment_events, profiling
+from .mpesa_callbacks import record_callback
 import json
 
 
@@ -275,137 +292,8 @@ def check_email_exists(request):
 def home(request):
     """Home page view with Jumia-style layout"""
     
-    # Active banners for hero slider
-    banners = Banner.objects.filter(
-        is_active=True
-    ).filter(
-        Q(start_date__lte=datetime.now()) | Q(start_date__isnull=True)
-    ).filter(
-        Q(end_date__gte=datetime.now()) | Q(end_date__isnull=True)
-    )[:5]
-    
-    # Main categories for sidebar
-    main_categories = Category.objects.filter(
-        is_active=True,
-        parent__isnull=True
-    ).prefetch_related('children')[:12]
-    
-    # Flash Sales - products with discount
-    flash_sales = Product.objects.filter(
-        is_active=True,
-        stock__gt=0,
-        compare_price__gt=0
-    ).exclude(
-        compare_price=0
-    ).order_by('-total_sales')[:12]
-    
-    # Top Deals - featured products
-    top_deals = Product.objects.filter(
-        is_active=True,
-        is_featured=True,
-        stock__gt=0
-    ).order_by('-total_sales', '-views')[:20]
-    
-    # Best Sellers
-    best_sellers = Product.objects.filter(
-        is_active=True,
-        stock__gt=0
-    ).order_by('-total_sales')[:12]
-    
-    # New Arrivals - products from last 30 days
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    new_arrivals = Product.objects.filter(
-        is_active=True,
-        stock__gt=0,
-        created_at__gte=thirty_days_ago
-    ).order_by('-created_at')[:12]
-    
-    # Electronics category
-    electronics = None
-    electronics_products = []
-    try:
-        electronics = Category.objects.get(slug='electronics', is_active=True)
-        electronics_products = Product.objects.filter(
-            category__in=[electronics] + list(electronics.children.all()),
-            is_active=True,
-            stock__gt=0
-        ).order_by('-total_sales')[:12]
-    except Category.DoesNotExist:
-        pass
-    
-    # Fashion category
-    fashion = None
-    fashion_products = []
-    try:
-        fashion = Category.objects.get(slug='fashion', is_active=True)
-        fashion_products = Product.objects.filter(
-            category__in=[fashion] + list(fashion.children.all()),
-            is_active=True,
-            stock__gt=0
-        ).order_by('-total_sales')[:12]
-    except Category.DoesNotExist:
-        pass
-    
-    # Home & Kitchen category
-    home_kitchen = None
-    home_kitchen_products = []
-    try:
-        home_kitchen = Category.objects.get(slug='home-kitchen', is_active=True)
-        home_kitchen_products = Product.objects.filter(
-            category__in=[home_kitchen] + list(home_kitchen.children.all()),
-            is_active=True,
-            stock__gt=0
-        ).order_by('-total_sales')[:12]
-    except Category.DoesNotExist:
-        pass
-    
-    # Phones & Tablets category
-    phones_tablets = None
-    phones_products = []
-    try:
-        phones_tablets = Category.objects.get(slug='phones-tablets', is_active=True)
-        phones_products = Product.objects.filter(
-            category__in=[phones_tablets] + list(phones_tablets.children.all()),
-            is_active=True,
-            stock__gt=0
-        ).order_by('-total_sales')[:12]
-    except Category.DoesNotExist:
-        pass
-    
-    # Top brands
-    top_brands = Brand.objects.filter(
-        is_active=True,
-        products__is_active=True
-    ).annotate(
-        product_count=Count('products')
-    ).filter(
-        product_count__gt=0
-    ).order_by('-product_count')[:12]
-    
-    # Top vendors
-    top_vendors = Vendor.objects.filter(
-        is_active=True,
-        is_verified=True
-    ).order_by('-rating')[:8]
-    
-    context = {
-        'banners': banners,
-        'main_categories': main_categories,
-        'flash_sales': flash_sales,
-        'top_deals': top_deals,
-        'best_sellers': best_sellers,
-        'new_arrivals': new_arrivals,
-        'electronics': electronics,
-        'electronics_products': electronics_products,
-        'fashion': fashion,
-        'fashion_products': fashion_products,
-        'home_kitchen': home_kitchen,
-        'home_kitchen_products': home_kitchen_products,
-        'phones_tablets': phones_tablets,
-        'phones_products': phones_products,
-        'top_brands': top_brands,
-        'top_vendors': top_vendors,
-    }
+    # Banners, categories and product rails are precomputed and cached
+    context = get_home_rails()
     
     return render(request, 'home.html', context)
 
@@ -420,21 +308,19 @@ from decimal import Decimal
 def category_products(request, slug):
     """Category products listing with filters"""
     
-    # Get category
-    category = get_object_or_404(Category, slug=slug, is_active=True)
-    
-    # Get all subcategories
-    subcategories = category.children.filter(is_active=True)
+    # Get category (from the in-memory category tree)
+    tree = get_category_tree()
+    category = get_category_or_404(slug)
     
-    # Get all categories in this hierarchy (parent + children)
-    category_ids = [category.id] + list(subcategories.values_list('id', flat=True))
+    # Get all categories in this hierarchy (the category and its descendants)
+    category_ids = tree.descendant_ids(category.id)
     
     # Base queryset
     products = Product.objects.filter(
         category_id__in=category_ids,
         is_active=True,
         stock__gt=0
-    ).select_related('brand', 'category', 'vendor').prefetch_related('images', 'reviews')
+    ).select_related('brand', 'category', 'vendor').prefetch_related('images')
     
     # Get filter parameters
     min_price = request.GET.get('min_price')
@@ -461,94 +347,56 @@ def category_products(request, slug):
         products = products.filter(brand_id__in=brand_ids)
     
     if subcategory_ids:
-        products = products.filter(category_id__in=subcategory_ids)
+        products = products.filter(category_id__in=set().union(
+            *(tree.descendant_ids(subcategory_id) for subcategory_id in parse_ids(subcategory_ids))
+        ))
     
+    rating_value = None
     if rating:
         try:
             rating_value = int(rating)
             # Filter products with average rating >= rating_value
-            products = products.annotate(
-                avg_rating=Avg('reviews__rating')
-            ).filter(avg_rating__gte=rating_value)
+            products = products.filter(rating_avg__gte=rating_value)
         except:
             pass
     
     # Apply sorting
+    # (id breaks ties so pages never repeat or skip products)
     if sort_by == 'price_low':
-        products = products.order_by('price')
+        products = products.order_by('price', 'id')
     elif sort_by == 'price_high':
-        products = products.order_by('-price')
+        products = products.order_by('-price', '-id')
     elif sort_by == 'newest':
-        products = products.order_by('-created_at')
+        products = products.order_by('-created_at', '-id')
     elif sort_by == 'rating':
-        products = products.annotate(
-            avg_rating=Avg('reviews__rating')
-        ).order_by('-avg_rating')
+        products = products.order_by('-rating_avg', '-rating_count', '-id')
     else:  # popular (default)
-        products = products.order_by('-total_sales', '-views')
-    
-    # Get price range for all products in category (for filter slider)
-    price_range = Product.objects.filter(
-        category_id__in=category_ids,
-        is_active=True,
-        stock__gt=0
-    ).aggregate(
-        min_price=Min('price'),
-        max_price=Max('price')
+        products = products.order_by('-total_sales', '-views', '-id')
+    
+    # Price range, brand, subcategory and specification counts under the
+    # current filters, answered from the category's facet index
+    facets = get_facet_index(category).facets(
+        min_price=parse_price(min_price),
+        max_price=parse_price(max_price),
+        brand_ids=parse_ids(brand_ids),
+        subcategory_ids=parse_ids(subcategory_ids),
+        rating=rating_value,
     )
     
-    # Get brands available in this category
-    brands = Brand.objects.filter(
-        products__category_id__in=category_ids,
-        products__is_active=True,
-        products__stock__gt=0,
-        is_active=True
-    ).annotate(
-        product_count=Count('products', filter=Q(
-            products__category_id__in=category_ids,
-            products__is_active=True,
-            products__stock__gt=0
-        ))
-    ).filter(product_count__gt=0).order_by('name')
-    
-    # Get common specifications for filtering
-    specifications = ProductSpecification.objects.filter(
-        product__category_id__in=category_ids,
-        product__is_active=True
-    ).values('name').annotate(
-        count=Count('id')
-    ).filter(count__gte=5).order_by('name')[:10]
-    
-    # Get specification values for each spec
-    spec_filters = {}
-    for spec in specifications:
-        spec_name = spec['name']
-        spec_values = ProductSpecification.objects.filter(
-            product__category_id__in=category_ids,
-            product__is_active=True,
-            name=spec_name
-        ).values('value').annotate(
-            count=Count('id')
-        ).order_by('value')[:20]
-        
-        if spec_values:
-            spec_filters[spec_name] = spec_values
-    
-    # Pagination
-    page_number = request.GET.get('page', 1)
-    paginator = Paginator(products, 40)  # 40 products per page
-    page_obj = paginator.get_page(page_number)
+    # Pagination (?cursor= switches to keyset pages; the facet total
+    # doubles as the product count)
+    page_obj = paginate(request, products, 40, count=facets['total'])  # 40 products per page
     
     # Build context
     context = {
         'category': category,
-        'subcategories': subcategories,
+        'subcategories': facets['subcategories'],
         'products': page_obj,
         'page_obj': page_obj,
-        'brands': brands,
-        'price_range': price_range,
-        'spec_filters': spec_filters,
-        'total_products': products.count(),
+        'brands': facets['brands'],
+        'price_range': facets['price_range'],
+        'spec_filters': facets['spec_filters'],
+        'total_products': facets['total'],
         
         # Current filters
         'current_min_price': min_price or '',
@@ -567,39 +415,45 @@ def search(request):
     products = Product.objects.none()
     
     if query:
-        products = Product.objects.filter(
-            Q(name__icontains=query) |
-            Q(description__icontains=query) |
-            Q(brand__name__icontains=query) |
-            Q(category__name__icontains=query),
-            is_active=True
-        ).select_related('brand', 'category', 'vendor').distinct()
+        products = search_products(query).select_related('brand', 'category', 'vendor')
     
     # Pagination
-    paginator = Paginator(products, 24)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = paginate(request, products, 24)
+    
+    # Nothing matched: show near-miss spellings instead. Checked on the page
+    # already fetched, so searches that match run no extra query
+    if query and not page_obj.object_list and not page_obj.has_previous():
+        products = similar_products(query).select_related('brand', 'category', 'vendor')
+        page_obj = paginate(request, products, 24)
     
     context = {
         'query': query,
         'products': page_obj,
-        'total_results': products.count(),
+        'total_results': page_obj.paginator.count,
     }
     
     return render(request, 'e_commerce/search.html', context)
 
 
+def search_suggest(request):
+    """Search-as-you-type suggestions served from the in-memory prefix index"""
+    query = request.GET.get('q', '').strip()[:100]
+    
+    return JsonResponse({
+        'query': query,
+        **suggest(query),
+    })
+
+
 def category(request, slug):
     """Category detail view with filtering"""
-    category = get_object_or_404(Category, slug=slug, is_active=True)
+    category = get_category_or_404(slug)
     
     # Get all products in this category and subcategories
-    categories = [category]
-    if category.children.exists():
-        categories.extend(list(category.children.filter(is_active=True)))
+    category_ids = get_category_tree().descendant_ids(category.id)
     
     products = Product.objects.filter(
-        category__in=categories,
+        category_id__in=category_ids,
         is_active=True
     ).select_related('brand', 'category', 'vendor')
     
@@ -630,21 +484,19 @@ def category(request, slug):
     
     # Get brands for filtering
     brands = Brand.objects.filter(
-        products__category__in=categories,
+        products__category_id__in=category_ids,
         is_active=True
     ).distinct()
     
     # Pagination
-    paginator = Paginator(products, 24)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = paginate(request, products, 24)
     
     context = {
         'category': category,
         'products': page_obj,
         'brands': brands,
-        'subcategories': category.children.filter(is_active=True),
-        'total_products': products.count(),
+        'subcategories': get_category_tree().children(category.id),
+        'total_products': page_obj.paginator.count,
     }
     
     return render(request, 'e_commerce/category.html', context)
@@ -652,54 +504,52 @@ def category(request, slug):
 
 def phones(request):
     """Phones & Tablets category"""
-    category = get_object_or_404(Category, slug='phones-tablets', is_active=True)
+    category = get_category_or_404('phones-tablets')
     return category_view(request, category)
 
 
 def electronics(request):
     """Electronics category"""
-    category = get_object_or_404(Category, slug='electronics', is_active=True)
+    category = get_category_or_404('electronics')
     return category_view(request, category)
 
 
 def computing(request):
     """Computing category"""
-    category = get_object_or_404(Category, slug='computing', is_active=True)
+    category = get_category_or_404('computing')
     return category_view(request, category)
 
 
 def fashion(request):
     """Fashion category"""
-    category = get_object_or_404(Category, slug='fashion', is_active=True)
+    category = get_category_or_404('fashion')
     return category_view(request, category)
 
 
 def home_kitchen(request):
     """Home & Kitchen category"""
-    category = get_object_or_404(Category, slug='home-kitchen', is_active=True)
+    category = get_category_or_404('home-kitchen')
     return category_view(request, category)
 
 
 def health_beauty(request):
     """Health & Beauty category"""
-    category = get_object_or_404(Category, slug='health-beauty', is_active=True)
+    category = get_category_or_404('health-beauty')
     return category_view(request, category)
 
 
 def sports(request):
     """Sports & Outdoors category"""
-    category = get_object_or_404(Category, slug='sports-outdoors', is_active=True)
+    category = get_category_or_404('sports-outdoors')
     return category_view(request, category)
 
 
 def category_view(request, category):
     """Helper function for category views"""
-    categories = [category]
-    if category.children.exists():
-        categories.extend(list(category.children.filter(is_active=True)))
+    category_ids = get_category_tree().descendant_ids(category.id)
     
     products = Product.objects.filter(
-        category__in=categories,
+        category_id__in=category_ids,
         is_active=True
     ).select_related('brand', 'category', 'vendor')
     
@@ -730,21 +580,19 @@ def category_view(request, category):
     
     # Get brands for filtering
     brands = Brand.objects.filter(
-        products__category__in=categories,
+        products__category_id__in=category_ids,
         is_active=True
     ).distinct()
     
     # Pagination
-    paginator = Paginator(products, 24)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = paginate(request, products, 24)
     
     context = {
         'category': category,
         'products': page_obj,
         'brands': brands,
-        'subcategories': category.children.filter(is_active=True),
-        'total_products': products.count(),
+        'subcategories': get_category_tree().children(category.id),
+        'total_products': page_obj.paginator.count,
     }
     
     return render(request, 'e_commerce/category.html', context)
@@ -778,7 +626,7 @@ def cart(request):
         subtotal = cart.subtotal
     
     # Get delivery zones for delivery fee calculation
-    delivery_zones = DeliveryZone.objects.filter(is_active=True).order_by('region', 'city')
+    delivery_zones = get_delivery_table().zones
     
     context = {
         'cart': cart,
@@ -845,6 +693,7 @@ def remove_from_cart(request, item_id):
     cart_item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
     product_name = cart_item.product.name
     cart_item.delete()
+    invalidate_cart_summary(request)
     messages.success(request, f'Removed {product_name} from cart.')
     return redirect('cart')
 
@@ -868,6 +717,8 @@ def update_cart(request, item_id):
             cart_item.delete()
             messages.success(request, 'Item removed from cart.')
     
+        invalidate_cart_summary(request)
+    
     return redirect('cart')
 
 
@@ -878,14 +729,12 @@ def wishlist(request):
         user=request.user
     ).select_related('product', 'product__brand', 'product__category').order_by('-created_at')
     
-    # Pagination
-    paginator = Paginator(wishlist_items, 24)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Pagination (exact count: the list changes with every add and remove)
+    page_obj = paginate(request, wishlist_items, 24, cache_count=False)
     
     context = {
         'wishlist_items': page_obj,
-        'total_items': wishlist_items.count(),
+        'total_items': page_obj.paginator.count,
     }
     
     return render(request, 'wishlist.html', context)
@@ -1002,7 +851,7 @@ def order_detail(request, order_number):
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Avg, Count, Q
+from django.db.models import Avg, Count, Prefetch, Q
 from django.http import JsonResponse
 from .models import (
     Product, ProductImage, ProductVariant, 
@@ -1017,39 +866,42 @@ def product_detail(request, slug):
     
     # Get product
     product = get_object_or_404(
-        Product.objects.select_related('vendor', 'category', 'brand')
-        .prefetch_related('images', 'variants', 'specifications', 'reviews__user'),
+        Product.objects.select_related('vendor', 'category', 'brand').prefetch_related(
+            Prefetch('images', queryset=ProductImage.objects.order_by('order', 'id')),
+            Prefetch('variants', queryset=ProductVariant.objects.filter(is_active=True)),
+            Prefetch('specifications', queryset=ProductSpecification.objects.order_by('order'))
+        ),
         slug=slug,
         is_active=True
     )
     
-    # Increment view count
-    product.views += 1
-    product.save(update_fields=['views'])
+    # Count the view; buffered views are written back in bulk
+    record_view(product.id)
+    product.views += pending_views(product.id)
     
-    # Get product images
-    images = product.images.all().order_by('order', 'id')
-    primary_image = images.filter(is_primary=True).first() or images.first()
+    # Get product images (prefetched above, in display order)
+    images = list(product.images.all())
+    primary_image = next((image for image in images if image.is_primary), images[0] if images else None)
     
     # Get variants
-    variants = product.variants.filter(is_active=True)
+    variants = list(product.variants.all())
     
     # Get specifications grouped
-    specifications = product.specifications.all().order_by('order')
+    specifications = list(product.specifications.all())
     
     # Get reviews with statistics
-    reviews = product.reviews.filter(is_approved=True).order_by('-created_at')
-    
-    # Review statistics
-    review_stats = reviews.aggregate(
-        average_rating=Avg('rating'),
-        total_reviews=Count('id'),
-        five_star=Count('id', filter=Q(rating=5)),
-        four_star=Count('id', filter=Q(rating=4)),
-        three_star=Count('id', filter=Q(rating=3)),
-        two_star=Count('id', filter=Q(rating=2)),
-        one_star=Count('id', filter=Q(rating=1)),
-    )
+    reviews = product.reviews.filter(is_approved=True).select_related('user').order_by('-created_at')
+    
+    # Review statistics (maintained on the product row)
+    review_stats = {
+        'average_rating': product.rating_avg,
+        'total_reviews': product.rating_count,
+        'five_star': product.rating_5_count,
+        'four_star': product.rating_4_count,
+        'three_star': product.rating_3_count,
+        'two_star': product.rating_2_count,
+        'one_star': product.rating_1_count,
+    }
     
     # Calculate rating percentages
     total_reviews = review_stats['total_reviews'] or 1
@@ -1070,22 +922,16 @@ def product_detail(request, slug):
             order__status='delivered'
         ).exists()
         
-        # Check if user already reviewed
-        user_review = reviews.filter(user=request.user).first()
-    
-    # Related products (same category)
-    related_products = Product.objects.filter(
-        category=product.category,
-        is_active=True,
-        stock__gt=0
-    ).exclude(id=product.id).order_by('-total_sales')[:12]
+        # Check if user already reviewed (cached per user; fetched only if so)
+        if has_reviewed(request.user, product.id):
+            user_review = reviews.filter(user=request.user).first()
     
-    # You may also like (from same vendor)
-    vendor_products = Product.objects.filter(
-        vendor=product.vendor,
-        is_active=True,
-        stock__gt=0
-    ).exclude(id=product.id).order_by('-total_sales')[:6]
+    # Related products (best sellers of the category and its subcategories)
+    # and more from the vendor
+    related_products, vendor_products = ranked_products(
+        Rail('category', [product.category_id], 'sales', 12, [product.id]),
+        Rail('vendor', [product.vendor_id], 'sales', 6, [product.id])
+    )
     
     # Recently viewed products (from session)
     recently_viewed_ids = request.session.get('recently_viewed', [])
@@ -1107,12 +953,8 @@ def product_detail(request, slug):
             product=product
         ).exists()
     
-    # Breadcrumb categories
-    breadcrumb_categories = []
-    current_category = product.category
-    while current_category:
-        breadcrumb_categories.insert(0, current_category)
-        current_category = current_category.parent
+    # Breadcrumb categories (top level down to the product's category)
+    breadcrumb_categories = get_category_tree().ancestors(product.category_id)
     
     context = {
         'product': product,
@@ -1218,8 +1060,7 @@ def submit_review(request, product_id):
             return redirect('product_detail', slug=product.slug)
         
         # Check if user already reviewed
-        existing_review = Review.objects.filter(user=request.user, product=product).first()
-        if existing_review:
+        if has_reviewed(request.user, product.id, refresh=True):
             messages.error(request, 'You have already reviewed this product.')
             return redirect('product_detail', slug=product.slug)
         
@@ -1272,6 +1113,8 @@ def ajax_add_to_cart(request):
                 cart_item.quantity += quantity
                 cart_item.save()
             
+            invalidate_cart_summary(request)
+            
             return JsonResponse({
                 'success': True,
                 'message': f'Added {product.name} to cart.',
@@ -1369,23 +1212,14 @@ def cart_view(request):
     
     # Get recommended products based on cart items
     if cart_items.exists():
-        # Get categories from cart items
-        cart_categories = [item.product.category_id for item in cart_items if item.product.category]
-        
-        # Get similar products
-        similar_products = Product.objects.filter(
-            category_id__in=cart_categories,
-            is_active=True,
-            stock__gt=0
-        ).exclude(
-            id__in=[item.product_id for item in cart_items]
-        ).order_by('-total_sales')[:8]
+        # Best sellers of the cart items' categories
+        cart_categories = {item.product.category_id for item in cart_items if item.product.category_id}
+        similar_products, = ranked_products(
+            Rail('category', cart_categories, 'sales', 8, [item.product_id for item in cart_items])
+        )
     else:
         # Show popular products if cart is empty
-        similar_products = Product.objects.filter(
-            is_active=True,
-            stock__gt=0
-        ).order_by('-total_sales')[:8]
+        similar_products, = ranked_products(Rail('all', [0], 'sales', 8))
     
     context = {
         'cart': cart,
@@ -1447,6 +1281,8 @@ def update_cart_item(request, item_id):
                 cart_item.quantity = quantity
                 cart_item.save()
             
+            invalidate_cart_summary(request)
+            
             # Recalculate totals
             cart = cart_item.cart
             item_total = cart_item.total_price
@@ -1484,6 +1320,7 @@ def remove_cart_item(request, item_id):
             
             cart = cart_item.cart
             cart_item.delete()
+            invalidate_cart_summary(request)
             
             # Recalculate totals
             cart_subtotal = cart.subtotal
@@ -1514,6 +1351,7 @@ def clear_cart(request):
         try:
             cart = Cart.objects.get(user=request.user)
             cart.items.all().delete()
+            invalidate_cart_summary(request)
             
             messages.success(request, 'Cart cleared successfully')
             return redirect('cart')
@@ -1582,6 +1420,8 @@ def add_to_cart(request, product_id):
                     price=price
                 )
             
+            invalidate_cart_summary(request)
+            
             return JsonResponse({
                 'success': True,
                 'message': 'Product added to cart',
@@ -1632,11 +1472,10 @@ def checkout(request):
     addresses = request.user.addresses.all().order_by('-is_default', '-created_at')
     default_address = addresses.filter(is_default=True).first() or addresses.first()
     
-    # Get active pickup stations
-    pickup_stations = PickupStation.objects.filter(is_active=True).order_by('city', 'name')
-    
-    # Get delivery zones for pricing
-    delivery_zones = DeliveryZone.objects.filter(is_active=True)
+    # Active pickup stations and delivery zones (in-memory delivery table)
+    delivery = get_delivery_table()
+    pickup_stations = delivery.stations
+    delivery_zones = delivery.zones
     
     # Calculate subtotal
     subtotal = cart.subtotal
@@ -1644,17 +1483,16 @@ def checkout(request):
     # Default delivery method and fee
     delivery_method = request.session.get('delivery_method', 'pickup_station')
     
-    # Calculate delivery fee based on method
-    if delivery_method == 'home_delivery' and default_address:
+    # Calculate delivery fee based on method, as place_order will charge it
+    if delivery_method == 'home_delivery':
         # Get delivery fee for user's location
-        delivery_zone = delivery_zones.filter(
-            region=default_address.region,
-            city=default_address.city
-        ).first()
-        delivery_fee = delivery_zone.delivery_fee if delivery_zone else Decimal('300.00')
+        delivery_fee = delivery.quote('home_delivery', default_address).fee
     else:
-        # Pickup station default fee
-        delivery_fee = Decimal('0.00')
+        # Selected pickup station's fee, or the default station's
+        delivery_fee = delivery.quote(
+            'pickup_station',
+            station_id=request.session.get('pickup_station_id')
+        ).fee
     
     # Get applied coupon from session
     coupon_code = request.session.get('coupon_code')
@@ -1736,29 +1574,22 @@ def update_delivery_method(request):
             subtotal = cart.subtotal
             
             # Calculate delivery fee
+            delivery = get_delivery_table()
             if delivery_method == 'pickup_station':
                 if station_id:
-                    station = get_object_or_404(PickupStation, id=station_id, is_active=True)
+                    if delivery.station(station_id) is None:
+                        return JsonResponse({'error': 'Pickup station not found'}, status=404)
                     request.session['pickup_station_id'] = station_id
-                    # Use station-specific fee if available, otherwise default
-                    delivery_fee = getattr(station, 'delivery_fee', Decimal('150.00'))
-                else:
-                    delivery_fee = Decimal('150.00')
+                # Station-specific fee, or the default station's
+                delivery_fee = delivery.quote('pickup_station', station_id=station_id).fee
             else:  # home_delivery
+                address = None
                 if address_id:
                     address = get_object_or_404(Address, id=address_id, user=request.user)
                     request.session['delivery_address_id'] = address_id
-                    
-                    # Get delivery zone for address
-                    delivery_zone = DeliveryZone.objects.filter(
-                        region=address.region,
-                        city=address.city,
-                        is_active=True
-                    ).first()
-                    
-                    delivery_fee = delivery_zone.delivery_fee if delivery_zone else Decimal('300.00')
-                else:
-                    delivery_fee = Decimal('300.00')
+                
+                # Delivery zone fee for the address, or the default fee
+                delivery_fee = delivery.quote('home_delivery', address).fee
             
             # Get discount from session
             discount = Decimal('0.00')
@@ -1892,7 +1723,6 @@ from django.db import transaction
 from django.utils import timezone
 from django.conf import settings
 from .models import Order, Payment
-import requests
 import base64
 import json
 from datetime import datetime
@@ -1931,14 +1761,14 @@ def payment_page(request, order_id):
 
 
 @login_required
-def initiate_mpesa_payment(request, payment_id):
-    """Initiate M-Pesa STK Push"""
+async def initiate_mpesa_payment(request, payment_id):
+    """Initiate M-Pesa STK Push (async: the Daraja calls don't hold a worker)"""
     if request.method == 'POST':
         try:
-            payment = get_object_or_404(
+            payment = await aget_object_or_404(
                 Payment.objects.select_related('order'),
                 id=payment_id,
-                order__user=request.user
+                order__user=await request.auser()
             )
             
             if payment.status == 'completed':
@@ -1968,7 +1798,7 @@ def initiate_mpesa_payment(request, payment_id):
                 }, status=400)
             
             # Get M-Pesa access token
-            access_token = get_mpesa_access_token()
+            access_token = await aget_access_token()
             
             if not access_token:
                 return JsonResponse({
@@ -2009,15 +1839,17 @@ def initiate_mpesa_payment(request, payment_id):
             }
             
             # Make STK Push request
-            response = requests.post(stk_push_url, json=payload, headers=headers)
+            response = await daraja.apost(stk_push_url, 'stk_push', json=payload, headers=headers)
             response_data = response.json()
             
             if response.status_code == 200 and response_data.get('ResponseCode') == '0':
                 # Update payment with checkout request ID
                 payment.status = 'processing'
                 payment.mpesa_phone = phone_number
+                payment.checkout_request_id = response_data.get('CheckoutRequestID', '')
+                payment.merchant_request_id = response_data.get('MerchantRequestID', '')
                 payment.response_data = response_data
-                payment.save()
+                await payment.asave()
                 
                 return JsonResponse({
                     'success': True,
@@ -2030,12 +1862,16 @@ def initiate_mpesa_payment(request, payment_id):
                 payment.status = 'failed'
                 payment.failure_reason = error_message
                 payment.response_data = response_data
-                payment.save()
+                await payment.asave()
                 
                 return JsonResponse({
                     'error': error_message
                 }, status=400)
                 
+        except DarajaUnavailable:
+            return JsonResponse({
+                'error': 'M-Pesa is temporarily unavailable. Please try again shortly.'
+            }, status=503)
         except Exception as e:
             return JsonResponse({
                 'error': str(e)
@@ -2045,42 +1881,42 @@ def initiate_mpesa_payment(request, payment_id):
 
 
 def get_mpesa_access_token():
-    """Get M-Pesa OAuth access token"""
-    try:
-        consumer_key = settings.MPESA_CONSUMER_KEY
-        consumer_secret = settings.MPESA_CONSUMER_SECRET
-        auth_url = settings.MPESA_AUTH_URL
-        
-        # Encode credentials
-        credentials = base64.b64encode(
-            f"{consumer_key}:{consumer_secret}".encode()
-        ).decode('utf-8')
-        
-        headers = {
-            "Authorization": f"Basic {credentials}"
-        }
-        
-        response = requests.get(auth_url, headers=headers)
-        
-        if response.status_code == 200:
-            return response.json().get('access_token')
-        
-        return None
-        
-    except Exception as e:
-        print(f"Error getting access token: {e}")
-        return None
+    """Get M-Pesa OAuth access token (cached and refreshed ahead of expiry)"""
+    return get_access_token()
 
 
 @login_required
-def check_payment_status(request, payment_id):
-    """Check M-Pesa payment status"""
+async def check_payment_status(request, payment_id):
+    """
+    Check M-Pesa payment status.
+
+    Long-polls when the client passes the status it already has
+    (``?status=processing&wait=25``): the request is held until the payment
+    changes or ``wait`` seconds pass, instead of the page polling every few
+    seconds.
+    """
     try:
-        payment = get_object_or_404(
-            Payment.objects.select_related('order'),
-            id=payment_id,
-            order__user=request.user
-        )
+        queryset = Payment.objects.select_related('order').filter(order__user=await request.auser())
+        known_status = request.GET.get('status')
+        try:
+            wait = max(0.0, float(request.GET.get('wait') or 0))
+        except ValueError:
+            wait = 0.0
+        
+        retry_after = None
+        if wait and not payment_events.long_poll_supported(request):
+            # Not served by ASGI: answer now and let the page poll
+            wait = 0
+            retry_after = payment_events.POLL_INTERVAL
+        
+        if wait:
+            with payment_events.hub.watch(payment_id) as changed:
+                payment = await aget_object_or_404(queryset, id=payment_id)
+                if payment.status == known_status:
+                    if await payment_events.wait_for(changed, wait):
+                        payment = await queryset.aget(id=payment_id)
+        else:
+            payment = await aget_object_or_404(queryset, id=payment_id)
         
         return JsonResponse({
             'status': payment.status,
@@ -2089,6 +1925,7 @@ def check_payment_status(request, payment_id):
             'transaction_id': payment.transaction_id,
             'mpesa_receipt': payment.mpesa_receipt,
             'order_number': payment.order.order_number,
+            'retry_after': retry_after,
         })
         
     except Exception as e:
@@ -2099,86 +1936,25 @@ def check_payment_status(request, payment_id):
 
 @csrf_exempt
 def mpesa_callback(request):
-    """M-Pesa callback endpoint"""
+    """
+    M-Pesa callback endpoint. The payload is stored in the callback inbox and
+    applied by the process_mpesa_callbacks worker, so Safaricom gets its
+    acknowledgement without waiting on payment and order updates.
+    """
     try:
-        # Get callback data
         callback_data = json.loads(request.body)
-        
-        # Extract data from callback
-        body = callback_data.get('Body', {})
-        stk_callback = body.get('stkCallback', {})
-        
-        result_code = stk_callback.get('ResultCode')
-        result_desc = stk_callback.get('ResultDesc')
-        checkout_request_id = stk_callback.get('CheckoutRequestID')
-        
-        # Find payment by checkout request ID
-        payment = Payment.objects.filter(
-            response_data__CheckoutRequestID=checkout_request_id
-        ).first()
-        
-        if not payment:
-            return JsonResponse({
-                'ResultCode': 1,
-                'ResultDesc': 'Payment not found'
-            })
-        
-        # Update payment based on result
-        if result_code == 0:
-            # Payment successful
-            callback_metadata = stk_callback.get('CallbackMetadata', {})
-            items = callback_metadata.get('Item', [])
-            
-            # Extract transaction details
-            mpesa_receipt = None
-            amount = None
-            phone = None
-            transaction_date = None
-            
-            for item in items:
-                name = item.get('Name')
-                value = item.get('Value')
-                
-                if name == 'MpesaReceiptNumber':
-                    mpesa_receipt = value
-                elif name == 'Amount':
-                    amount = value
-                elif name == 'PhoneNumber':
-                    phone = value
-                elif name == 'TransactionDate':
-                    transaction_date = value
-            
-            # Update payment
-            payment.status = 'completed'
-            payment.mpesa_receipt = mpesa_receipt
-            payment.completed_at = timezone.now()
-            payment.response_data = callback_data
-            payment.save()
-            
-            # Update order
-            order = payment.order
-            order.status = 'confirmed'
-            order.confirmed_at = timezone.now()
-            order.save()
-            
-        else:
-            # Payment failed
-            payment.status = 'failed'
-            payment.failure_reason = result_desc
-            payment.response_data = callback_data
-            payment.save()
-        
-        return JsonResponse({
-            'ResultCode': 0,
-            'ResultDesc': 'Success'
-        })
-        
-    except Exception as e:
-        print(f"Callback error: {e}")
+    except ValueError as e:
         return JsonResponse({
             'ResultCode': 1,
-            'ResultDesc': str(e)
+            'ResultDesc': f'Invalid payload: {e}'
         })
+    
+    record_callback(callback_data)
+    
+    return JsonResponse({
+        'ResultCode': 0,
+        'ResultDesc': 'Accepted'
+    })
 
 
 @login_required
@@ -2239,6 +2015,7 @@ def place_order(request):
                 delivery_address = None
                 pickup_station = None
                 delivery_fee = Decimal('0.00')
+                delivery = get_delivery_table()
                 
                 if delivery_method == 'home_delivery':
                     address_id = request.session.get('delivery_address_id')
@@ -2250,17 +2027,11 @@ def place_order(request):
                         delivery_address = get_object_or_404(Address, id=address_id, user=request.user)
                         
                         # Calculate delivery fee based on address location
-                        delivery_zone = DeliveryZone.objects.filter(
-                            region=delivery_address.region,
-                            city=delivery_address.city,
-                            is_active=True
-                        ).first()
+                        quote = delivery.quote('home_delivery', delivery_address)
+                        delivery_fee = quote.fee
                         
-                        if delivery_zone:
-                            delivery_fee = delivery_zone.delivery_fee
-                        else:
+                        if quote.zone is None:
                             # Default fee if zone not found
-                            delivery_fee = Decimal('300.00')
                             messages.warning(
                                 request, 
                                 f'Delivery zone for {delivery_address.city}, {delivery_address.region} not found. Using default fee of KSh 300.'
@@ -2275,18 +2046,17 @@ def place_order(request):
                         # Try to get from POST data
                         station_id = request.POST.get('pickup_station_id')
                     
-                    if station_id:
-                        pickup_station = get_object_or_404(PickupStation, id=station_id, is_active=True)
-                        # Use pickup station's delivery fee
-                        delivery_fee = pickup_station.delivery_fee
-                    else:
-                        # Use first available station as default
-                        pickup_station = PickupStation.objects.filter(is_active=True).first()
-                        if pickup_station:
-                            delivery_fee = pickup_station.delivery_fee
+                    # Selected station, or the first available one as default
+                    quote = delivery.quote('pickup_station', station_id=station_id)
+                    pickup_station = quote.station
+                    if pickup_station is None:
+                        if station_id:
+                            messages.error(request, 'The selected pickup station is not available')
                         else:
                             messages.error(request, 'No pickup stations available')
-                            return redirect('checkout')
+                        return redirect('checkout')
+                    # Use pickup station's delivery fee
+                    delivery_fee = quote.fee
                 
                 # Calculate amounts
                 subtotal = cart.subtotal
@@ -2349,39 +2119,9 @@ def place_order(request):
                     customer_note=f'Coupon: {coupon_code}' if coupon_code else ''
                 )
                 
-                # Create order items and update stock
-                for cart_item in cart_items:
-                    # Check stock availability
-                    available_stock = cart_item.variant.stock if cart_item.variant else cart_item.product.stock
-                    
-                    if available_stock < cart_item.quantity:
-                        raise Exception(
-                            f'Insufficient stock for {cart_item.product.name}. '
-                            f'Only {available_stock} available.'
-                        )
-                    
-                    # Create order item
-                    OrderItem.objects.create(
-                        order=order,
-                        product=cart_item.product,
-                        variant=cart_item.variant,
-                        vendor=cart_item.product.vendor,
-                        product_name=cart_item.product.name,
-                        product_sku=cart_item.product.sku,
-                        variant_name=cart_item.variant.name if cart_item.variant else '',
-                        quantity=cart_item.quantity,
-                        price=cart_item.price,
-                        total=cart_item.total_price
-                    )
-                    
-                    # Update stock
-                    if cart_item.variant:
-                        cart_item.variant.stock -= cart_item.quantity
-                        cart_item.variant.save()
-                    
-                    cart_item.product.stock -= cart_item.quantity
-                    cart_item.product.total_sales += cart_item.quantity
-                    cart_item.product.save()
+                # Create order items and take their stock (raises
+                # InsufficientStock, rolling the order back)
+                reserve_stock(order, cart_items)
                 
                 # Get payment method
                 payment_method = request.POST.get('payment_method', 'mpesa')
@@ -2401,6 +2141,7 @@ def place_order(request):
                 
                 # Clear cart
                 cart.items.all().delete()
+                invalidate_cart_summary(request)
                 
                 # Clear session data
                 session_keys_to_clear = [
@@ -2428,6 +2169,14 @@ def place_order(request):
         except Cart.DoesNotExist:
             messages.error(request, 'Your cart is empty')
             return redirect('cart')
+        except InsufficientStock as e:
+            # One message per cart line that could not be filled
+            for shortfall in e.shortfalls:
+                messages.error(
+                    request,
+                    f'Insufficient stock for {shortfall.name}. Only {shortfall.available} available.'
+                )
+            return redirect('cart')
         except Exception as e:
             messages.error(request, f'Error placing order: {str(e)}')
             return redirect('checkout')
@@ -2524,36 +2273,13 @@ def order_detail(request, order_id):
             }
         ]
     
-    # Estimated delivery date
-    estimated_delivery = None
-    if order.delivery_method == 'pickup_station' and order.pickup_station:
-        # Add 3-5 days for pickup
-        from datetime import timedelta
-        estimated_delivery = order.created_at + timedelta(days=5)
-    elif order.delivery_address:
-        # Check delivery zone for estimated days
-        from .models import DeliveryZone
-        delivery_zone = DeliveryZone.objects.filter(
-            region=order.delivery_address.region,
-            city=order.delivery_address.city,
-            is_active=True
-        ).first()
-        if delivery_zone:
-            from datetime import timedelta
-            estimated_delivery = order.created_at + timedelta(days=delivery_zone.estimated_days)
+    # Estimated delivery date (pickup stations, or the address's delivery zone)
+    estimated_delivery = get_delivery_table().estimated_delivery(order)
     
     # Check which products can be reviewed
     reviewable_items = []
     if order.status == 'delivered':
-        for item in order.items.all():
-            # Check if user has already reviewed this product
-            has_reviewed = Review.objects.filter(
-                product=item.product,
-                user=request.user
-            ).exists()
-            
-            if not has_reviewed:
-                reviewable_items.append(item.product.id)
+        reviewable_items = unreviewed(request.user, [item.product_id for item in order.items.all()])
     
     context = {
         'order': order,
@@ -2588,16 +2314,8 @@ def order_list(request):
     if status_filter != 'all':
         orders = orders.filter(status=status_filter)
     
-    # Get order counts by status
-    from django.db.models import Count, Q
-    status_counts = {
-        'all': Order.objects.filter(user=request.user).count(),
-        'pending': Order.objects.filter(user=request.user, status='pending').count(),
-        'confirmed': Order.objects.filter(user=request.user, status='confirmed').count(),
-        'shipped': Order.objects.filter(user=request.user, status='shipped').count(),
-        'delivered': Order.objects.filter(user=request.user, status='delivered').count(),
-        'cancelled': Order.objects.filter(user=request.user, status='cancelled').count(),
-    }
+    # Get order counts by status (cached, one query on a miss)
+    status_counts = get_order_stats(request.user)
     
     context = {
         'orders': orders,
@@ -2613,32 +2331,31 @@ def cancel_order(request, order_id):
     """Cancel an order"""
     if request.method == 'POST':
         try:
-            order = get_object_or_404(
-                Order.objects.select_related('user').prefetch_related('items__product'),
-                id=order_id,
-                user=request.user
-            )
-            
-            # Check if order can be cancelled
-            if order.status not in ['pending', 'confirmed']:
-                messages.error(request, 'This order cannot be cancelled')
-                return redirect('order_detail', order_id=order.id)
-            
-            # Cancel order
-            order.status = 'cancelled'
-            order.save()
-            
-            # Restore stock
-            for item in order.items.all():
-                item.product.stock += item.quantity
-                item.product.total_sales -= item.quantity
-                item.product.save()
-            
-            # Update payment status
-            payment = order.payments.first()
-            if payment and payment.status == 'completed':
-                payment.status = 'refunded'
-                payment.save()
+            with transaction.atomic():
+                # Lock the order so a repeated request cannot restore stock twice
+                order = get_object_or_404(
+                    Order.objects.select_for_update(),
+                    id=order_id,
+                    user=request.user
+                )
+                
+                # Check if order can be cancelled
+                if order.status not in ['pending', 'confirmed']:
+                    messages.error(request, 'This order cannot be cancelled')
+                    return redirect('order_detail', order_id=order.id)
+                
+                # Cancel order
+                order.status = 'cancelled'
+                order.save()
+                
+                # Restore stock
+                restore_stock(order)
+                
+                # Update payment status
+                payment = order.payments.first()
+                if payment and payment.status == 'completed':
+                    payment.status = 'refunded'
+                    payment.save()
             
             messages.success(request, f'Order {order.order_number} has been cancelled')
             return redirect('order_detail', order_id=order.id)
@@ -2710,8 +2427,9 @@ def account_overview(request):
     user = request.user
     
     # Get statistics
-    orders_count = Order.objects.filter(user=user).count()
-    pending_orders = Order.objects.filter(user=user, status='pending').count()
+    order_stats = get_order_stats(user)
+    orders_count = order_stats['all']
+    pending_orders = order_stats['pending']
     wishlist_count = Wishlist.objects.filter(user=user).count()
     
     # Get recent orders
@@ -2767,7 +2485,7 @@ def account_reviews(request):
     ).prefetch_related('items__product')
     
     # Get already reviewed products
-    reviewed_products = Review.objects.filter(user=request.user).values_list('product_id', flat=True)
+    reviewed_products = reviewed_product_ids(request.user)
     
     context = {
         'delivered_orders': delivered_orders,
@@ -3035,4 +2753,10 @@ def api_mark_all_notifications_read(request):
         })
         
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=400)
\ No newline at end of file
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+@staff_member_required
+def profiling_stats(request):
+    """Sampled request profiles aggregated by this process (see e_commerce.profiling)"""
+    return JsonResponse(profiling.store.snapshot())
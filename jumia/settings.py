@@ -30,6 +30,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'e_commerce',
 ]
 
@@ -47,6 +48,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Inactive unless REQUEST_PROFILING is on; kept last to time the view only
+    'e_commerce.profiling.RequestProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'jumia.urls'
@@ -129,6 +132,72 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'jumia-default',
+    }
+}
+
+# Seconds before the precomputed home page rails are rebuilt
+HOME_RAILS_TTL = 300
+
+# Header cart badge cache
+CART_SUMMARY_TTL = 60 * 60
+
+# Process-wide category tree (menus, listings, breadcrumbs)
+CATEGORY_TREE_TTL = 10 * 60
+
+# Full-text search (PostgreSQL)
+SEARCH_CONFIG = 'english'
+SEARCH_SALES_WEIGHT = 0.1
+
+# Seconds between background rebuilds of the autocomplete prefix index
+SUGGEST_INDEX_TTL = 15 * 60
+
+# Category listing facet indexes kept per process, least recently used
+# dropped first once they hold more than FACET_INDEX_CACHE_BYTES
+FACET_INDEX_TTL = 10 * 60
+FACET_INDEX_CACHE_BYTES = 64 * 1024 * 1024
+
+# Listing totals shown next to paginated results
+LISTING_COUNT_TTL = 5 * 60
+
+# Product page views are buffered and written back in bulk
+VIEW_COUNT_FLUSH_INTERVAL = 30
+VIEW_COUNT_MAX_PENDING = 1000
+
+# Per-user order counts by status (order list tabs, account overview)
+ORDER_STATS_TTL = 10 * 60
+
+# Per-user set of reviewed product ids (review prompts, review submission)
+REVIEWED_PRODUCTS_TTL = 60 * 60
+
+# Delivery zones and pickup stations kept per process for fee/ETA lookups
+DELIVERY_TABLE_TTL = 10 * 60
+
+# Products kept per materialized ranking (category/vendor/brand top lists).
+# Category and catalog-wide rankings change only when rebuilt: run
+# `manage.py refresh_rankings --interval 900`; a ranking not rebuilt for
+# RANKING_MAX_AGE seconds is rebuilt on read
+RANKING_SIZE = 48
+RANKING_MAX_AGE = 30 * 60
+
+# Sampled per-view profiling (query counts, DB/template/view time, repeated
+# queries), readable by staff at /api/profiling/ and optionally snapshotted
+# to REQUEST_PROFILING_SNAPSHOT_DIR
+REQUEST_PROFILING = False
+REQUEST_PROFILING_SAMPLE_RATE = 0.01
+REQUEST_PROFILING_MAX_SAMPLES = 1000
+REQUEST_PROFILING_SNAPSHOT_DIR = None
+REQUEST_PROFILING_SNAPSHOT_INTERVAL = 5 * 60
+REQUEST_PROFILING_SNAPSHOT_KEEP = 48
+
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -185,4 +254,36 @@ MPESA_CALLBACK_URL = 'https://6c35cb9e4cf6.ngrok-free.app/payment/mpesa/callback
 # 1. Install ngrok: https://ngrok.com/download
 # 2. Run: ngrok http 8000
 # 3. Copy the https URL and append /payment/mpesa/callback/
-# Example: https://abc123.ngrok.io/payment/mpesa/callback/
\ No newline at end of file
+# Example: https://abc123.ngrok.io/payment/mpesa/callback/
+
+# Access tokens are reused until this many seconds before they expire,
+# then refreshed in the background
+MPESA_TOKEN_REFRESH_MARGIN = 5 * 60
+
+# Daraja HTTP client: timeouts in seconds, retries for calls that are safe to
+# repeat, and a circuit breaker that fails fast after repeated errors
+MPESA_CONNECT_TIMEOUT = 3.05
+MPESA_READ_TIMEOUT = 10
+MPESA_MAX_RETRIES = 2
+MPESA_POOL_SIZE = 20
+MPESA_BREAKER_THRESHOLD = 5
+MPESA_BREAKER_COOLDOWN = 30
+
+# Callbacks are stored in an inbox and applied by
+# `python manage.py process_mpesa_callbacks`; unmatched callbacks are retried
+# for MPESA_CALLBACK_MAX_ATTEMPTS passes
+MPESA_CALLBACK_BATCH_SIZE = 200
+MPESA_CALLBACK_POLL_INTERVAL = 1
+MPESA_CALLBACK_MAX_ATTEMPTS = 10
+
+# check_payment_status holds long-poll requests open for at most this many
+# seconds; serve under ASGI so waiting clients don't each hold a worker
+PAYMENT_STATUS_MAX_WAIT = 25
+
+# `python manage.py reconcile_mpesa_payments` queries Daraja for payments
+# still processing this many seconds after creation, with a bounded number
+# of concurrent queries and a queries-per-second limit
+MPESA_RECONCILE_AFTER = 5 * 60
+MPESA_RECONCILE_BATCH_SIZE = 100
+MPESA_RECONCILE_WORKERS = 4
+MPESA_RECONCILE_RATE = 10